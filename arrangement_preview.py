@@ -0,0 +1,279 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from pattern_m21_converter import PitchedInstruments, DrumInstruments, States, MEASURE_DURATION
+
+# (start, end) of the sounding parts of a beat, in beats, for each state of a chord or bass beat
+BEAT_SPANS = {
+    States.FILL_1.value: [(0.0, 1.0)],
+    States.FILL_1_1.value: [(0.0, 0.5), (0.5, 1.0)],
+    States.FILL_0_1.value: [(0.5, 1.0)],
+    States.FILL_1_T.value: [(0.0, 2.0)],
+}
+
+# hits of a drum beat, drawn as sixteenths, for each state
+BEAT_HITS = {
+    States.FILL_1.value: [(0.0, 0.25)],
+    States.FILL_1_1.value: [(0.0, 0.25), (0.5, 0.75)],
+    States.FILL_0_1.value: [(0.5, 0.75)],
+    States.FILL_1_T.value: [(0.0, 0.25)],
+}
+
+
+class ArrangementPreview:
+    """
+    Draws an arrangement as an RGB image: a piano-roll of the melody, chords and bass over a drum grid,
+    wrapped in systems of a few measures, like a score.
+
+    Notes and hits are turned into arrays of rectangles, and each color layer is rasterized at once:
+    the rectangles are expanded into pixel runs (one per pixel row), then into flat pixel indices,
+    so the cost depends on the painted pixels, not on the number of notes or the size of the image.
+    """
+
+    PX_PER_BEAT = 24
+    PX_PER_SEMITONE = 3
+    DRUM_ROW_HEIGHT = 6
+    SYSTEM_GAP = 10
+    MEASURES_PER_SYSTEM = 8
+
+    COLORS = {
+        "background": (255, 255, 255),
+        "beat_line": (235, 235, 235),
+        "measure_line": (170, 170, 170),
+        "drum_background": (245, 245, 240),
+        "chord": (120, 190, 120),
+        "bass": (60, 100, 200),
+        "melody": (220, 70, 50),
+    }
+
+    DRUM_COLORS = {
+        DrumInstruments.RIDE: (200, 160, 40),
+        DrumInstruments.FOOT_HIHAT: (150, 150, 150),
+        DrumInstruments.HIHAT: (100, 100, 100),
+        DrumInstruments.SNARE: (160, 60, 160),
+        DrumInstruments.KICK: (40, 40, 40),
+        DrumInstruments.CRASH: (230, 130, 30),
+    }
+
+    def __init__(self, measures_per_system=MEASURES_PER_SYSTEM):
+        self.beats_per_system = measures_per_system * MEASURE_DURATION
+        self.width = self.beats_per_system * self.PX_PER_BEAT
+
+    @staticmethod
+    def _beat_spans(row, spans_by_state):
+        """
+        Spans (or hits) of a row of the state: arrays of beat positions and of (start, end) in beats
+        """
+        positions, starts, ends = [], [], []
+        for state_value, spans in spans_by_state.items():
+            state_positions = np.flatnonzero(row == state_value)
+            for (span_start, span_end) in spans:
+                positions.append(state_positions)
+                starts.append(state_positions + span_start)
+                ends.append(state_positions + span_end)
+
+        return np.concatenate(positions).astype(int), np.concatenate(starts), np.concatenate(ends)
+
+    def _pitched_rects(self, row, beat_midis):
+        """
+        Rectangles (start, end, midi) of the chord or bass notes
+        """
+        positions, starts, ends = self._beat_spans(row, BEAT_SPANS)
+
+        # one rectangle per note of each sounding beat
+        n_notes = np.array([len(midis) for midis in beat_midis], dtype=int)
+        flat_midis = np.concatenate([np.asarray(midis, dtype=int) for midis in beat_midis]) if beat_midis \
+            else np.zeros(0, dtype=int)
+        first_notes = np.cumsum(n_notes) - n_notes
+
+        in_range = positions < len(beat_midis)
+        positions, starts, ends = positions[in_range], starts[in_range], ends[in_range]
+        n_rect_notes = n_notes[positions]
+        note_idxs = self._expand(first_notes[positions], n_rect_notes)
+
+        return np.repeat(starts, n_rect_notes), np.repeat(ends, n_rect_notes), flat_midis[note_idxs]
+
+    @staticmethod
+    def _melody_rects(melody, octave_up_down, window=None):
+        """
+        Rectangles (start, end, midi) of the melody notes, laid out one after another as in the score
+
+        :param window: (start_beat, end_beat): only the notes in the window, cut at its bounds, from its start
+        """
+        durations = np.array([float(melody_fig.duration.quarterLength) for melody_fig in melody])
+        is_note = np.array([melody_fig.isNote for melody_fig in melody], dtype=bool)
+        midis = np.array([melody_fig.pitch.midi if melody_fig.isNote else 0 for melody_fig in melody], dtype=int)
+        starts = np.cumsum(durations) - durations
+        ends = starts + durations
+
+        if window is not None:
+            start_beat, end_beat = window
+            is_note &= (ends > start_beat) & (starts < end_beat)
+            starts = np.maximum(starts, start_beat) - start_beat
+            ends = np.minimum(ends, end_beat) - start_beat
+
+        return starts[is_note], ends[is_note], midis[is_note] + 12 * octave_up_down
+
+    def _wrap(self, starts, ends, tops, bottoms):
+        """
+        Pixel rectangles of spans in beats, split at the system boundaries.
+
+        :param tops, bottoms: vertical pixel range of each span within a system
+        :return: x0, x1, y0, y1 arrays of pixel rectangles in the image
+        """
+        x_starts = np.round(np.asarray(starts) * self.PX_PER_BEAT).astype(int)
+        x_ends = np.maximum(np.round(np.asarray(ends) * self.PX_PER_BEAT).astype(int), x_starts + 1)
+
+        first_systems = x_starts // self.width
+        last_systems = (x_ends - 1) // self.width
+        n_pieces = last_systems - first_systems + 1
+
+        # one piece per system covered by each span
+        span_idxs = np.repeat(np.arange(len(x_starts)), n_pieces)
+        piece_systems = self._expand(first_systems, n_pieces)
+        system_x = piece_systems * self.width
+        x0 = np.maximum(x_starts[span_idxs], system_x) - system_x
+        x1 = np.minimum(x_ends[span_idxs], system_x + self.width) - system_x
+        y0 = piece_systems * self.system_height + np.asarray(tops)[span_idxs]
+        y1 = piece_systems * self.system_height + np.asarray(bottoms)[span_idxs]
+
+        return x0, x1, y0, y1
+
+    @staticmethod
+    def _expand(starts, lengths):
+        """
+        Concatenation of the ranges [start, start + length)
+        """
+        range_starts = np.cumsum(lengths) - lengths
+        return np.repeat(starts - range_starts, lengths) + np.arange(lengths.sum())
+
+    def _layer_pixels(self, rects):
+        """
+        Flat indices of the pixels covered by a set of rectangles
+        """
+        x0, x1, y0, y1 = rects
+
+        # one run per pixel row of each rectangle
+        n_rows = np.maximum(y1 - y0, 0)
+        run_rows = self._expand(y0, n_rows)
+        run_x0 = np.repeat(x0, n_rows)
+        run_lengths = np.repeat(np.maximum(x1 - x0, 0), n_rows)
+
+        return self._expand(run_rows * self.width + run_x0, run_lengths)
+
+    def render(self, state, melody, m21_chord_progression, m21_bass_line, octave_up_down=0, window=None):
+        """
+        :param state: state of the Cellular Automaton
+        :param melody: list of music21 notes and rests
+        :param m21_chord_progression: list of music21 chords (one per beat)
+        :param m21_bass_line: list of music21 notes (one per beat)
+        :param window: (start_beat, end_beat) of the beats to draw (see pattern_m21_converter.measure_window),
+            or None for the whole arrangement; the chords and bass notes out of the window are not read
+        :return: np.ndarray uint8 (height, width, 3)
+        """
+        if window is not None:
+            start_beat, end_beat = window
+            state = state[:, start_beat:end_beat]
+            m21_chord_progression = m21_chord_progression[start_beat:end_beat]
+            m21_bass_line = m21_bass_line[start_beat:end_beat]
+
+        pattern_length = state.shape[1]
+
+        chord_midis = [[pitch.midi for pitch in m21_chord.pitches] for m21_chord in m21_chord_progression]
+        bass_midis = [[bass_note.pitch.midi] for bass_note in m21_bass_line]
+
+        pitched_rects = {
+            "chord": self._pitched_rects(state[PitchedInstruments.CHORD.value], chord_midis),
+            "bass": self._pitched_rects(state[PitchedInstruments.BASS.value], bass_midis),
+            "melody": self._melody_rects(melody, octave_up_down, window),
+        }
+
+        # vertical layout of a system: piano-roll (high pitches on top), then the drum rows
+        all_midis = np.concatenate([midis for (_, _, midis) in pitched_rects.values()])
+        lowest_midi, highest_midi = (all_midis.min() - 2, all_midis.max() + 2) if len(all_midis) else (36, 84)
+        roll_height = (highest_midi - lowest_midi + 1) * self.PX_PER_SEMITONE
+        drums_top = roll_height + 2
+        self.system_height = drums_top + len(DrumInstruments) * self.DRUM_ROW_HEIGHT + self.SYSTEM_GAP
+
+        n_systems = max(int(np.ceil(pattern_length / self.beats_per_system)), 1)
+        shape = (n_systems * self.system_height, self.width)
+        image = np.empty(shape + (3,), dtype=np.uint8)
+        image[:] = self.COLORS["background"]
+
+        content_height = self.system_height - self.SYSTEM_GAP
+        n_beats = n_systems * self.beats_per_system
+        beats = np.arange(n_beats)
+        layers = [
+            ("drum_background", self._wrap([0], [n_beats], [drums_top], [content_height])),
+            ("beat_line", self._wrap(beats, beats + 1 / self.PX_PER_BEAT, np.zeros(n_beats, dtype=int),
+                                     np.full(n_beats, content_height))),
+            ("measure_line", self._wrap(beats[::MEASURE_DURATION], beats[::MEASURE_DURATION] + 1 / self.PX_PER_BEAT,
+                                        np.zeros(len(beats[::MEASURE_DURATION]), dtype=int),
+                                        np.full(len(beats[::MEASURE_DURATION]), content_height))),
+        ]
+
+        for voice, (starts, ends, midis) in pitched_rects.items():
+            tops = (highest_midi - midis) * self.PX_PER_SEMITONE
+            # 1 pixel gap between repeated notes
+            layers.append((voice, self._wrap(starts, ends - 1 / self.PX_PER_BEAT, tops, tops + self.PX_PER_SEMITONE)))
+
+        for drum_idx, drum_instrument in enumerate(DrumInstruments):
+            _, starts, ends = self._beat_spans(state[drum_instrument.value], BEAT_HITS)
+            top = drums_top + drum_idx * self.DRUM_ROW_HEIGHT
+            layers.append((drum_instrument, self._wrap(starts, ends, np.full(len(starts), top),
+                                                       np.full(len(starts), top + self.DRUM_ROW_HEIGHT - 1))))
+
+        pixels = image.reshape(-1, 3)
+        for layer, rects in layers:
+            color = self.DRUM_COLORS[layer] if layer in self.DRUM_COLORS else self.COLORS[layer]
+            pixels[self._layer_pixels(rects)] = color
+
+        return image
+
+
+class PreviewCache:
+    """
+    Least recently used previews, keyed by the render which produced the arrangement (e.g. its tune,
+    parameters and seed, see cellularautomaton_gradio.preview_key), so that a render is drawn once
+    """
+
+    def __init__(self, max_previews=16):
+        self.max_previews = max_previews
+        self._previews = OrderedDict()
+
+    def get(self, key, state, melody, m21_chord_progression, m21_bass_line, octave_up_down=0, window=None):
+        """
+        Preview image of an arrangement, drawn if it is not in the cache
+
+        :param key: hashable key of the arrangement, or None to draw it without caching it (e.g. unseeded render)
+        """
+        image = self.cached(key)
+        if image is None:
+            image = ArrangementPreview().render(state, melody, m21_chord_progression, m21_bass_line,
+                                                octave_up_down=octave_up_down, window=window)
+            if key is not None:
+                self._previews[key] = image
+                if len(self._previews) > self.max_previews:
+                    self._previews.popitem(last=False)
+
+        return image
+
+    def cached(self, key):
+        """
+        Preview image of a key if it is in the cache (else None), without the arrangement
+        """
+        image = self._previews.get(key) if key is not None else None
+        if image is not None:
+            self._previews.move_to_end(key)
+        return image
+
+
+preview_cache = PreviewCache()
+
+
+def preview_image(state, melody, m21_chord_progression, m21_bass_line, octave_up_down=0, window=None, key=None):
+    """
+    Cached preview image of an arrangement (see ArrangementPreview and PreviewCache)
+    """
+    return preview_cache.get(key, state, melody, m21_chord_progression, m21_bass_line, octave_up_down, window)
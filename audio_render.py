@@ -0,0 +1,330 @@
+import os
+import time
+import wave
+
+import numpy as np
+import music21 as m21
+
+from pattern_m21_converter import PatternMusic21Converter, PitchedInstruments, DrumInstruments, States
+from cellularautomaton_gradio import generate_arrangement
+
+DEFAULT_TEMPO = 120
+
+
+def midi_to_frequency(midi):
+    return 440.0 * 2 ** ((np.asarray(midi, dtype=float) - 69) / 12)
+
+
+class AudioRenderer:
+    """
+    Renders the parts generated by the Cellular Automaton into a WAV file, without MuseScore.
+
+    - drums: each DrumInstruments pitch has a synthesized hit (noise and sine sweeps)
+    - melody, chords and bass: simple additive voices (a few harmonics with an envelope)
+
+    Each note or hit is an event pointing to a waveform template; templates are synthesized once and
+    stored in a flat bank. The mix is computed block by block with a vectorized overlap-add of the
+    events which sound in the block (np.bincount), and each block is written to the WAV file as soon
+    as it is mixed, so memory depends on the block size and the templates, not on the tune length.
+    """
+
+    # voice: (harmonic amplitudes, attack seconds, decay time constant seconds, gain)
+    pitched_voices = {
+        "melody": ([1.0, 0.6, 0.4, 0.25, 0.15], 0.02, 1.5, 0.25),
+        "chord": ([1.0, 0.4, 0.2, 0.1], 0.005, 0.6, 0.07),
+        "bass": ([1.0, 0.5, 0.25], 0.005, 0.5, 0.35),
+    }
+
+    # drum pitch: (seconds, gain)
+    drum_sounds = {
+        51: (0.9, 0.12),  # ride cymbal
+        44: (0.08, 0.10),  # foot hihat
+        42: (0.06, 0.08),  # hihat
+        38: (0.2, 0.25),  # snare
+        36: (0.3, 0.6),  # bass drum
+        49: (1.5, 0.15),  # crash cymbal
+    }
+
+    RELEASE = 0.03  # seconds of fade out at the end of pitched notes
+    MASTER_GAIN = 0.5
+
+    def __init__(self, sample_rate=22050, block_size=8192, swing_ratio=0.5):
+        """
+        :param sample_rate: samples per second
+        :param block_size: samples mixed at a time
+        :param swing_ratio: position of the second eighth of a beat; 0.5 is straight (as in the score),
+            about 0.66 is the standard swing for slow to medium tempos
+        """
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.swing_ratio = swing_ratio
+
+        self._template_bank = []  # list of np.ndarray, concatenated into a flat bank in render
+        self._template_ids = {}  # template key -> index
+        self._noise = np.random.default_rng(0)  # fixed noise, so that renders are reproducible
+
+    def _swing(self, offsets):
+        """
+        Moves the second eighth of each beat to swing_ratio (piecewise linear time map)
+        """
+        offsets = np.asarray(offsets, dtype=float)
+        beats = np.floor(offsets)
+        fraction = offsets - beats
+        swung = np.where(fraction < 0.5,
+                         fraction / 0.5 * self.swing_ratio,
+                         self.swing_ratio + (fraction - 0.5) / 0.5 * (1 - self.swing_ratio))
+        return beats + swung
+
+    def _template(self, key, synthesize):
+        template_id = self._template_ids.get(key)
+        if template_id is None:
+            template_id = len(self._template_bank)
+            self._template_bank.append(synthesize().astype(np.float32))
+            self._template_ids[key] = template_id
+        return template_id
+
+    def _pitched_template(self, voice, midi, n_samples):
+
+        def synthesize():
+            harmonics, attack, decay, gain = self.pitched_voices[voice]
+            t = np.arange(n_samples) / self.sample_rate
+            frequency = midi_to_frequency(midi)
+            k = np.arange(1, len(harmonics) + 1)[:, None]
+            # harmonics above the Nyquist frequency are removed
+            amplitudes = np.where(k[:, 0] * frequency < self.sample_rate / 2, harmonics, 0.0)[:, None]
+            waveform = (amplitudes * np.sin(2 * np.pi * frequency * k * t)).sum(axis=0)
+
+            envelope = np.minimum(t / attack, 1.0) * np.exp(-t / decay)
+            release_samples = min(int(self.RELEASE * self.sample_rate), n_samples)
+            envelope[n_samples - release_samples:] *= np.linspace(1, 0, release_samples)
+
+            return gain * waveform * envelope
+
+        return self._template((voice, int(midi), n_samples), synthesize)
+
+    def _drum_template(self, drum_pitch):
+
+        def synthesize():
+            seconds, gain = self.drum_sounds[drum_pitch]
+            n_samples = int(seconds * self.sample_rate)
+            t = np.arange(n_samples) / self.sample_rate
+            noise = self._noise.uniform(-1, 1, n_samples)
+
+            if drum_pitch == 36:  # bass drum: sine sweep down
+                phase = 2 * np.pi * np.cumsum(50 + 100 * np.exp(-t / 0.04)) / self.sample_rate
+                waveform = np.sin(phase) * np.exp(-t / 0.12)
+            elif drum_pitch == 38:  # snare: noise and tone
+                waveform = (0.7 * noise + 0.5 * np.sin(2 * np.pi * 190 * t)) * np.exp(-t / 0.05)
+            elif drum_pitch in [42, 44]:  # hihats: high-passed noise
+                waveform = np.diff(noise, prepend=0.0) * np.exp(-t / (0.015 if drum_pitch == 42 else 0.025))
+            else:  # cymbals: inharmonic partials and noise
+                partials = np.array([1.0, 1.483, 1.932, 2.546, 2.63, 3.897]) * (420 if drum_pitch == 51 else 340)
+                metal = np.sign(np.sin(2 * np.pi * partials[:, None] * t)).sum(axis=0) / len(partials)
+                tail = 0.25 if drum_pitch == 51 else 0.5
+                waveform = (0.5 * metal + 0.5 * np.diff(noise, prepend=0.0)) * np.exp(-t / tail)
+
+            return gain * waveform
+
+        return self._template(("drum", drum_pitch), synthesize)
+
+    def _drum_events(self, state):
+        """
+        Onsets (in beats) and templates of the drum hits, vectorized per drum row
+        """
+        onsets = []
+        template_ids = []
+        for drum_instrument in DrumInstruments:
+            row = state[drum_instrument.value]
+            template_id = self._drum_template(PatternMusic21Converter.drumInstruments[drum_instrument][1])
+
+            positions = np.concatenate([
+                np.flatnonzero(row == States.FILL_1.value),
+                np.flatnonzero(row == States.FILL_1_1.value),
+                np.flatnonzero(row == States.FILL_1_1.value) + 0.5,
+                np.flatnonzero(row == States.FILL_0_1.value) + 0.5,
+            ])
+            onsets.append(positions)
+            template_ids.append(np.full(len(positions), template_id))
+
+        return np.concatenate(onsets), np.concatenate(template_ids)
+
+    def _beat_pitched_events(self, state, row_idx, beat_midis, voice, seconds_per_beat):
+        """
+        Onsets and templates of the chord or bass notes (one chord or bass note per beat)
+        """
+        row = state[row_idx][:len(beat_midis)]
+        onsets = np.arange(len(row), dtype=float)
+        durations = np.ones(len(row))
+
+        syncopated = row == States.FILL_0_1.value
+        onsets[syncopated] += 0.5
+        durations[syncopated] = 0.5
+        durations[row == States.FILL_1_T.value] = 2.0
+        sounding = row != States.OFF.value
+
+        event_onsets = []
+        template_ids = []
+        for position in np.flatnonzero(sounding):
+            n_samples = int(durations[position] * seconds_per_beat * self.sample_rate)
+            for midi in beat_midis[position]:
+                event_onsets.append(onsets[position])
+                template_ids.append(self._pitched_template(voice, midi, n_samples))
+
+        return np.array(event_onsets), np.array(template_ids, dtype=int)
+
+    def _melody_events(self, melody, seconds_per_beat, octave_up_down):
+        """
+        Onsets and templates of the melody notes; tied notes are joined. The melody figures are laid out one
+        after another from offset 0, as in the score (their offsets are not those of the lead-sheet after
+        quantize_melody, nor for the copies of repeat_melody)
+        """
+        durations = np.array([float(melody_fig.duration.quarterLength) for melody_fig in melody])
+        offsets = np.cumsum(durations) - durations
+        notes = [melody_fig for melody_fig in melody if isinstance(melody_fig, m21.note.Note)]
+        note_offsets = [offset for (offset, melody_fig) in zip(offsets, melody)
+                        if isinstance(melody_fig, m21.note.Note)]
+
+        onsets = []
+        template_ids = []
+        for note_idx, melody_note in enumerate(notes):
+            if melody_note.tie is not None and melody_note.tie.type in ["stop", "continue"]:
+                continue
+
+            duration = melody_note.duration.quarterLength
+            next_idx = note_idx + 1
+            while (melody_note.tie is not None and next_idx < len(notes) and notes[next_idx].tie is not None
+                   and notes[next_idx].tie.type in ["stop", "continue"]):
+                duration += notes[next_idx].duration.quarterLength
+                next_idx += 1
+
+            n_samples = max(int(duration * seconds_per_beat * self.sample_rate), 1)
+            onsets.append(note_offsets[note_idx])
+            template_ids.append(self._pitched_template("melody", melody_note.pitch.midi + 12 * octave_up_down,
+                                                       n_samples))
+
+        return np.array(onsets, dtype=float), np.array(template_ids, dtype=int)
+
+    def render(self, fp, state, melody, m21_chord_progression, m21_bass_line, tempo=None, octave_up_down=0):
+        """
+        Renders the tune into a mono 16 bit WAV file.
+
+        :param state: state of the Cellular Automaton
+        :param melody: list of music21 notes and rests (concert pitch), laid out one after another
+        :param m21_chord_progression: list of music21 chords (one per beat)
+        :param m21_bass_line: list of music21 notes (one per beat)
+        :param tempo: music21 metronome mark (DEFAULT_TEMPO if None)
+        :return: seconds of audio
+        """
+        quarter_bpm = tempo.getQuarterBPM() if tempo is not None else DEFAULT_TEMPO
+        seconds_per_beat = 60.0 / quarter_bpm
+
+        chord_midis = [[pitch.midi for pitch in m21_chord.pitches] for m21_chord in m21_chord_progression]
+        bass_midis = [[bass_note.pitch.midi] for bass_note in m21_bass_line]
+
+        events = [
+            self._drum_events(state),
+            self._beat_pitched_events(state, PitchedInstruments.CHORD.value, chord_midis, "chord", seconds_per_beat),
+            self._beat_pitched_events(state, PitchedInstruments.BASS.value, bass_midis, "bass", seconds_per_beat),
+            self._melody_events(melody, seconds_per_beat, octave_up_down),
+        ]
+        onsets = np.concatenate([event_onsets for (event_onsets, _) in events])
+        template_ids = np.concatenate([event_template_ids for (_, event_template_ids) in events]).astype(int)
+
+        # flat template bank
+        template_lengths = np.array([len(template) for template in self._template_bank])
+        template_starts = np.concatenate([[0], np.cumsum(template_lengths)[:-1]])
+        bank = np.concatenate(self._template_bank)
+
+        starts = np.round(self._swing(onsets) * seconds_per_beat * self.sample_rate).astype(np.int64)
+        order = np.argsort(starts, kind="stable")
+        starts = starts[order]
+        template_ids = template_ids[order]
+        ends = starts + template_lengths[template_ids]
+
+        pattern_length = len(state[0])
+        n_samples = max(int(pattern_length * seconds_per_beat * self.sample_rate), int(ends.max(initial=0)))
+        max_template_length = template_lengths.max(initial=0)
+
+        with wave.open(fp, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(self.sample_rate)
+
+            for block_start in range(0, n_samples, self.block_size):
+                block_end = min(block_start + self.block_size, n_samples)
+                block = self._mix_block(block_start, block_end, starts, ends, template_ids, template_starts,
+                                        bank, max_template_length)
+
+                # soft clipping instead of normalization, which would need the whole tune
+                block = np.tanh(self.MASTER_GAIN * block)
+                wav_file.writeframes((block * 32767).astype("<i2").tobytes())
+
+        return n_samples / self.sample_rate
+
+    @staticmethod
+    def _mix_block(block_start, block_end, starts, ends, template_ids, template_starts, bank,
+                   max_template_length):
+        """
+        Overlap-add of the events which sound in [block_start, block_end)
+        """
+        # events are sorted by start: only those starting less than max_template_length before can sound
+        first, last = np.searchsorted(starts, [block_start - max_template_length, block_end])
+        active = np.arange(first, last)
+        active = active[ends[active] > block_start]
+
+        if len(active) == 0:
+            return np.zeros(block_end - block_start)
+
+        segment_starts = np.maximum(starts[active], block_start)
+        segment_lengths = np.minimum(ends[active], block_end) - segment_starts
+
+        # index of each sample inside its segment
+        segment_offsets = np.repeat(np.cumsum(segment_lengths) - segment_lengths, segment_lengths)
+        ramp = np.arange(segment_lengths.sum()) - segment_offsets
+
+        block_positions = np.repeat(segment_starts - block_start, segment_lengths) + ramp
+        bank_positions = np.repeat(template_starts[template_ids[active]] + segment_starts - starts[active],
+                                   segment_lengths) + ramp
+
+        return np.bincount(block_positions, weights=bank[bank_positions], minlength=block_end - block_start)
+
+
+def render_audio(selected_file, fp=None, synco_prob=0.5, kick_crash_prob=0.2, octave_up_down=0,
+                 voice_leading="greedy", voice_leading_temperature=0.0, folder="./Omnibook",
+                 sample_rate=22050, swing_ratio=0.5, choruses=1):
+    """
+    Adds rhythm to a lead-sheet and renders it into a WAV file (by default, next to the lead-sheet).
+
+    :param choruses: number of times the form is played (see generate_arrangement)
+
+    :return: fp: WAV file path
+    """
+    file_path = os.path.join(folder, selected_file)
+    if fp is None:
+        fp = os.path.splitext(file_path)[0] + "_rhythm.wav"
+
+    rhythm_generator, m21_melody, m21_chord_progression, m21_bass_line, _, tempo = generate_arrangement(
+        file_path,
+        synco_prob=synco_prob,
+        kick_crash_prob=kick_crash_prob,
+        voice_leading=voice_leading,
+        voice_leading_temperature=voice_leading_temperature,
+        choruses=choruses,
+    )
+
+    start_time = time.perf_counter()
+    audio_renderer = AudioRenderer(sample_rate=sample_rate, swing_ratio=swing_ratio)
+    audio_seconds = audio_renderer.render(fp, rhythm_generator.state, m21_melody, m21_chord_progression,
+                                          m21_bass_line, tempo=tempo, octave_up_down=octave_up_down)
+    render_seconds = time.perf_counter() - start_time
+
+    print(f"Rendered {audio_seconds:.1f} s of audio in {render_seconds:.2f} s "
+          f"({audio_seconds / render_seconds:.0f}x real time) into {fp}")
+
+    return fp
+
+
+if __name__ == "__main__":
+
+    # original https://www.youtube.com/watch?v=02apSoxB7B4
+    render_audio("Donna_Lee.xml", swing_ratio=0.66)
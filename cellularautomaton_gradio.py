@@ -1,13 +1,20 @@
-import gradio as gr
-
+import heapq
 import os
+import time
 
-from pattern_m21_converter import PatternMusic21Converter, PitchedInstruments, DrumInstruments, States, melody_instruments_d
+from pattern_m21_converter import PatternMusic21Converter, PitchedInstruments, DrumInstruments, States, melody_instruments_d, \
+    measure_window
 from m21_musescore import M21_and_show
-from omnibook_read import chords_and_m21melody
+from omnibook_read import chords_and_m21melody, melody_onset_grid, tune_melody_grid, repeat_melody, tile_melody_grid
+from render_memory import tune_context, stage_context
+from arrangement_preview import preview_cache, preview_image
+from generation_history import GenerationHistory
+from latency_budget import DEGRADATION_DESCRIPTIONS, background_renders, latency_planner
+from rule_tables import compile_jazz_rules, rule_context
 
 CHORD_SPLIT = ":"
 MEASURE_DURATION = 4
+CHORD_VOCABULARY = M21_and_show.chord_vocabulary
 
 import numpy as np
 import music21 as m21 # instrument, metadata, note, stream, clef, tie
@@ -31,7 +38,8 @@ class CellularAutomatonRhythmGenerator:
     EVEN_BEAT_SWING_PROBABILITY = 0.2
     ODD_BEAT_SWING_PROBABILITY = 0.8
 
-    def __init__(self, melody, chord_sequence, synco_prob=0.5, kick_crash_prob=0.2, print_states=False):
+    def __init__(self, melody, chord_sequence, synco_prob=0.5, kick_crash_prob=0.2, print_states=False,
+                 use_rule_tables=False, melody_grid=None, melody_synco_prob=None, random_state=None):
         """
         Initializes the CellularAutomatonRhythmGenerator with a specified pattern
         length.
@@ -41,9 +49,18 @@ class CellularAutomatonRhythmGenerator:
             chord_sequence (list): Sequence of chords. Each chord will be split in two parts:
                 - the root note will be assigned to the bass
                 - the rest of the chord will be assigned to the piano
+            use_rule_tables (bool): apply the rules as compiled lookup tables (see rule_tables.py)
+                to the whole state at once, instead of the per-position Python rules
+            melody_grid (dict): melody onsets and accents per eighth (see omnibook_read.melody_onset_grid),
+                computed from the melody if not given
+            melody_synco_prob (float): if not None, syncopation probability of the beats with an accented
+                melody note on their second eighth, so that the rhythm section answers the melody
+            random_state (np.random.RandomState): random state of the rules, e.g. seeded for a render,
+                so that concurrent renders do not share their draws (default: the global numpy random state)
         """
 
         self.melody = melody
+        self.random_state = random_state if random_state is not None else np.random
         self.chord_sequence = chord_sequence
 
         # pattern_length: The length of the tune pattern in beats.
@@ -52,10 +69,16 @@ class CellularAutomatonRhythmGenerator:
 
         self.state = self._initialize_state(self.pattern_length)
 
-        self.beat_bass_sequence, self.beat_chord_sequence = self._initialize_beat_pitch_sequences()
+        # chord of each beat, as root and type codes of the chord vocabulary
+        self.beat_chord_roots, self.beat_chord_types = self._initialize_beat_pitch_sequences()
+        self._init_beat_chord_features()
+
+        self.melody_grid = melody_grid if melody_grid is not None else \
+            melody_onset_grid(melody, self.pattern_length)
 
         self.SYNCOPATION_PROBABILITY = synco_prob
         self.KICK_OR_CRASH_PROBABILITY = kick_crash_prob  # only when syncopation occurs
+        self.MELODY_SYNCOPATION_PROBABILITY = melody_synco_prob  # on beats with a melody push
 
         self.print_states = print_states
         if print_states==True:
@@ -66,6 +89,25 @@ class CellularAutomatonRhythmGenerator:
             "jazz_syncopation": self._apply_jazz_syncopation_rule,
         }
 
+        self.use_rule_tables = use_rule_tables
+        if use_rule_tables:
+            # same rules as self._rules, in the declarative format
+            self._compiled_rules = compile_jazz_rules(
+                synco_prob=synco_prob,
+                kick_crash_prob=kick_crash_prob,
+                even_beat_swing_prob=self.EVEN_BEAT_SWING_PROBABILITY,
+                odd_beat_swing_prob=self.ODD_BEAT_SWING_PROBABILITY,
+                melody_synco_prob=melody_synco_prob,
+            )
+            self._rule_context = rule_context(self.beat_chord_roots, self.beat_chord_types, self.melody_grid)
+
+        # input state and random draws of each step, so that edit_chords can apply the rules again
+        # to the positions affected by a chord edit with the same draws
+        self._steps = []
+        self._position_draws = None
+        self._draw_position = None
+        self._replayed_draws = None
+
     def step(self, s):
         """
         Advances the drum pattern by one time step by applying the defined
@@ -75,10 +117,21 @@ class CellularAutomatonRhythmGenerator:
         # print(self.beat_chord_sequence)
         # print(self.beat_bass_sequence)
 
-        new_state = self.state.copy()
-        for position in range(self.pattern_length):
-            new_state = self._apply_rules(position, new_state)
+        step_input = self.state
+        if self.use_rule_tables:
+            # the same draws as CompiledRule.apply takes, kept for edit_chords
+            step_draws = [self.random_state.random_sample(self.pattern_length) for _ in self._compiled_rules]
+            new_state = self._apply_compiled_rules(step_input, step_draws)
+        else:
+            step_draws = [[] for _ in range(self.pattern_length)]
+            self._position_draws = step_draws
+            new_state = self.state.copy()
+            for position in range(self.pattern_length):
+                self._draw_position = position
+                new_state = self._apply_rules(position, new_state)
+            self._position_draws = None
         self.state = new_state
+        self._steps.append((step_input, step_draws))
 
         if self.print_states==True:
             print(f"States after step {s}:\n", self.state)
@@ -86,31 +139,186 @@ class CellularAutomatonRhythmGenerator:
 
     def _initialize_beat_pitch_sequences(self):
 
-        beat_bass_sequence = []
-        beat_chord_sequence = []
-        position = 0
-        for (chord_name, chord_duration) in self.chord_sequence:
-            chord_bass, chord_type = chord_name.split(CHORD_SPLIT)
-            for i in range(chord_duration):
-                beat_bass_sequence.append(chord_bass)
-                beat_chord_sequence.append(chord_name)
+        # chord names are interned once; the beats repeat the codes of their chord
+        root_codes, type_codes = CHORD_VOCABULARY.encode_sequence(
+            [chord_name for (chord_name, _) in self.chord_sequence])
+        chord_durations = [chord_duration for (_, chord_duration) in self.chord_sequence]
+        beat_chord_roots = np.repeat(root_codes, chord_durations)
+        beat_chord_types = np.repeat(type_codes, chord_durations)
+
+        # TODO bad behaviour with chord version changes in m21_musescore
+        # if (i < chord_duration - 1) and np.random.random() < self.CHORD_TIE_PROBABILITY:
+        #    chord_state = States.FILL_1_T.value
+        # else:
+        #    chord_state = States.FILL_1.value
+        chord_state = States.FILL_1.value
+
+        # self.state[PitchedInstruments.MELODY.value][:] = States.FILL_1.value
+
+        self.state[PitchedInstruments.CHORD.value][:] = chord_state
+
+        self.state[PitchedInstruments.BASS.value][:] = States.FILL_1.value
+
+        return beat_chord_roots, beat_chord_types
+
+    def _init_beat_chord_features(self):
+        """
+        Chord features of the beats used by the rules, computed once from the chord codes
+        """
+        # same chord in the next beat (False for the last beat)
+        self.beat_same_chord_next = np.zeros(self.pattern_length, dtype=bool)
+        self.beat_same_chord_next[:-1] = (self.beat_chord_roots[:-1] == self.beat_chord_roots[1:]) & \
+                                         (self.beat_chord_types[:-1] == self.beat_chord_types[1:])
+
+        # V7 or o7 chords
+        self.beat_is_syncopation_type = (CHORD_VOCABULARY.is_dominant | CHORD_VOCABULARY.is_diminished)[
+            self.beat_chord_types]
+
+    def _update_beat_chord_features(self, beats):
+        """
+        Chord features of the beats which depend on the chords of some beats (after edit_chords)
+        """
+        prev_beats = beats[beats > 0] - 1
+        next_beats = beats[beats < self.pattern_length - 1]
+        for feature_beats in (prev_beats, next_beats):
+            self.beat_same_chord_next[feature_beats] = \
+                (self.beat_chord_roots[feature_beats] == self.beat_chord_roots[feature_beats + 1]) & \
+                (self.beat_chord_types[feature_beats] == self.beat_chord_types[feature_beats + 1])
 
-                # TODO bad behaviour with chord version changes in m21_musescore
-                # if (i < chord_duration - 1) and np.random.random() < self.CHORD_TIE_PROBABILITY:
-                #    chord_state = States.FILL_1_T.value
-                # else:
-                #    chord_state = States.FILL_1.value
-                chord_state = States.FILL_1.value
+        self.beat_is_syncopation_type[beats] = (CHORD_VOCABULARY.is_dominant | CHORD_VOCABULARY.is_diminished)[
+            self.beat_chord_types[beats]]
 
-                # self.state[PitchedInstruments.MELODY.value][position] = States.FILL_1.value
+        if self.use_rule_tables:
+            self._rule_context = rule_context(self.beat_chord_roots, self.beat_chord_types, self.melody_grid)
 
-                self.state[PitchedInstruments.CHORD.value][position] = chord_state
+    def edit_chords(self, chord_edits):
+        """
+        Replaces chords of the chord sequence, and applies the rules of the steps again only to the positions
+        affected by the edit, with the random draws of the steps: the result is the state a generator of the
+        edited chord sequence gets for the same seed (the number of draws of a position does not depend
+        on the chords).
+
+        With the per-position rules, the positions whose chord features change (the edited beats and their
+        neighbours) are recomputed, and the next position as long as the new state of a position changes
+        (the syncopation rule reads the new chord state of the previous position). The rule tables are
+        applied to the whole state at once, with the same draws.
+
+        :param chord_edits: dict position of a chord in chord_sequence -> new chord name (durations are kept)
+        :return: edited_beats: np.ndarray, beats whose chord changed
+        :return: changed_positions: np.ndarray, positions whose state changed
+        """
+        # all the edits are checked before any is applied
+        chord_codes = {chord_pos: CHORD_VOCABULARY.encode(chord_name) for chord_pos, chord_name in chord_edits.items()}
+        for chord_pos in chord_edits:
+            if not 0 <= chord_pos < len(self.chord_sequence):
+                raise IndexError(f"No chord {chord_pos} in a sequence of {len(self.chord_sequence)} chords")
+
+        self.chord_sequence = list(self.chord_sequence)
+        chord_starts = np.cumsum([0] + [duration for (_, duration) in self.chord_sequence])
+
+        edited_beats = []
+        for chord_pos, chord_name in chord_edits.items():
+            root_code, type_code = chord_codes[chord_pos]
+            chord_duration = self.chord_sequence[chord_pos][1]
+            self.chord_sequence[chord_pos] = (chord_name, chord_duration)
+
+            chord_beats = np.arange(chord_starts[chord_pos], chord_starts[chord_pos] + chord_duration)
+            if self.beat_chord_roots[chord_beats[0]] != root_code or self.beat_chord_types[chord_beats[0]] != type_code:
+                self.beat_chord_roots[chord_beats] = root_code
+                self.beat_chord_types[chord_beats] = type_code
+                edited_beats.extend(chord_beats)
+
+        edited_beats = np.unique(np.array(edited_beats, dtype=int))
+        if len(edited_beats) == 0:
+            return edited_beats, edited_beats
+
+        self._update_beat_chord_features(edited_beats)
+
+        # the syncopation rule of a position reads the chords of the position and its neighbours
+        dirty_positions = np.unique(np.concatenate([edited_beats - 1, edited_beats, edited_beats + 1]))
+        dirty_positions = dirty_positions[(dirty_positions >= 0) & (dirty_positions < self.pattern_length)]
+
+        initial_state = self.state
+        changed_inputs = np.zeros(0, dtype=int)
+        for step_idx, (step_input, step_draws) in enumerate(self._steps):
+            old_output = self._steps[step_idx + 1][0] if step_idx + 1 < len(self._steps) else self.state
+
+            if self.use_rule_tables:
+                new_output = self._apply_compiled_rules(step_input, step_draws)
+            else:
+                new_output = self._replay_positions(step_input, old_output, step_draws,
+                                                    np.union1d(dirty_positions, changed_inputs))
 
-                self.state[PitchedInstruments.BASS.value][position] = States.FILL_1.value
+            changed_inputs = np.flatnonzero((new_output != old_output).any(axis=0))
+            if step_idx + 1 < len(self._steps):
+                self._steps[step_idx + 1] = (new_output, self._steps[step_idx + 1][1])
+            else:
+                self.state = new_output
 
-                position += 1
+        changed_positions = np.flatnonzero((self.state != initial_state).any(axis=0))
+
+        return edited_beats, changed_positions
+
+    def _replay_positions(self, step_input, old_output, step_draws, positions):
+        """
+        Applies the per-position rules of a step again to some positions, with their recorded draws,
+        and to the next position while the new state of a position changes
+
+        :return: new output of the step
+        """
+        new_state = old_output.copy()
+        pending = [int(position) for position in positions]
+        heapq.heapify(pending)
+        replayed = set()
+        while pending:
+            position = heapq.heappop(pending)
+            if position in replayed:
+                continue
+            replayed.add(position)
+
+            new_state[:, position] = step_input[:, position]
+            self._replayed_draws = iter(step_draws[position])
+            new_state = self._apply_rules(position, new_state)
+            self._replayed_draws = None
+
+            next_position = position + 1
+            if next_position < self.pattern_length and (new_state[:, position] != old_output[:, position]).any():
+                heapq.heappush(pending, next_position)
+
+        return new_state
+
+    def _apply_compiled_rules(self, state, step_draws):
+
+        for compiled_rule, random_draws in zip(self._compiled_rules, step_draws):
+            state = compiled_rule.apply(state, self._rule_context, random_draws)
+        return state
+
+    def _random(self):
+        """
+        Uniform draw of a rule at the current position. The draws of each position are recorded,
+        and replayed when edit_chords applies the rules to the position again
+        """
+        if self._replayed_draws is not None:
+            return next(self._replayed_draws)
+
+        random_draw = self.random_state.random_sample()
+        if self._position_draws is not None:
+            self._position_draws[self._draw_position].append(random_draw)
+        return random_draw
+
+    @property
+    def beat_chord_sequence(self):
+        """
+        Chord name of each beat
+        """
+        return CHORD_VOCABULARY.decode_sequence(self.beat_chord_roots, self.beat_chord_types)
 
-        return beat_bass_sequence, beat_chord_sequence
+    @property
+    def beat_bass_sequence(self):
+        """
+        Bass (chord root) of each beat
+        """
+        return [CHORD_VOCABULARY.root_names[root_code] for root_code in self.beat_chord_roots]
 
     def _initialize_state(self, pattern_length):
         """
@@ -155,7 +363,7 @@ class CellularAutomatonRhythmGenerator:
         if (position % 2) == 0: # even beats: no hihat, one ride beat
             new_foot_hihat_state = States.OFF.value
 
-            if np.random.random() < self.EVEN_BEAT_SWING_PROBABILITY:
+            if self._random() < self.EVEN_BEAT_SWING_PROBABILITY:
                 new_ride_cymbal_state = States.FILL_1_1.value
             else:
                 new_ride_cymbal_state = States.FILL_1.value
@@ -163,7 +371,7 @@ class CellularAutomatonRhythmGenerator:
         else: # odd beats: one hihat beat, swing ride beat
             new_foot_hihat_state = States.FILL_1.value
 
-            if np.random.random() < self.ODD_BEAT_SWING_PROBABILITY:
+            if self._random() < self.ODD_BEAT_SWING_PROBABILITY:
                 new_ride_cymbal_state = States.FILL_1_1.value
             else:
                 new_ride_cymbal_state = States.OFF.value
@@ -182,16 +390,19 @@ class CellularAutomatonRhythmGenerator:
         :param new_state: state before being modified
         :return: new_state: state after being modified
         """
-        if np.random.random() < self.SYNCOPATION_PROBABILITY:
+        synco_prob = self.SYNCOPATION_PROBABILITY
+        if self.MELODY_SYNCOPATION_PROBABILITY is not None and \
+                self.melody_grid["eighth_accents"][2 * position + 1] > 0:
+            # accented melody note on the second eighth of the beat
+            synco_prob = self.MELODY_SYNCOPATION_PROBABILITY
+
+        if self._random() < synco_prob:
             next_position = position + 1
 
             if next_position < self.pattern_length:
-                chord_name = self.beat_chord_sequence[position]
-                chord_type = chord_name.split(CHORD_SPLIT)[1]
-                next_chord_name = self.beat_chord_sequence[next_position]
-                if chord_name == next_chord_name:
+                if self.beat_same_chord_next[position]:
 
-                    if chord_type in ["7", "7(b9)", "o7"]:
+                    if self.beat_is_syncopation_type[position]:
                         # new_state[PitchedInstruments.MELODY.value][position] = States.FILL_0_1.value
 
                         new_state[PitchedInstruments.CHORD.value][position] = States.FILL_0_1.value
@@ -204,14 +415,13 @@ class CellularAutomatonRhythmGenerator:
                         if position > 0:
                             prev_position = position - 1
 
-                            prev_chord_name = self.beat_chord_sequence[prev_position]
                             # Avoid syncopation if previous chord has same name and is [syncopated or tied]
-                            if prev_chord_name != chord_name or \
+                            if not self.beat_same_chord_next[prev_position] or \
                                     new_state[PitchedInstruments.CHORD.value][prev_position] not in \
                                 [States.FILL_0_1.value, States.FILL_1_T.value]:
                                 new_state[PitchedInstruments.CHORD.value][position] = States.FILL_0_1.value
 
-            kick_or_crash = np.random.random()
+            kick_or_crash = self._random()
             if kick_or_crash < self.KICK_OR_CRASH_PROBABILITY: # 0 < random < KICK_OR_CRASH_PROB
                 new_state[DrumInstruments.KICK.value][position] = States.FILL_1.value
             elif kick_or_crash > (1 - self.KICK_OR_CRASH_PROBABILITY): # crash prob is same as kick: 1 > random > (1 - KICK_OR_CRASH_PROB)
@@ -257,101 +467,817 @@ def list_melody_instruments():
 
     return melody_instruments_list
 
+def generate_arrangement(file_path, synco_prob=0.5, kick_crash_prob=0.2,
+                         voice_leading="greedy", voice_leading_temperature=0.0, memory_profiler=None,
+                         use_rule_tables=False, melody_synco_prob=None, choruses=1, seed=None, state=None,
+                         analyze_key=True, table_voicing=False, measures=None):
+    """
+    Reads a lead-sheet, executes the Cellular Automaton and voices the chords, without building a score.
+
+    :param file_path: lead-sheet file path
+    :param use_rule_tables: apply the Cellular Automaton rules as compiled lookup tables
+    :param melody_synco_prob: syncopation probability of the beats with a melody push (None: synco_prob)
+    :param choruses: number of times the form is played; the Cellular Automaton runs over all the choruses,
+        so each chorus gets its own rhythm, while the lead-sheet is parsed and the chords voiced once
+    :param seed: seed of the random draws (Cellular Automaton and voicing, from a random state of the render,
+        not the global one), to render an arrangement again
+    :param state: state of the Cellular Automaton used instead of the generated one,
+        e.g. a version of generation_history.GenerationHistory
+    :param analyze_key: find the key with score.analyze if it is not cached (see omnibook_read.tune_key)
+    :param table_voicing: voice the chords with the table-based voicing (same chords, fewer music21 objects,
+        see M21_and_show.table_chord_codes_to_m21_chords_and_bass)
+    :param measures: (first, last) measure numbers of a window (see pattern_m21_converter.measure_window):
+        the whole tune is generated and voice-led, but music21 chords are only built for the window beats
+        (the chords and bass notes of the other beats are None, unless table_voicing)
+    :param memory_profiler: optional render_memory.RenderMemoryProfiler which records memory per pipeline stage
+    :return: rhythm_generator: CellularAutomatonRhythmGenerator, with the state after the steps
+    :return: m21_melody: list of music21 notes and rests
+    :return: m21_chord_progression: list of music21 chords (without root note), one per beat
+    :return: m21_bass_line: list of music21 notes, one per beat
+    :return: key: music21 key of the tune
+    :return: tempo: music21 metronome mark of the tune (or None)
+    """
+
+    # draws of the render only: concurrent renders (e.g. gradio sessions) do not share a random state
+    random_state = np.random.RandomState(seed) if seed is not None else None
+
+    with stage_context(memory_profiler, "parse"):
+        chord_progression, m21_melody, _, key, tempo = chords_and_m21melody(file_path, analyze_key=analyze_key)
+        pattern_length = sum([duration for (_, duration) in chord_progression])
+        melody_grid = tune_melody_grid(file_path, m21_melody, pattern_length)
+        if choruses > 1:
+            m21_melody = repeat_melody(m21_melody, pattern_length, choruses)
+            melody_grid = tile_melody_grid(melody_grid, choruses)
+
+    with stage_context(memory_profiler, "cellular_automaton"):
+        rhythm_generator = CellularAutomatonRhythmGenerator(
+            melody=m21_melody,
+            chord_sequence=chord_progression * choruses,
+            synco_prob=synco_prob,
+            kick_crash_prob=kick_crash_prob,
+            print_states=False,
+            use_rule_tables=use_rule_tables,
+            melody_grid=melody_grid,
+            melody_synco_prob=melody_synco_prob,
+            random_state=random_state,
+        )
+
+        for step in range(1):
+        # for step in range(16):
+            rhythm_generator.step(step)
+
+        # the steps are still executed, so that the voicing gets the same random draws for the same seed
+        if state is not None:
+            state = np.asarray(state, dtype=int)
+            if state.shape != rhythm_generator.state.shape:
+                raise ValueError(f"State of shape {state.shape} for a pattern of shape {rhythm_generator.state.shape}")
+            rhythm_generator.state = state
+
+    with stage_context(memory_profiler, "voicing"):
+        m21_and_show = M21_and_show(random_state=random_state)
+
+        beat_duration = 1
+        beat_durations = [beat_duration] * pattern_length
+
+        # the chords of a chorus are voiced once; the next choruses reuse the voicings
+        chord_codes = (rhythm_generator.beat_chord_roots[:pattern_length],
+                       rhythm_generator.beat_chord_types[:pattern_length], beat_durations)
+        if table_voicing:
+            m21_chord_progression, m21_bass_line = m21_and_show.table_chord_codes_to_m21_chords_and_bass(
+                *chord_codes, voice_leading=voice_leading, temperature=voice_leading_temperature)
+        elif measures is not None:
+            start_beat, end_beat = measure_window(measures, pattern_length * choruses)
+            window_chords = {beat % pattern_length for beat in range(start_beat, end_beat)}
+            m21_chord_progression, m21_bass_line = m21_and_show.window_chord_codes_to_m21_chords_and_bass(
+                *chord_codes, window_chords, voice_leading=voice_leading, temperature=voice_leading_temperature)
+        else:
+            m21_chord_progression, m21_bass_line = m21_and_show.chord_codes_to_m21_chords_and_bass(
+                *chord_codes, voice_leading=voice_leading, temperature=voice_leading_temperature)
+        m21_chord_progression = m21_chord_progression * choruses
+        m21_bass_line = m21_bass_line * choruses
+
+    return rhythm_generator, m21_melody, m21_chord_progression, m21_bass_line, key, tempo
+
+
+class EditableArrangement:
+    """
+    Arrangement of a lead-sheet whose chords can be edited, e.g. a 7 replaced by a 7(b9), recomputing only
+    what the edit affects (see edit): the Cellular Automaton positions around the edited beats
+    (CellularAutomatonRhythmGenerator.edit_chords), the voicings until the voice-leading chain reconverges
+    (M21_and_show.greedy_revoice) and the measures of the score with a changed beat
+    (PatternMusic21Converter.update_measures). The result is the arrangement of the edited lead-sheet
+    for the same seed.
+
+    The chords are voiced with fixed random draws per chord (see M21_and_show.greedy_voice_leading), so the
+    voicings of a seed are not the ones of generate_arrangement.
+    """
+
+    def __init__(self, file_path, selected_instrument=None, synco_prob=0.5, kick_crash_prob=0.2,
+                 octave_up_down=0, voice_leading="greedy", voice_leading_temperature=0.0, use_rule_tables=False,
+                 melody_synco_prob=None, choruses=1, seed=None, chord_edits=None):
+        """
+        Reads a lead-sheet, executes the Cellular Automaton, voices the chords and builds the score.
+
+        :param chord_edits: dict position of a chord in the lead-sheet -> chord name, applied before generating
+        (see generate_arrangement for the other parameters)
+        """
+        if selected_instrument is None or isinstance(selected_instrument, list):
+            selected_instrument = list(melody_instruments_d.keys())[0]
+
+        # parameters of the arrangement in the interface (see edit_chords)
+        self.settings = None
+
+        random_state = np.random.RandomState(seed) if seed is not None else np.random
+
+        chord_progression, m21_melody, _, key, tempo = chords_and_m21melody(file_path)
+        for chord_pos, chord_name in (chord_edits or {}).items():
+            chord_progression[chord_pos] = (chord_name, chord_progression[chord_pos][1])
+        self.chord_progression = chord_progression
+        self.pattern_length = sum([duration for (_, duration) in chord_progression])
+        self.choruses = choruses
+
+        melody_grid = tune_melody_grid(file_path, m21_melody, self.pattern_length)
+        if choruses > 1:
+            m21_melody = repeat_melody(m21_melody, self.pattern_length, choruses)
+            melody_grid = tile_melody_grid(melody_grid, choruses)
+
+        self.rhythm_generator = CellularAutomatonRhythmGenerator(
+            melody=m21_melody,
+            chord_sequence=chord_progression * choruses,
+            synco_prob=synco_prob,
+            kick_crash_prob=kick_crash_prob,
+            use_rule_tables=use_rule_tables,
+            melody_grid=melody_grid,
+            melody_synco_prob=melody_synco_prob,
+            random_state=random_state,
+        )
+        self.rhythm_generator.step(0)
+
+        # the chords of a chorus are voiced once, with two draws per beat
+        self.m21_and_show = M21_and_show(random_state=random_state)
+        self.voice_leading = voice_leading
+        self.voice_leading_temperature = voice_leading_temperature
+        self.voicing_draws = random_state.random_sample((self.pattern_length, 2))
+        self.voicings = self._voice_leading()
+
+        self.m21_chord_progression = [None] * self.pattern_length
+        self.m21_bass_line = [None] * self.pattern_length
+        self._build_chords(range(self.pattern_length))
+
+        self.music_converter = PatternMusic21Converter(is_m21melody=True, key=key, tempo=tempo)
+        self.score = self.music_converter.to_music21_score(
+            self.rhythm_generator.state,
+            m21_melody,
+            self.m21_chord_progression * choruses,
+            self.m21_bass_line * choruses,
+            score_title=file_path.split("/")[-1].strip(".xml"),
+            melody_instrument=melody_instruments_d[selected_instrument](),
+            octave_up_down=octave_up_down,
+        )
+
+    @property
+    def chord_codes(self):
+        """
+        Root and type codes of the beats of a chorus
+        """
+        return self.rhythm_generator.beat_chord_roots[:self.pattern_length], \
+            self.rhythm_generator.beat_chord_types[:self.pattern_length]
+
+    def _voice_leading(self):
+
+        if self.voice_leading == "viterbi":
+            return self.m21_and_show.viterbi_voice_leading(*self.chord_codes, self.voice_leading_temperature,
+                                                           random_draws=self.voicing_draws[:, 1])
+        return self.m21_and_show.greedy_voice_leading(*self.chord_codes, random_draws=self.voicing_draws)
+
+    def _build_chords(self, beats):
+        """
+        music21 chord and bass note of some beats of a chorus, from their voicings
+        """
+        root_codes, type_codes = self.chord_codes
+        for beat in beats:
+            m21_chords, m21_bass_notes = [], []
+            self.m21_and_show._voicing_to_m21_chord_and_bass(root_codes[beat], type_codes[beat], 1,
+                                                             self.voicings[beat], m21_chords, m21_bass_notes)
+            self.m21_chord_progression[beat] = m21_chords[0]
+            self.m21_bass_line[beat] = m21_bass_notes[0]
+
+    def edit(self, chord_edits):
+        """
+        Replaces chords of the lead-sheet in all the choruses, and updates the arrangement and its score.
+
+        :param chord_edits: dict position of a chord in the lead-sheet progression -> new chord name
+        :return: indices of the updated measures of the score
+        """
+        n_chords = len(self.chord_progression)
+        for chord_pos in chord_edits:
+            if not 0 <= chord_pos < n_chords:
+                raise IndexError(f"No chord {chord_pos + 1} in a lead-sheet of {n_chords} chords")
+        edited_beats, changed_positions = self.rhythm_generator.edit_chords(
+            {chord_pos + chorus * n_chords: chord_name
+             for chord_pos, chord_name in chord_edits.items() for chorus in range(self.choruses)})
+        for chord_pos, chord_name in chord_edits.items():
+            self.chord_progression[chord_pos] = (chord_name, self.chord_progression[chord_pos][1])
+
+        edited_chords = edited_beats[edited_beats < self.pattern_length]
+        if self.voice_leading == "viterbi":
+            # the Viterbi voicings depend on the whole progression
+            voicings = self._voice_leading() if len(edited_chords) else self.voicings
+            changed_chords = [beat for beat, (voicing, prev_voicing) in enumerate(zip(voicings, self.voicings))
+                              if voicing != prev_voicing]
+        else:
+            voicings, changed_chords = self.m21_and_show.greedy_revoice(
+                self.voicings, *self.chord_codes, edited_chords, self.voicing_draws)
+        self.voicings = voicings
+
+        rebuilt_beats = np.union1d(edited_chords, np.array(changed_chords, dtype=int))
+        self._build_chords(rebuilt_beats)
+
+        changed_beats = np.union1d(changed_positions, (rebuilt_beats[:, None] +
+                                                       self.pattern_length * np.arange(self.choruses)).reshape(-1))
+        measure_idxs = np.unique(changed_beats // MEASURE_DURATION).tolist()
+        self.music_converter.update_measures(self.score, self.rhythm_generator.state,
+                                             self.m21_chord_progression * self.choruses,
+                                             self.m21_bass_line * self.choruses, measure_idxs)
+
+        return measure_idxs
+
+
+def render_score(selected_file, selected_instrument=None,
+                 synco_prob=0.5, kick_crash_prob=0.2, octave_up_down=0,
+                 voice_leading="greedy", voice_leading_temperature=0.0,
+                 folder="./Omnibook", memory_profiler=None, use_rule_tables=False, melody_synco_prob=None,
+                 choruses=1, parallel_parts=None, seed=None, state=None, measures=None):
+    """
+    Adds rhythm to a lead-sheet and returns the music21 score, without showing it.
+
+    :param selected_file: lead-sheet file name in folder
+    :param selected_instrument: melody instrument name (key of melody_instruments_d)
+    :param memory_profiler: optional render_memory.RenderMemoryProfiler which records memory per pipeline stage
+    :param use_rule_tables: apply the Cellular Automaton rules as compiled lookup tables
+    :param melody_synco_prob: syncopation probability of the beats with a melody push (None: synco_prob)
+    :param choruses: number of times the form is played, each chorus with its own rhythm
+    :param parallel_parts: build the parts of the score concurrently, with "threads" or "processes"
+        (see PatternMusic21Converter.to_music21_score)
+    :param seed, state: see generate_arrangement
+    :param measures: (first, last) measure numbers of a window of the score to render, e.g. (9, 16),
+        or None for the whole score; last None (or 0) is the last measure. The rhythm is the one of the
+        whole tune (for the same seed), but only the window is converted
+    :return: score: music21.stream.Score
+    """
+
+    score, _, _ = render_arrangement_score(selected_file, selected_instrument,
+                                           synco_prob=synco_prob,
+                                           kick_crash_prob=kick_crash_prob,
+                                           octave_up_down=octave_up_down,
+                                           voice_leading=voice_leading,
+                                           voice_leading_temperature=voice_leading_temperature,
+                                           folder=folder,
+                                           memory_profiler=memory_profiler,
+                                           use_rule_tables=use_rule_tables,
+                                           melody_synco_prob=melody_synco_prob,
+                                           choruses=choruses,
+                                           parallel_parts=parallel_parts,
+                                           seed=seed,
+                                           state=state,
+                                           measures=measures)
+
+    return score
+
+
+def render_arrangement_score(selected_file, selected_instrument=None,
+                             synco_prob=0.5, kick_crash_prob=0.2, octave_up_down=0,
+                             voice_leading="greedy", voice_leading_temperature=0.0,
+                             folder="./Omnibook", memory_profiler=None, use_rule_tables=False,
+                             melody_synco_prob=None, choruses=1, parallel_parts=None, seed=None, state=None,
+                             analyze_key=True, table_voicing=False, measures=None, preview=False):
+    """
+    Same as render_score, also returning the state of the Cellular Automaton of the arrangement
+    and optionally its preview image
+
+    :param analyze_key, table_voicing: see generate_arrangement
+    :param preview: draw the preview image of the arrangement (of the window of measures), from the arrangement
+        of the score, so that they always match
+
+    :return: score: music21.stream.Score
+    :return: state: np.ndarray (n_instruments, pattern_length), of the whole tune
+    :return: image: preview image (see arrangement_preview.ArrangementPreview), or None if not preview
+    """
+
+    if selected_instrument is None or isinstance(selected_instrument, list):
+        selected_instrument = list(melody_instruments_d.keys())[0]
+
+    file_path = os.path.join(folder, selected_file)
+
+    score_title = selected_file.split("/")[-1].strip(".xml")
+
+    with tune_context(memory_profiler, score_title):
+
+        rhythm_generator, m21_melody, m21_chord_progression, m21_bass_line, key, tempo = generate_arrangement(
+            file_path,
+            synco_prob=synco_prob,
+            kick_crash_prob=kick_crash_prob,
+            voice_leading=voice_leading,
+            voice_leading_temperature=voice_leading_temperature,
+            memory_profiler=memory_profiler,
+            use_rule_tables=use_rule_tables,
+            melody_synco_prob=melody_synco_prob,
+            choruses=choruses,
+            seed=seed,
+            state=state,
+            analyze_key=analyze_key,
+            table_voicing=table_voicing,
+            measures=measures,
+        )
+
+        # drawn before the score is built, which transposes the melody for the instrument
+        image = None
+        if preview:
+            key_kwargs = dict(synco_prob=synco_prob, kick_crash_prob=kick_crash_prob, octave_up_down=octave_up_down,
+                              choruses=choruses, voice_leading=voice_leading,
+                              voice_leading_temperature=voice_leading_temperature, use_rule_tables=use_rule_tables,
+                              melody_synco_prob=melody_synco_prob, measures=measures)
+            image = preview_image(rhythm_generator.state, m21_melody, m21_chord_progression, m21_bass_line,
+                                  octave_up_down=octave_up_down,
+                                  window=preview_window(measures, rhythm_generator.state.shape[1]),
+                                  key=preview_key(file_path, seed, **key_kwargs))
+
+        music_converter = PatternMusic21Converter(is_m21melody=True, key=key, tempo=tempo)
+
+        melody_instrument = melody_instruments_d[selected_instrument]()
+
+        score = music_converter.to_music21_score(rhythm_generator.state,
+                                                 m21_melody,
+                                                 m21_chord_progression,
+                                                 m21_bass_line,
+                                                 score_title=score_title,
+                                                 melody_instrument=melody_instrument,
+                                                 octave_up_down=octave_up_down,
+                                                 memory_profiler=memory_profiler,
+                                                 parallel_parts=parallel_parts,
+                                                 measures=measures,
+                                                 )
+
+    return score, rhythm_generator.state, image
+
+
+def preview_key(file_path, seed, synco_prob=0.5, kick_crash_prob=0.2, octave_up_down=0, choruses=1,
+                voice_leading="greedy", voice_leading_temperature=0.0, use_rule_tables=False,
+                melody_synco_prob=None, measures=None, **_):
+    """
+    Key of the preview of a render in arrangement_preview.preview_cache: the tune, the parameters and the seed,
+    which determine the arrangement. The state is not part of it: the state of a seeded render is the one
+    generated with its seed, including when a version of the history is rendered again.
+
+    :return: tuple, or None for an unseeded render (its preview is not cached)
+    """
+    if seed is None:
+        return None
+
+    return (file_path, int(seed), float(synco_prob), float(kick_crash_prob), int(octave_up_down), int(choruses),
+            voice_leading, float(voice_leading_temperature), use_rule_tables, melody_synco_prob,
+            tuple(measures) if measures is not None else None)
+
+
+def preview_window(measures, pattern_length):
+    """
+    (start_beat, end_beat) of the preview of a window of measures, or None for the whole arrangement
+    """
+    return measure_window(measures, pattern_length) if measures is not None else None
+
+
 def add_rhythm(selected_file, selected_instrument=None,
-               synco_prob=0.5, kick_crash_prob=0.2, octave_up_down=0,
-               folder="./Omnibook"):
+               synco_prob=0.5, kick_crash_prob=0.2, octave_up_down=0, choruses=1,
+               voice_leading="greedy", voice_leading_temperature=0.0,
+               folder="./Omnibook", seed=None, state=None, latency_budget=None, measures=None):
+    """
+    :param measures: (first, last) measure numbers of the window of the score to render (see render_score)
+    :param latency_budget: seconds within which the render should be shown (None or 0: no budget). When the
+        estimated time of the render exceeds it, cheaper paths are taken (see latency_budget.DEGRADATIONS),
+        and the full-quality render is finished in the background (see fetch_full_render)
+    """
+
+    output, _, _ = _add_rhythm(selected_file, selected_instrument,
+                               synco_prob=synco_prob,
+                               kick_crash_prob=kick_crash_prob,
+                               octave_up_down=octave_up_down,
+                               choruses=choruses,
+                               voice_leading=voice_leading,
+                               voice_leading_temperature=voice_leading_temperature,
+                               folder=folder,
+                               seed=seed,
+                               state=state,
+                               latency_budget=latency_budget,
+                               measures=measures)
+
+    return output
+
+
+def _add_rhythm(selected_file, selected_instrument=None,
+                synco_prob=0.5, kick_crash_prob=0.2, octave_up_down=0, choruses=1,
+                voice_leading="greedy", voice_leading_temperature=0.0,
+                folder="./Omnibook", seed=None, state=None, latency_budget=None, measures=None):
+    """
+    Renders and shows the score (see add_rhythm)
+
+    :return: output: message
+    :return: state: state of the Cellular Automaton of the arrangement (None if no file is selected)
+    :return: image: preview image of the arrangement (None if no file is selected)
+    """
 
     if isinstance(selected_file, list):
-        return "No file has been selected!"
+        return "No file has been selected!", None, None
+
+    choruses = int(choruses)
 
     if selected_instrument is None or isinstance(selected_instrument, list):
         selected_instrument = list(melody_instruments_d.keys())[0]
 
     output = f"Adding rhythm to {selected_file} with {selected_instrument}"
+    if choruses > 1:
+        output += f" ({choruses} choruses)"
+    if measures is not None:
+        output += f", measures {measures[0]} to {measures[1] or 'the end'}"
+
+    if latency_budget:
+        render_kwargs = {
+            "selected_file": selected_file,
+            "selected_instrument": selected_instrument,
+            "synco_prob": synco_prob,
+            "kick_crash_prob": kick_crash_prob,
+            "octave_up_down": octave_up_down,
+            "choruses": choruses,
+            "voice_leading": voice_leading,
+            "voice_leading_temperature": voice_leading_temperature,
+            "seed": seed,
+            "state": state,
+            "measures": measures,
+        }
+        budget_output, state, image = _render_within_budget(render_kwargs, latency_budget, folder=folder)
+        return output + budget_output, state, image
+
+    score, state, image = render_arrangement_score(selected_file, selected_instrument,
+                                                   synco_prob=synco_prob,
+                                                   kick_crash_prob=kick_crash_prob,
+                                                   octave_up_down=octave_up_down,
+                                                   voice_leading=voice_leading,
+                                                   voice_leading_temperature=voice_leading_temperature,
+                                                   folder=folder,
+                                                   choruses=choruses,
+                                                   seed=seed,
+                                                   state=state,
+                                                   measures=measures,
+                                                   preview=True)
 
-    file_path = os.path.join(folder, selected_file)
+    score.show()
 
-    m21_and_show = M21_and_show()
+    return output, state, image
 
-    score_title = selected_file.split("/")[-1].strip(".xml")
 
-    chord_progression, m21_melody, _, key, tempo = chords_and_m21melody(file_path)
+def _render_within_budget(render_kwargs, latency_budget, folder="./Omnibook"):
+    """
+    Renders and shows the score, or only its preview, with the degradations which keep the render
+    within the latency budget; if any is applied, the full-quality render (same seed and state)
+    is submitted to the background renders.
+
+    :param render_kwargs: render_arrangement_score parameters
+    :return: output: time of the render and applied degradations
+    :return: state
+    :return: image: preview image of the arrangement
+    """
+    start_time = time.perf_counter()
+
+    file_path = os.path.join(folder, render_kwargs["selected_file"])
+    choruses = render_kwargs["choruses"]
+    measures = render_kwargs["measures"]
+    full_estimated = latency_planner.estimate(file_path, choruses, measures=measures)
+    degradations, _ = latency_planner.plan(latency_budget, file_path, choruses, measures=measures)
+
+    # the background render draws the same random numbers
+    if render_kwargs["seed"] is None:
+        render_kwargs = {**render_kwargs, "seed": int(np.random.randint(2 ** 31))}
+
+    if "preview_only" in degradations:
+        rhythm_generator, m21_melody, m21_chord_progression, m21_bass_line, _, _ = generate_arrangement(
+            file_path,
+            synco_prob=render_kwargs["synco_prob"],
+            kick_crash_prob=render_kwargs["kick_crash_prob"],
+            voice_leading=render_kwargs["voice_leading"],
+            voice_leading_temperature=render_kwargs["voice_leading_temperature"],
+            choruses=choruses,
+            seed=render_kwargs["seed"],
+            state=render_kwargs["state"],
+            analyze_key=False,
+            table_voicing=True,
+            measures=measures,
+        )
+        state = rhythm_generator.state
+        image = preview_image(state, m21_melody, m21_chord_progression, m21_bass_line,
+                              octave_up_down=render_kwargs["octave_up_down"],
+                              window=preview_window(measures, state.shape[1]),
+                              key=preview_key(file_path, **render_kwargs))
+    else:
+        score, state, image = render_arrangement_score(folder=folder,
+                                                       analyze_key="cached_key" not in degradations,
+                                                       table_voicing="table_voicing" in degradations,
+                                                       preview=True,
+                                                       **render_kwargs)
+        score.show()
+
+    seconds = time.perf_counter() - start_time
+    latency_planner.record(file_path, state.shape[1] // choruses, seconds, choruses=choruses,
+                           degradations=degradations, measures=measures)
+
+    output = f" in {seconds:.1f} s (budget {latency_budget:g} s)"
+    if degradations:
+        render_id = background_renders.submit({**render_kwargs, "state": state}, folder=folder)
+        output += f", estimated {full_estimated:.1f} s at full quality, so with: " + \
+            ", ".join(DEGRADATION_DESCRIPTIONS[degradation] for degradation in degradations) + \
+            f"; full render {render_id} in the background"
+
+    return output, state, image
+
+
+def add_rhythm_version(history, selected_file, selected_instrument=None,
+                       synco_prob=0.5, kick_crash_prob=0.2, octave_up_down=0, choruses=1, latency_budget=None,
+                       first_measure=0, last_measure=0, folder="./Omnibook"):
+    """
+    Same as add_rhythm, recording the generated state as a new version of the session history
+
+    :param history: generation_history.GenerationHistory of the session
+    :param first_measure, last_measure: window of the score to render (first_measure 0: the whole score;
+        last_measure 0: to the end)
+    :return: output: message
+    :return: history
+    :return: history_label: current version and versions of the history
+    :return: image: preview image of the arrangement
+    """
+    seed = int(np.random.randint(2 ** 31))
+    render_kwargs = {
+        "selected_file": selected_file,
+        "selected_instrument": selected_instrument,
+        "synco_prob": synco_prob,
+        "kick_crash_prob": kick_crash_prob,
+        "octave_up_down": octave_up_down,
+        "choruses": choruses,
+        "seed": seed,
+        "measures": (int(first_measure), int(last_measure or 0)) if first_measure else None,
+    }
+
+    output, state, image = _add_rhythm(folder=folder, latency_budget=latency_budget, **render_kwargs)
+    if state is not None:
+        version = history.push(state, **render_kwargs)
+        output += f" (version {version})"
+
+    return output, history, history.label(), image
+
+
+def render_version(history, version=None, folder="./Omnibook"):
+    """
+    Renders and shows a version of the session history again (with its state and seed), and makes it current
 
-    rhythm_generator = CellularAutomatonRhythmGenerator(
-        melody=m21_melody,
-        chord_sequence=chord_progression,
-        synco_prob=synco_prob,
-        kick_crash_prob=kick_crash_prob,
-        print_states=False
-    )
+    :param version: version number (default: current version)
+    :return: output, history, history_label, image: see add_rhythm_version
+    """
+    if len(history) == 0:
+        return "No rhythm has been added yet!", history, history.label(), None
 
-    for step in range(1):
-    # for step in range(16):
-        rhythm_generator.step(step)
+    version = int(version) if version else history.current
+    try:
+        state = history.state(version)
+    except KeyError as key_error:
+        return str(key_error.args[0]), history, history.label(), None
+    history.select(version)
 
-    beat_duration = 1
-    beat_chord_sequence = rhythm_generator.beat_chord_sequence
-    # print(beat_chord_sequence)
-    beat_chord_progression = [(chord_name, beat_duration) for chord_name in beat_chord_sequence]
+    output, _, image = _add_rhythm(folder=folder, state=state, **history.metadata(version))
 
-    m21_chord_progression, m21_bass_line = m21_and_show.chord_seq_to_m21_chords_and_bass(
-        beat_chord_progression)
+    return f"{output} (version {version})", history, history.label(), image
 
-    music_converter = PatternMusic21Converter(is_m21melody=True, key=key, tempo=tempo)
 
-    melody_instrument = melody_instruments_d[selected_instrument]()
+def undo_rhythm(history, folder="./Omnibook"):
 
-    score = music_converter.to_music21_score(rhythm_generator.state,
-                                             m21_melody,
-                                             m21_chord_progression,
-                                             m21_bass_line,
-                                             score_title=score_title,
-                                             melody_instrument=melody_instrument,
-                                             octave_up_down=octave_up_down,
-                                             )
+    version = history.undo()
+    if version is None:
+        return "Nothing to undo", history, history.label(), None
 
-    score.show()
+    return render_version(history, version, folder=folder)
+
+
+def redo_rhythm(history, folder="./Omnibook"):
+
+    version = history.redo()
+    if version is None:
+        return "Nothing to redo", history, history.label(), None
+
+    return render_version(history, version, folder=folder)
+
+
+def fetch_full_render(render_id=None):
+    """
+    Shows the full-quality render of a render degraded by its latency budget, if it is done
+
+    :param render_id: background render id (default: the last one)
+    """
+    output, output_path = background_renders.fetch(int(render_id) if render_id else None)
+    if output_path is not None:
+        m21.converter.subConverters.ConverterMusicXML().launch(output_path)
 
     return output
 
 
-with gr.Blocks() as demo:
+def parse_chord_edits(chord_edits_text):
+    """
+    :param chord_edits_text: chord numbers in the lead-sheet (from 1) and new chord names,
+        e.g. "3=F:7(b9), 8=C:-7"
+    :return: dict position of a chord in the lead-sheet (from 0) -> chord name
+    """
+    chord_edits = {}
+    for chord_edit in chord_edits_text.replace(";", ",").split(","):
+        if chord_edit.strip():
+            chord_number, chord_name = chord_edit.split("=")
+            chord_edits[int(chord_number) - 1] = chord_name.strip()
+    return chord_edits
+
+
+def edit_chords(arrangement, selected_file, selected_instrument=None, synco_prob=0.5, kick_crash_prob=0.2,
+                octave_up_down=0, choruses=1, chord_edits_text="", folder="./Omnibook"):
+    """
+    Edits chords of the lead-sheet of the arrangement being edited, updating only the affected measures,
+    and shows the score. A new arrangement is generated when the tune or the parameters change.
+
+    :param arrangement: EditableArrangement of the session, or None
+    :param chord_edits_text: see parse_chord_edits
+    :return: output: message
+    :return: arrangement
+    """
+    if isinstance(selected_file, list):
+        return "No file has been selected!", arrangement
+
+    try:
+        chord_edits = parse_chord_edits(chord_edits_text)
+    except ValueError:
+        return f"Invalid chord edits {chord_edits_text} (e.g. 3=F:7(b9), 8=C:-7)", arrangement
+
+    choruses = int(choruses)
+    settings = (selected_file, selected_instrument, synco_prob, kick_crash_prob, octave_up_down, choruses)
+    start_time = time.perf_counter()
+
+    output = ""
+    if arrangement is None or arrangement.settings != settings:
+        arrangement = EditableArrangement(os.path.join(folder, selected_file), selected_instrument,
+                                          synco_prob=synco_prob, kick_crash_prob=kick_crash_prob,
+                                          octave_up_down=octave_up_down, choruses=choruses,
+                                          seed=int(np.random.randint(2 ** 31)))
+        arrangement.settings = settings
+        output = f"Arrangement of {selected_file} generated in {time.perf_counter() - start_time:.1f} s. "
+        start_time = time.perf_counter()
+
+    if chord_edits:
+        try:
+            measure_idxs = arrangement.edit(chord_edits)
+        except (ValueError, IndexError) as edit_error:
+            return output + f"Invalid chord edits {chord_edits_text}: {edit_error}", arrangement
+        output += f"Chords edited in {time.perf_counter() - start_time:.2f} s, measures updated: " + \
+            (", ".join(str(measure_idx + 1) for measure_idx in measure_idxs) or "none") + ". "
+
+    arrangement.score.show()
+
+    output += "Chords: " + " ".join(f"{chord_pos + 1}={chord_name}"
+                                    for chord_pos, (chord_name, _) in enumerate(arrangement.chord_progression))
+
+    return output, arrangement
+
+
+def preview_rhythm(history, folder="./Omnibook"):
+    """
+    Shows the piano-roll and drum-grid image (concert pitch) of the current version of the session history,
+    the one of its render when it is still cached, else drawn again from the state and seed of the version,
+    without building the music21 score nor launching MuseScore.
+
+    :param history: generation_history.GenerationHistory of the session
+    :return: output: message
+    :return: image: np.ndarray (height, width, 3), or None
+    """
+    if len(history) == 0:
+        return "No rhythm has been added yet!", None
+
+    version = history.current
+    render_kwargs = history.metadata(version)
+    file_path = os.path.join(folder, render_kwargs["selected_file"])
+    output = f"Preview of {render_kwargs['selected_file']} (version {version})"
+
+    key = preview_key(file_path, **render_kwargs)
+    image = preview_cache.cached(key)
+    if image is not None:
+        return output, image
+
+    rhythm_generator, m21_melody, m21_chord_progression, m21_bass_line, _, _ = generate_arrangement(
+        file_path,
+        synco_prob=render_kwargs["synco_prob"],
+        kick_crash_prob=render_kwargs["kick_crash_prob"],
+        choruses=int(render_kwargs["choruses"]),
+        seed=render_kwargs["seed"],
+        state=history.state(version),
+        analyze_key=False,
+        table_voicing=True,
+    )
+
+    image = preview_image(rhythm_generator.state, m21_melody, m21_chord_progression, m21_bass_line,
+                          octave_up_down=render_kwargs["octave_up_down"],
+                          window=preview_window(render_kwargs["measures"], rhythm_generator.state.shape[1]),
+                          key=key)
+
+    return output, image
+
+
+if __name__ == "__main__":
+
+    import gradio as gr
+
+    with gr.Blocks() as demo:
+
+        with gr.Row():
+
+            with gr.Column(scale=1):
+
+                xml_files = list_files()
+                selected_file = gr.Dropdown(value=xml_files[0], choices=xml_files,
+                                            label="Select an Omnibook tune")
+
+                show_leadsheet_btn = gr.Button("Show leadsheet")
+
+                show_output = gr.Textbox(label="Result")
+
+            show_leadsheet_btn.click(show_leadsheet, inputs=selected_file, outputs=[show_output])
+
+            with gr.Column(scale=1):
+                melody_instruments_list = list_melody_instruments()
+                selected_instrument = gr.Dropdown(value=melody_instruments_list[0], choices=melody_instruments_list,
+                                                  label="Select an instrument for the melody")
+
+                add_rhythm_btn = gr.Button("Add Rhythm!!")
+
+                with gr.Row():
+                    undo_btn = gr.Button("Undo")
+                    redo_btn = gr.Button("Redo")
 
-    with gr.Row():
+                with gr.Row():
+                    version_number = gr.Number(label="Version", precision=0)
+                    render_version_btn = gr.Button("Re-render version")
 
-        with gr.Column(scale=1):
+                history_label = gr.Textbox(label="History")
 
-            xml_files = list_files()
-            selected_file = gr.Dropdown(value=xml_files[0], choices=xml_files,
-                                        label="Select an Omnibook tune")
+                preview_btn = gr.Button("Preview")
 
-            show_leadsheet_btn = gr.Button("Show leadsheet")
+                with gr.Row():
+                    render_id = gr.Number(label="Full render", precision=0)
+                    fetch_btn = gr.Button("Fetch full render")
 
-            show_output = gr.Textbox(label="Result")
+                with gr.Row():
+                    chord_edits_text = gr.Textbox(label="Chord edits (e.g. 3=F:7(b9), 8=C:-7)")
+                    edit_chords_btn = gr.Button("Edit chords")
 
-        show_leadsheet_btn.click(show_leadsheet, inputs=selected_file, outputs=[show_output])
+                add_rhythm_output = gr.Textbox(label="Result")
 
-        with gr.Column(scale=1):
-            melody_instruments_list = list_melody_instruments()
-            selected_instrument = gr.Dropdown(value=melody_instruments_list[0], choices=melody_instruments_list,
-                                              label="Select an instrument for the melody")
+            with gr.Column(scale=1):
 
-            add_rhythm_btn = gr.Button("Add Rhythm!!")
+                octave_up_down = gr.Slider(minimum=-1, maximum=1, value=0, step=1,
+                                           label="Transpose octave up (1) or down (-1)")
+                synco_prob = gr.Slider(minimum=0, maximum=1, value=0.5,
+                                       label="Syncopation probability")
+                kick_crash_prob = gr.Slider(minimum=0, maximum=1, value=0.2,
+                                            label="Kick/crash prob (linked to synco)")
+                choruses = gr.Slider(minimum=1, maximum=8, value=1, step=1,
+                                     label="Choruses (each with its own rhythm)")
+                latency_budget = gr.Slider(minimum=0, maximum=10, value=0, step=0.5,
+                                           label="Latency budget in seconds (0: full quality)")
+                with gr.Row():
+                    first_measure = gr.Number(value=0, precision=0, label="From measure (0: whole score)")
+                    last_measure = gr.Number(value=0, precision=0, label="To measure (0: the end)")
 
-            add_rhythm_output = gr.Textbox(label="Result")
+            # versions of the rhythm of the session, for undo / redo
+            history = gr.State(GenerationHistory())
+            # arrangement whose chords are being edited
+            arrangement = gr.State(None)
 
-        with gr.Column(scale=1):
+        with gr.Row():
+            preview = gr.Image(label="Preview (piano-roll and drums)", type="numpy")
 
-            octave_up_down = gr.Slider(minimum=-1, maximum=1, value=0, step=1,
-                                       label="Transpose octave up (1) or down (-1)")
-            synco_prob = gr.Slider(minimum=0, maximum=1, value=0.5,
-                                   label="Syncopation probability")
-            kick_crash_prob = gr.Slider(minimum=0, maximum=1, value=0.2,
-                                        label="Kick/crash prob (linked to synco)")
+        undo_btn.click(undo_rhythm, inputs=[history], outputs=[add_rhythm_output, history, history_label, preview])
+        redo_btn.click(redo_rhythm, inputs=[history], outputs=[add_rhythm_output, history, history_label, preview])
+        render_version_btn.click(render_version, inputs=[history, version_number],
+                                 outputs=[add_rhythm_output, history, history_label, preview])
 
-        add_rhythm_btn.click(add_rhythm,
-                             inputs=[selected_file, selected_instrument,
-                                     synco_prob, kick_crash_prob, octave_up_down],
-                             outputs=[add_rhythm_output])
+        add_rhythm_btn.click(add_rhythm_version,
+                             inputs=[history, selected_file, selected_instrument,
+                                     synco_prob, kick_crash_prob, octave_up_down, choruses, latency_budget,
+                                     first_measure, last_measure],
+                             outputs=[add_rhythm_output, history, history_label, preview])
+        fetch_btn.click(fetch_full_render, inputs=[render_id], outputs=[add_rhythm_output])
+        edit_chords_btn.click(edit_chords,
+                              inputs=[arrangement, selected_file, selected_instrument,
+                                      synco_prob, kick_crash_prob, octave_up_down, choruses, chord_edits_text],
+                              outputs=[add_rhythm_output, arrangement])
+        preview_btn.click(preview_rhythm, inputs=[history], outputs=[add_rhythm_output, preview])
 
-demo.launch()
\ No newline at end of file
+    demo.launch()
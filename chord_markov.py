@@ -0,0 +1,309 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import music21 as m21
+
+from cellularautomaton_gradio import CellularAutomatonRhythmGenerator
+from m21_musescore import M21_and_show, mod_chord_duration
+from omnibook_read import chords_and_m21melody
+from pattern_m21_converter import PatternMusic21Converter, MEASURE_DURATION
+from rule_tables import compile_jazz_rules, rule_context
+
+CHORD_VOCABULARY = M21_and_show.chord_vocabulary
+
+
+class ChordMarkovChain:
+    """
+    First-order Markov chain of the chords of the corpus, for generating new chord progressions.
+
+    The states are chord codes: root_code * n_types + type_code (see chord_vocabulary). The transition counts
+    are stored as a sparse CSR matrix (indptr, indices, counts): the next chords of state s are
+    indices[indptr[s]:indptr[s + 1]]. For the sampling, cum_probs holds s + the cumulative probability
+    of each next chord of s, so that the row of the current chord is found by the same search as the next
+    chord: one np.searchsorted per step draws the next chords of a whole batch of progressions (inverse CDF).
+    A chord which never has a next chord (e.g. the last chord of a tune) is followed by a first chord.
+    """
+
+    def __init__(self, indptr, indices, counts, start_counts):
+        """
+        :param indptr, indices, counts: CSR transition counts (n_states + 1,), (n_transitions,), (n_transitions,)
+        :param start_counts: np.ndarray (n_states,), counts of the first chords of the tunes
+        """
+        self.n_types = len(CHORD_VOCABULARY.type_names)
+        self.n_states = len(CHORD_VOCABULARY.root_names) * self.n_types
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+        self.start_counts = start_counts
+
+        self.start_states = np.flatnonzero(start_counts)
+        self.start_cum_probs = np.cumsum(start_counts[self.start_states]) / start_counts.sum()
+        self.start_cum_probs[-1] = 1.0
+
+        # chords without next chords are followed by a first chord
+        row_counts = np.diff(indptr)
+        is_dead_end = row_counts == 0
+        row_counts[is_dead_end] = len(self.start_states)
+        sampling_indptr = np.concatenate([[0], np.cumsum(row_counts)])
+        rows = np.repeat(np.arange(self.n_states), row_counts)
+
+        sampling_indices = np.empty(sampling_indptr[-1], dtype=indices.dtype)
+        sampling_counts = np.empty(sampling_indptr[-1], dtype=np.float64)
+        transition_pos = np.flatnonzero(~is_dead_end[rows])
+        sampling_indices[transition_pos] = indices
+        sampling_counts[transition_pos] = counts
+        dead_end_pos = np.flatnonzero(is_dead_end[rows])
+        sampling_indices[dead_end_pos] = np.tile(self.start_states, is_dead_end.sum())
+        sampling_counts[dead_end_pos] = np.tile(start_counts[self.start_states], is_dead_end.sum())
+
+        # row + cumulative probability within the row; the last one of each row is exactly row + 1
+        cum_counts = np.cumsum(sampling_counts)
+        row_start_counts = np.concatenate([[0.0], cum_counts])[sampling_indptr[rows]]
+        row_totals = np.bincount(rows, weights=sampling_counts, minlength=self.n_states)
+        self.cum_probs = rows + (cum_counts - row_start_counts) / row_totals[rows]
+        self.cum_probs[sampling_indptr[1:] - 1] = np.arange(1, self.n_states + 1)
+        self.next_states = sampling_indices
+
+    @classmethod
+    def from_chord_progressions(cls, chord_progressions):
+        """
+        Transition counts of chord progressions, counted in one vectorized pass over all their chords
+
+        :param chord_progressions: list of chord progressions, each a list of (chord_name, duration)
+        """
+        n_types = len(CHORD_VOCABULARY.type_names)
+        n_states = len(CHORD_VOCABULARY.root_names) * n_types
+
+        chord_names = [chord_name for chord_progression in chord_progressions
+                       for (chord_name, _) in chord_progression]
+        root_codes, type_codes = CHORD_VOCABULARY.encode_sequence(chord_names)
+        states = root_codes.astype(np.int64) * n_types + type_codes
+
+        # transitions within a tune (not from the last chord of a tune to the first one of the next)
+        tune_lengths = np.array([len(chord_progression) for chord_progression in chord_progressions])
+        tune_starts = np.concatenate([[0], np.cumsum(tune_lengths)[:-1]])[tune_lengths > 0]
+        is_transition = np.ones(max(len(states) - 1, 0), dtype=bool)
+        is_transition[tune_starts[1:] - 1] = False
+
+        transitions = states[:-1][is_transition] * n_states + states[1:][is_transition]
+        transition_codes, counts = np.unique(transitions, return_counts=True)
+        rows, indices = np.divmod(transition_codes, n_states)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_states))])
+
+        start_counts = np.bincount(states[tune_starts], minlength=n_states)
+
+        return cls(indptr, indices.astype(np.int32), counts, start_counts)
+
+    @classmethod
+    def from_folder(cls, folder="./Omnibook", files=None):
+        """
+        Chain of the chords of the lead-sheets of a folder (default: all of them), each one parsed once
+        """
+        files = files or sorted(xml_file for xml_file in os.listdir(folder) if xml_file.endswith(".xml"))
+
+        chord_progressions = []
+        for selected_file in files:
+            chord_progression, _, _, _, _ = chords_and_m21melody(os.path.join(folder, selected_file),
+                                                                 quantize=False, analyze_key=False)
+            chord_progressions.append(chord_progression)
+
+        return cls.from_chord_progressions(chord_progressions)
+
+    def save(self, fp):
+
+        np.savez(fp, indptr=self.indptr, indices=self.indices, counts=self.counts, start_counts=self.start_counts)
+        return fp
+
+    @classmethod
+    def load(cls, fp):
+
+        with np.load(fp) as chain_arrays:
+            return cls(chain_arrays["indptr"], chain_arrays["indices"], chain_arrays["counts"],
+                       chain_arrays["start_counts"])
+
+    @property
+    def n_transitions(self):
+        return len(self.indices)
+
+    def sample(self, n_progressions, n_chords, rng=None):
+        """
+        Draws progressions from the chain, all of them at once: one vectorized inverse-CDF draw per chord position
+
+        :param rng: optional np.random.Generator of the random draws, for reproducible batches
+        :return: np.ndarray int32 (n_progressions, n_chords) of chord codes (see decode)
+        """
+        random_draws = rng.random((n_progressions, n_chords)) if rng is not None else \
+            np.random.random((n_progressions, n_chords))
+
+        states = np.empty((n_progressions, n_chords), dtype=np.int32)
+        states[:, 0] = self.start_states[np.searchsorted(self.start_cum_probs, random_draws[:, 0], side="right")]
+        for chord_pos in range(1, n_chords):
+            # the first cum_probs above state + draw is in the row of the state
+            transition_idxs = np.searchsorted(self.cum_probs, states[:, chord_pos - 1] + random_draws[:, chord_pos],
+                                              side="right")
+            states[:, chord_pos] = self.next_states[transition_idxs]
+
+        return states
+
+    def decode(self, states):
+        """
+        :return: root_codes, type_codes of the chord codes (see chord_vocabulary)
+        """
+        return np.divmod(states, self.n_types)
+
+    def chord_names(self, states):
+        """
+        :param states: chord codes of a progression
+        :return: list of chord names, e.g. "B-:7"
+        """
+        return CHORD_VOCABULARY.decode_sequence(*self.decode(states))
+
+
+def chord_sequences(chain, states, n_beats=None):
+    """
+    Chord sequences of sampled progressions, with the durations given by m21_musescore.mod_chord_duration
+
+    :param states: np.ndarray (n_progressions, n_chords) of chord codes (see ChordMarkovChain.sample)
+    :param n_beats: if given, the sequences are cut to n_beats (the last chord is shortened),
+        so that they have the same length and their states can be generated in one batch (see progression_states)
+    :return: list of chord sequences, each a list of (chord_name, chord_duration)
+    """
+    sequences = []
+    for progression_states in states:
+        chord_sequence = mod_chord_duration(chain.chord_names(progression_states))
+
+        if n_beats is not None:
+            cut_sequence = []
+            beats = 0
+            for chord_name, chord_duration in chord_sequence:
+                if beats >= n_beats:
+                    break
+                cut_sequence.append((chord_name, min(chord_duration, n_beats - beats)))
+                beats += chord_duration
+            if beats < n_beats:
+                raise ValueError(f"Progression of {beats} beats shorter than {n_beats} beats: sample more chords")
+            chord_sequence = cut_sequence
+
+        sequences.append(chord_sequence)
+
+    return sequences
+
+
+def rest_melody(pattern_length):
+    """
+    Melody of a generated progression: a rest per measure
+    """
+    return [m21.note.Rest(quarterLength=min(MEASURE_DURATION, pattern_length - measure_start))
+            for measure_start in range(0, pattern_length, MEASURE_DURATION)]
+
+
+def progression_generators(chord_sequences, **generator_kwargs):
+    """
+    Cellular Automaton of each generated chord sequence, after one step
+
+    :param generator_kwargs: CellularAutomatonRhythmGenerator parameters (synco_prob, use_rule_tables...)
+    :return: list of CellularAutomatonRhythmGenerator
+    """
+    rhythm_generators = []
+    for chord_sequence in chord_sequences:
+        pattern_length = sum([duration for (_, duration) in chord_sequence])
+        rhythm_generator = CellularAutomatonRhythmGenerator(melody=rest_melody(pattern_length),
+                                                            chord_sequence=chord_sequence, **generator_kwargs)
+        rhythm_generator.step(0)
+        rhythm_generators.append(rhythm_generator)
+
+    return rhythm_generators
+
+
+def progression_states(chord_sequences, compiled_rules, rng=None):
+    """
+    Cellular Automaton states of a batch of chord sequences of the same length in beats (see chord_sequences
+    with n_beats), with a single vectorized application of the compiled rules to the whole batch
+
+    :param compiled_rules: list of rule_tables.CompiledRule, e.g. compile_jazz_rules(synco_prob, ...)
+    :param rng: optional np.random.Generator of the random draws
+    :return: np.ndarray (n_sequences, n_instruments, n_beats)
+    """
+    beat_chord_roots, beat_chord_types = [], []
+    for chord_sequence in chord_sequences:
+        root_codes, type_codes = CHORD_VOCABULARY.encode_sequence([chord_name for (chord_name, _) in chord_sequence])
+        chord_durations = [chord_duration for (_, chord_duration) in chord_sequence]
+        beat_chord_roots.append(np.repeat(root_codes, chord_durations))
+        beat_chord_types.append(np.repeat(type_codes, chord_durations))
+
+    pattern_lengths = set(len(beat_roots) for beat_roots in beat_chord_roots)
+    if len(pattern_lengths) != 1:
+        raise ValueError(f"Chord sequences of different lengths {sorted(pattern_lengths)}: cut them to n_beats")
+    pattern_length = pattern_lengths.pop()
+
+    context = rule_context(np.array(beat_chord_roots), np.array(beat_chord_types))
+
+    # the initial state does not depend on the chords
+    initial_state = CellularAutomatonRhythmGenerator(melody=rest_melody(pattern_length),
+                                                     chord_sequence=chord_sequences[0]).state
+    states = np.broadcast_to(initial_state, (len(chord_sequences),) + initial_state.shape)
+    for compiled_rule in compiled_rules:
+        random_draws = rng.random((len(chord_sequences), pattern_length)) if rng is not None else None
+        states = compiled_rule.apply(states, context, random_draws)
+
+    return states
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Generates chord progressions with a Markov chain of the corpus, "
+                                                 "and their Cellular Automaton rhythm")
+    parser.add_argument("--folder", default="./Omnibook")
+    parser.add_argument("--files", nargs="*", help="tunes of the folder (default: all)")
+    parser.add_argument("--chain", help="saved chain (.npz), loaded instead of the corpus if it exists, else saved")
+    parser.add_argument("--progressions", type=int, default=1000)
+    parser.add_argument("--beats", type=int, default=128, help="length of the progressions")
+    parser.add_argument("--synco-prob", type=float, default=0.5)
+    parser.add_argument("--kick-crash-prob", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--show", action="store_true", help="show the score of the first progression")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.chain and os.path.exists(args.chain):
+        chain = ChordMarkovChain.load(args.chain)
+    else:
+        chain = ChordMarkovChain.from_folder(args.folder, args.files)
+        if args.chain:
+            chain.save(args.chain)
+    print(f"Chain of {chain.n_transitions} transitions in {time.time() - start_time:.2f} s")
+
+    rng = np.random.default_rng(args.seed)
+
+    # chords last 2 beats or more
+    start_time = time.time()
+    states = chain.sample(args.progressions, args.beats // 2 + 1, rng)
+    sequences = chord_sequences(chain, states, n_beats=args.beats)
+    print(f"{args.progressions} progressions of {args.beats} beats in {time.time() - start_time:.2f} s")
+
+    start_time = time.time()
+    compiled_rules = compile_jazz_rules(
+        synco_prob=args.synco_prob,
+        kick_crash_prob=args.kick_crash_prob,
+        even_beat_swing_prob=CellularAutomatonRhythmGenerator.EVEN_BEAT_SWING_PROBABILITY,
+        odd_beat_swing_prob=CellularAutomatonRhythmGenerator.ODD_BEAT_SWING_PROBABILITY,
+    )
+    ca_states = progression_states(sequences, compiled_rules, rng)
+    print(f"{len(ca_states)} Cellular Automaton states in {time.time() - start_time:.2f} s")
+
+    print(" ".join(f"{chord_name}({chord_duration})" for chord_name, chord_duration in sequences[0][:16]), "...")
+
+    if args.show:
+        chord_sequence = sequences[0]
+        rhythm_generator = progression_generators([chord_sequence], synco_prob=args.synco_prob,
+                                                  kick_crash_prob=args.kick_crash_prob)[0]
+        # one chord per beat, as in the arrangements of the lead-sheets
+        beat_chord_sequence = [(chord_name, 1) for chord_name in rhythm_generator.beat_chord_sequence]
+        m21_chord_progression, m21_bass_line = M21_and_show().chord_seq_to_m21_chords_and_bass(beat_chord_sequence)
+
+        score = PatternMusic21Converter(is_m21melody=True).to_music21_score(
+            rhythm_generator.state, rest_melody(rhythm_generator.pattern_length), m21_chord_progression,
+            m21_bass_line, score_title="Markov Chain Chord Progression")
+        score.show()
@@ -0,0 +1,73 @@
+import numpy as np
+import music21 as m21
+
+CHORD_JOIN = ":"
+
+# chord roots, with music21 spellings ("-" for flat)
+ROOT_NAMES = [letter + accidental for accidental in ["", "#", "-", "##", "--"] for letter in "CDEFGAB"]
+
+# chord-type classes
+DOMINANT_TYPES = ["7", "7(b9)"]
+DIMINISHED_TYPES = ["o7"]
+HALF_DIMINISHED_TYPES = ["ø7"]
+
+
+class ChordVocabulary:
+    """
+    Interns chord roots and types into small integers, so that chord sequences can be handled
+    as parallel int8 arrays (root codes and type codes) instead of "root:type" strings.
+
+    Properties of the roots and types are precomputed lookups indexed by their codes:
+        - trans_intervs[root_code]: transposition interval from C, in [-6, 6]
+        - is_dominant[type_code], is_diminished[type_code], is_half_diminished[type_code]: chord-type classes
+    """
+
+    def __init__(self, chord_types):
+        """
+        :param chord_types: chord types of the vocabulary, e.g. ["M7", "7", "-7"]
+        """
+        self.root_names = ROOT_NAMES
+        self.root_codes = {root_name: root_code for root_code, root_name in enumerate(self.root_names)}
+        # music21 generates flat as "-", but we want to display flat as "b" (also admitted by music21)
+        self.root_display_names = [root_name.replace("-", "b") for root_name in self.root_names]
+
+        self.type_names = list(dict.fromkeys(chord_types))
+        self.type_codes = {type_name: type_code for type_code, type_name in enumerate(self.type_names)}
+
+        pitch_classes = np.array([m21.pitch.Pitch(root_name).pitchClass for root_name in self.root_names])
+        self.trans_intervs = np.where(pitch_classes > 6, pitch_classes - 12, pitch_classes)
+
+        self.is_dominant = np.isin(self.type_names, DOMINANT_TYPES)
+        self.is_diminished = np.isin(self.type_names, DIMINISHED_TYPES)
+        self.is_half_diminished = np.isin(self.type_names, HALF_DIMINISHED_TYPES)
+
+    def encode(self, chord_name):
+        """
+        :param chord_name: "root:type", e.g. "B-:7(b9)"
+        :return: (root_code, type_code)
+        """
+        chord_root, chord_type = chord_name.split(CHORD_JOIN)
+        try:
+            return self.root_codes[chord_root], self.type_codes[chord_type]
+        except KeyError:
+            raise ValueError(f"Unknown chord {chord_name}")
+
+    def encode_sequence(self, chord_names):
+        """
+        :param chord_names: list of chord names
+        :return: root_codes: np.ndarray int8
+        :return: type_codes: np.ndarray int8
+        """
+        codes = [self.encode(chord_name) for chord_name in chord_names]
+        root_codes = np.array([root_code for root_code, _ in codes], dtype=np.int8)
+        type_codes = np.array([type_code for _, type_code in codes], dtype=np.int8)
+
+        return root_codes, type_codes
+
+    def decode(self, root_code, type_code):
+
+        return self.root_names[root_code] + CHORD_JOIN + self.type_names[type_code]
+
+    def decode_sequence(self, root_codes, type_codes):
+
+        return [self.decode(root_code, type_code) for root_code, type_code in zip(root_codes, type_codes)]
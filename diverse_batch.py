@@ -0,0 +1,137 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+from cellularautomaton_gradio import CellularAutomatonRhythmGenerator
+from pattern_m21_converter import States
+from rhythm_analytics import TuneSampler
+from rule_tables import compile_jazz_rules
+
+# number of set bits of each byte
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int32)
+
+
+def pack_states(states):
+    """
+    Bit-packs a batch of states as one-hot cells, so that the Hamming distance between two packed states
+    is twice the number of cells whose state differs.
+
+    :param states: np.ndarray (n_states, n_instruments, pattern_length)
+    :return: np.ndarray uint8 (n_states, n_bytes)
+    """
+    one_hot = states.reshape(len(states), -1)[:, :, None] == np.arange(len(States), dtype=states.dtype)
+    return np.packbits(one_hot.reshape(len(states), -1), axis=1)
+
+
+def hamming_distances(packed_a, packed_b):
+    """
+    Number of differing cells between each packed state of a and each packed state of b
+
+    :return: np.ndarray int (len(packed_a), len(packed_b))
+    """
+    differing_bits = POPCOUNT[np.bitwise_xor(packed_a[:, None, :], packed_b[None, :, :])].sum(axis=2)
+    return differing_bits // 2
+
+
+def diverse_states(tune_sampler, compiled_rules, n_variations, min_distance=0.02, max_candidates=None,
+                   batch_size=64, rng=None):
+    """
+    Generates n_variations states of a tune which differ from each other in at least a fraction min_distance
+    of their cells. Candidates are drawn in batches; exact duplicates are rejected with a hash set of the
+    packed states, and near-duplicates with the Hamming distances of each batch to the accepted
+    variations and within the batch, computed in bulk.
+
+    :param tune_sampler: rhythm_analytics.TuneSampler of the tune
+    :param compiled_rules: list of rule_tables.CompiledRule
+    :param min_distance: minimum fraction of differing cells between two variations
+    :param max_candidates: budget of drawn candidates (default: 50 per variation)
+    :param rng: optional np.random.Generator
+    :return: states: np.ndarray (n_accepted, n_instruments, pattern_length), n_accepted <= n_variations
+    :return: report: dict with the numbers of candidates, exact and near duplicates, accepted variations,
+        and the candidates drawn per accepted variation
+    """
+    max_candidates = max_candidates if max_candidates is not None else 50 * n_variations
+    min_cells = int(np.ceil(min_distance * tune_sampler.initial_state.size))
+
+    accepted_states = []
+    accepted_packed = np.zeros((0, pack_states(tune_sampler.initial_state[None]).shape[1]), dtype=np.uint8)
+    seen_hashes = set()
+    n_candidates = n_exact_duplicates = n_near_duplicates = 0
+
+    while len(accepted_states) < n_variations and n_candidates < max_candidates:
+        states = tune_sampler.sample(min(batch_size, max_candidates - n_candidates), compiled_rules, rng)
+        n_candidates += len(states)
+        packed = pack_states(states)
+
+        # exact duplicates (of earlier candidates, or within the batch)
+        is_new = np.zeros(len(states), dtype=bool)
+        for state_idx, packed_state in enumerate(packed):
+            state_hash = packed_state.tobytes()
+            if state_hash not in seen_hashes:
+                seen_hashes.add(state_hash)
+                is_new[state_idx] = True
+        n_exact_duplicates += int((~is_new).sum())
+        states, packed = states[is_new], packed[is_new]
+
+        # near duplicates of the accepted variations, then of the candidates accepted before in the batch
+        is_far = hamming_distances(packed, accepted_packed).min(axis=1, initial=min_cells) >= min_cells
+        batch_distances = hamming_distances(packed, packed)
+        batch_accepted = []
+        n_near_duplicates += len(states) - int(is_far.sum())
+        for state_idx in np.flatnonzero(is_far):
+            if len(accepted_states) + len(batch_accepted) == n_variations:
+                break
+            if batch_distances[state_idx, batch_accepted].min(initial=min_cells) >= min_cells:
+                batch_accepted.append(state_idx)
+            else:
+                n_near_duplicates += 1
+
+        accepted_states.extend(states[batch_accepted])
+        accepted_packed = np.concatenate([accepted_packed, packed[batch_accepted]])
+
+    report = {
+        "n_candidates": n_candidates,
+        "n_exact_duplicates": n_exact_duplicates,
+        "n_near_duplicates": n_near_duplicates,
+        "n_accepted": len(accepted_states),
+        "candidates_per_variation": n_candidates / len(accepted_states) if accepted_states else float("inf"),
+        "min_cells": min_cells,
+    }
+
+    states = np.array(accepted_states) if accepted_states else \
+        np.zeros((0,) + tune_sampler.initial_state.shape, dtype=tune_sampler.initial_state.dtype)
+
+    return states, report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Generates distinct Cellular Automaton variations of a tune")
+    parser.add_argument("file", help="lead-sheet file name in the folder")
+    parser.add_argument("--folder", default="./Omnibook")
+    parser.add_argument("--variations", type=int, default=20)
+    parser.add_argument("--min-distance", type=float, default=0.02, help="minimum fraction of differing cells")
+    parser.add_argument("--max-candidates", type=int, default=None)
+    parser.add_argument("--synco-prob", type=float, default=0.5)
+    parser.add_argument("--kick-crash-prob", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    tune_sampler = TuneSampler(os.path.join(args.folder, args.file))
+    compiled_rules = compile_jazz_rules(
+        synco_prob=args.synco_prob,
+        kick_crash_prob=args.kick_crash_prob,
+        even_beat_swing_prob=CellularAutomatonRhythmGenerator.EVEN_BEAT_SWING_PROBABILITY,
+        odd_beat_swing_prob=CellularAutomatonRhythmGenerator.ODD_BEAT_SWING_PROBABILITY,
+    )
+
+    start_time = time.time()
+    states, report = diverse_states(tune_sampler, compiled_rules, args.variations, min_distance=args.min_distance,
+                                    max_candidates=args.max_candidates, rng=np.random.default_rng(args.seed))
+
+    print(f"{report['n_accepted']} of {args.variations} variations in {time.time() - start_time:.2f} s: "
+          f"{report['n_candidates']} candidates ({report['n_exact_duplicates']} exact duplicates, "
+          f"{report['n_near_duplicates']} near duplicates under {report['min_cells']} cells), "
+          f"{report['candidates_per_variation']:.1f} candidates per variation")
@@ -0,0 +1,349 @@
+import argparse
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+
+from cellularautomaton_gradio import list_files
+from m21_musescore import M21_and_show
+from pattern_m21_converter import PatternMusic21Converter, PitchedInstruments, DrumInstruments, States, \
+    MEASURE_DURATION
+from rhythm_analytics import TuneSampler
+from rule_tables import compile_jazz_rules
+from state_dataset import MANIFEST_FILE, default_params, read_manifest, shard_seed, write_manifest
+
+# fields of an event; each field is one fixed-width token
+EVENT_FIELDS = ["bar", "position", "instrument", "pitch", "duration", "velocity"]
+TOKEN_DTYPE = np.dtype("<u2")
+
+TICKS_PER_BEAT = 12  # eighths, triplets and sixteenths are whole ticks
+TICKS_PER_BAR = TICKS_PER_BEAT * MEASURE_DURATION
+
+MELODY_INSTRUMENT = 0  # the other instruments are the rows of the state, shifted by one
+
+# velocities of the notes in the MIDI files of the scores of PatternMusic21Converter
+ACCENT_VELOCITY = 127  # velocityScalar = PatternMusic21Converter.VOLUME_INCREASE
+DEFAULT_VELOCITY = 90  # music21 default (piano chords)
+
+# onset and duration, in beats, of the chord (or bass note) of a beat, for each state
+PITCHED_ONSETS = np.array([0.0, 0.0, 0.0, 0.5, 0.0])
+PITCHED_DURATIONS = np.array([1.0, 1.0, 1.0, 0.5, 1.0])
+
+# states whose chord (or bass note) is tied to the same pitch in the next beat
+TIED_STATES = {
+    PitchedInstruments.CHORD: [States.FILL_0_1.value, States.FILL_1_T.value],
+    PitchedInstruments.BASS: [States.FILL_0_1.value],
+}
+
+# onsets and durations, in beats, of the (up to 2) hits of a drum beat, for each state; duration 0: no hit
+DRUM_HIT_ONSETS = np.array([[0.0, 0.0], [0.0, 0.0], [0.0, 0.5], [0.5, 0.0], [0.0, 0.0]])
+DRUM_HIT_DURATIONS = np.array([[0.0, 0.0], [1.0, 0.0], [0.5, 0.5], [0.5, 0.0], [0.0, 0.0]])
+
+DRUM_PITCHES = np.zeros(len(PitchedInstruments) + len(DrumInstruments), dtype=int)
+for drum_instrument in DrumInstruments:
+    DRUM_PITCHES[drum_instrument.value] = PatternMusic21Converter.drumInstruments[drum_instrument][1]
+
+
+class ArrangementTokenizer:
+    """
+    Turns the arrangements of a tune into event tokens (bar, position, instrument, pitch, duration, velocity),
+    with the notes that PatternMusic21Converter would write in the score, but without building it.
+
+    Positions and durations are in ticks (TICKS_PER_BEAT per beat), pitches are MIDI (concert pitch),
+    instruments are MELODY_INSTRUMENT or the row of the state + 1, and tied notes are merged into one event.
+    A melody note which crosses a bar line is a single event (the score splits it into tied notes).
+
+    The melody events do not depend on the state, so they are computed once per tune; tokenizing a state
+    only turns its rows into events, with the chord and bass pitches of each beat of its voicing
+    (see beat_pitches).
+    """
+
+    def __init__(self, melody, chord_midis=None, bass_midis=None):
+        """
+        :param melody: list of music21 notes and rests
+        :param chord_midis, bass_midis: optional voicing of the tokenized states, when they all have the same
+            (see beat_pitches)
+        """
+        durations = np.array([float(melody_fig.duration.quarterLength) for melody_fig in melody])
+        is_note = np.array([melody_fig.isNote for melody_fig in melody], dtype=bool) & (durations > 0)
+        midis = np.array([melody_fig.pitch.midi if melody_fig.isNote else 0 for melody_fig in melody], dtype=int)
+        onsets = np.cumsum(durations) - durations
+        self.melody_events = (
+            onsets[is_note], durations[is_note], np.full(is_note.sum(), MELODY_INSTRUMENT), midis[is_note],
+            np.full(is_note.sum(), ACCENT_VELOCITY),
+        )
+
+        self.voicing_pitches = self.beat_pitches(chord_midis, bass_midis) if chord_midis is not None else None
+
+    @staticmethod
+    def beat_pitches(chord_midis, bass_midis):
+        """
+        Pitches of each beat of a voicing, flattened, with the beat of each pitch
+
+        :param chord_midis: midis of the chord of each beat (see M21_and_show.chord_codes_to_midis)
+        :param bass_midis: midi of the bass note of each beat
+        :return: dict PitchedInstruments -> (beats, midis)
+        """
+        voicing_pitches = {}
+        for pitched_instrument, beat_midis in [
+            (PitchedInstruments.CHORD, chord_midis),
+            (PitchedInstruments.BASS, [[bass_midi] for bass_midi in bass_midis]),
+        ]:
+            n_notes = np.array([len(midis) for midis in beat_midis], dtype=int)
+            voicing_pitches[pitched_instrument] = (
+                np.repeat(np.arange(len(beat_midis)), n_notes),
+                np.concatenate([np.asarray(midis, dtype=int) for midis in beat_midis]),
+            )
+
+        return voicing_pitches
+
+    @staticmethod
+    def _pitched_events(row, beats, midis, tied_states):
+        """
+        Events of the chord or bass notes of a row of the state, with the tied notes merged
+        """
+        row_states = row[beats]
+        onsets = beats + PITCHED_ONSETS[row_states]
+        durations = PITCHED_DURATIONS[row_states]
+
+        # a note is merged into the tied note of the same pitch in the previous beat, if it starts with the beat
+        keys = beats * 128 + midis
+        is_tied = np.isin(row_states, tied_states) & (beats < len(row) - 1)
+        is_merged = np.isin(keys - 128, keys[is_tied]) & (onsets == beats)
+
+        # by pitch, then beat: the notes of a tie are consecutive
+        order = np.lexsort((beats, midis))
+        first_notes = order[~is_merged[order]]
+        tie_starts = np.flatnonzero(~is_merged[order])
+        tied_durations = np.add.reduceat(durations[order], tie_starts) if len(order) else durations
+
+        return onsets[first_notes], tied_durations, midis[first_notes]
+
+    def tokenize(self, state, voicing_pitches=None):
+        """
+        :param state: state of the Cellular Automaton (n_instruments, pattern_length)
+        :param voicing_pitches: pitches of the voicing of the arrangement (see beat_pitches),
+            default: the voicing of the tokenizer
+        :return: np.ndarray TOKEN_DTYPE (n_events, len(EVENT_FIELDS)), sorted by onset, instrument and pitch
+        """
+        events = [self.melody_events]
+
+        for pitched_instrument, (beats, midis) in (voicing_pitches or self.voicing_pitches).items():
+            in_range = beats < state.shape[1]
+            onsets, durations, midis = self._pitched_events(
+                state[pitched_instrument.value], beats[in_range], midis[in_range], TIED_STATES[pitched_instrument])
+            velocity = DEFAULT_VELOCITY if pitched_instrument == PitchedInstruments.CHORD else ACCENT_VELOCITY
+            events.append((onsets, durations, np.full(len(onsets), pitched_instrument.value + 1), midis,
+                           np.full(len(onsets), velocity)))
+
+        # all the hits of all the drum rows at once
+        drum_rows = np.array([drum_instrument.value for drum_instrument in DrumInstruments])
+        drum_states = state[drum_rows]
+        hit_durations = DRUM_HIT_DURATIONS[drum_states]
+        rows, beats, hits = np.nonzero(hit_durations)
+        events.append((beats + DRUM_HIT_ONSETS[drum_states][rows, beats, hits], hit_durations[rows, beats, hits],
+                       drum_rows[rows] + 1, DRUM_PITCHES[drum_rows[rows]], np.full(len(rows), ACCENT_VELOCITY)))
+
+        onsets, durations, instruments, pitches, velocities = (np.concatenate(field) for field in zip(*events))
+        onset_ticks = np.round(onsets * TICKS_PER_BEAT).astype(int)
+        duration_ticks = np.maximum(np.round(durations * TICKS_PER_BEAT).astype(int), 1)
+
+        tokens = np.stack([
+            onset_ticks // TICKS_PER_BAR,
+            onset_ticks % TICKS_PER_BAR,
+            instruments,
+            pitches,
+            np.minimum(duration_ticks, np.iinfo(TOKEN_DTYPE).max),
+            velocities,
+        ], axis=1).astype(TOKEN_DTYPE)
+
+        return tokens[np.lexsort((pitches, instruments, onset_ticks))]
+
+
+def tokenize_tune(tune_job):
+    """
+    Generates the arrangements of a tune and writes their tokens to a shard: a flat binary file of tokens
+    (.bin) and an index of the offsets of the arrangements, in events (.offsets.npy). Runs in a worker process.
+
+    Each arrangement gets its own voicing, drawn (with the table-based voicing) from a random state seeded with
+    the seed of the tune, so that a shard is reproducible from its seed.
+
+    :param tune_job: dict with "folder", "shard_name", "tune_file", "tune_id", "params", "n_arrangements",
+        "seed", "voice_leading" and "batch_size"
+    :return: shard record of the manifest
+    """
+    tune_sampler = TuneSampler(tune_job["tune_file"])
+    tokenizer = ArrangementTokenizer(tune_sampler.melody)
+
+    # voicing draws: a generator of their own (the states are sampled with rng), not the global random state
+    m21_and_show = M21_and_show(random_state=np.random.RandomState(tune_job["seed"]))
+
+    tokens_file = tune_job["shard_name"] + ".bin"
+    offsets_file = tune_job["shard_name"] + ".offsets.npy"
+    tokens_path = os.path.join(tune_job["folder"], tokens_file)
+
+    rng = np.random.default_rng(tune_job["seed"])
+    compiled_rules = compile_jazz_rules(**tune_job["params"])
+    n_arrangements = tune_job["n_arrangements"]
+    offsets = np.zeros(n_arrangements + 1, dtype=np.int64)
+
+    # written under a temporary name, so readers never see a partial shard
+    with open(tokens_path + ".tmp", "wb") as tokens_bin:
+        for batch_start in range(0, n_arrangements, tune_job["batch_size"]):
+            batch_end = min(batch_start + tune_job["batch_size"], n_arrangements)
+            states = tune_sampler.sample(batch_end - batch_start, compiled_rules, rng)
+            for arrangement_idx, state in enumerate(states, start=batch_start):
+                chord_midis, bass_midis = m21_and_show.chord_codes_to_midis(
+                    tune_sampler.beat_chord_roots, tune_sampler.beat_chord_types,
+                    voice_leading=tune_job["voice_leading"])
+                tokens = tokenizer.tokenize(state, tokenizer.beat_pitches(chord_midis, bass_midis))
+                tokens.tofile(tokens_bin)
+                offsets[arrangement_idx + 1] = offsets[arrangement_idx] + len(tokens)
+
+    os.replace(tokens_path + ".tmp", tokens_path)
+    np.save(os.path.join(tune_job["folder"], offsets_file), offsets)
+
+    return {
+        "tokens_file": tokens_file,
+        "offsets_file": offsets_file,
+        "tune_id": tune_job["tune_id"],
+        "n_arrangements": n_arrangements,
+        "n_events": int(offsets[-1]),
+        "seed": tune_job["seed"],
+        "params": tune_job["params"],
+    }
+
+
+def export_tokens(output_folder, selected_files, tunes_folder="./Omnibook", n_arrangements=1000, params=None,
+                  voice_leading="greedy", n_workers=None, seed=0, batch_size=250):
+    """
+    Tokenizes n_arrangements generated arrangements of each tune into a dataset folder of shards (one per tune),
+    with a pool of worker processes across the tunes; an existing dataset is appended to.
+
+    :param params: dict of parameters (see rhythm_analytics.PARAMS); missing parameters take the defaults
+    :return: number of written tokens
+    """
+    start_time = time.time()
+
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = read_manifest(output_folder) if os.path.isfile(os.path.join(output_folder, MANIFEST_FILE)) else {
+        "event_fields": EVENT_FIELDS,
+        "token_dtype": TOKEN_DTYPE.str,
+        "ticks_per_beat": TICKS_PER_BEAT,
+        "tunes": [],
+        "shards": [],
+    }
+    params = {**default_params(), **(params or {})}
+
+    tune_jobs = []
+    for selected_file in selected_files:
+        if selected_file not in manifest["tunes"]:
+            manifest["tunes"].append(selected_file)
+        tune_jobs.append({
+            "folder": output_folder,
+            "shard_name": f"tokens_{len(manifest['shards']) + len(tune_jobs):06d}",
+            "tune_file": os.path.join(tunes_folder, selected_file),
+            "tune_id": manifest["tunes"].index(selected_file),
+            "params": params,
+            "n_arrangements": n_arrangements,
+            "voice_leading": voice_leading,
+            "batch_size": batch_size,
+        })
+
+    for shard_idx, tune_job in enumerate(tune_jobs, start=len(manifest["shards"])):
+        tune_job["seed"] = shard_seed(seed, shard_idx)
+
+    with mp.Pool(n_workers or os.cpu_count()) as pool:
+        shard_records = pool.map(tokenize_tune, tune_jobs, chunksize=1)
+
+    manifest["shards"].extend(shard_records)
+    write_manifest(output_folder, manifest)
+
+    n_tokens = sum(shard_record["n_events"] for shard_record in shard_records) * len(EVENT_FIELDS)
+    elapsed = time.time() - start_time
+    print(f"Wrote {n_tokens} tokens of {n_arrangements * len(tune_jobs)} arrangements in {elapsed:.1f} s "
+          f"({n_tokens / elapsed:.0f} tokens/s)")
+
+    return n_tokens
+
+
+class EventTokenDataset:
+    """
+    Random access to the arrangements of a dataset written by export_tokens: dataset[i] is a view
+    (n_events, len(EVENT_FIELDS)) of the memory-mapped tokens of the arrangement.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.manifest = read_manifest(folder)
+        self.tunes = self.manifest["tunes"]
+        self.shards = self.manifest["shards"]
+
+        shard_sizes = np.array([shard["n_arrangements"] for shard in self.shards], dtype=np.int64)
+        self._shard_starts = np.concatenate([[0], np.cumsum(shard_sizes)])
+
+        self._shard_tokens = [None] * len(self.shards)
+        self._shard_offsets = [None] * len(self.shards)
+
+    def __len__(self):
+        return int(self._shard_starts[-1])
+
+    def _locate(self, arrangement_idx):
+
+        if not 0 <= arrangement_idx < len(self):
+            raise IndexError(f"Arrangement {arrangement_idx} out of range (dataset of {len(self)} arrangements)")
+        shard_idx = int(np.searchsorted(self._shard_starts, arrangement_idx, side="right")) - 1
+
+        return shard_idx, int(arrangement_idx - self._shard_starts[shard_idx])
+
+    def shard_tokens(self, shard_idx):
+        """
+        Memory-mapped tokens of a shard: (n_events, len(EVENT_FIELDS))
+        """
+        if self._shard_tokens[shard_idx] is None:
+            shard = self.shards[shard_idx]
+            self._shard_tokens[shard_idx] = np.memmap(
+                os.path.join(self.folder, shard["tokens_file"]), dtype=self.manifest["token_dtype"], mode="r",
+                shape=(shard["n_events"], len(self.manifest["event_fields"])))
+            self._shard_offsets[shard_idx] = np.load(os.path.join(self.folder, shard["offsets_file"]))
+        return self._shard_tokens[shard_idx]
+
+    def __getitem__(self, arrangement_idx):
+
+        shard_idx, shard_arrangement_idx = self._locate(arrangement_idx)
+        shard_tokens = self.shard_tokens(shard_idx)
+        offsets = self._shard_offsets[shard_idx]
+
+        return shard_tokens[offsets[shard_arrangement_idx]:offsets[shard_arrangement_idx + 1]]
+
+    def info(self, arrangement_idx):
+        """
+        :return: dict with the tune, seed and parameters of the shard of an arrangement
+        """
+        shard_idx, shard_arrangement_idx = self._locate(arrangement_idx)
+        shard = self.shards[shard_idx]
+
+        return {**shard["params"], "tune": self.tunes[shard["tune_id"]], "seed": shard["seed"],
+                "arrangement_idx": shard_arrangement_idx}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Exports generated arrangements as event tokens")
+    parser.add_argument("output_folder")
+    parser.add_argument("--folder", default="./Omnibook", help="folder of the lead-sheets")
+    parser.add_argument("--files", nargs="*", help="tunes of the folder (default: all)")
+    parser.add_argument("--arrangements", type=int, default=1000, help="arrangements per tune")
+    parser.add_argument("--synco-prob", type=float, default=0.5)
+    parser.add_argument("--kick-crash-prob", type=float, default=0.2)
+    parser.add_argument("--voice-leading", default="greedy", choices=["greedy", "viterbi"])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    selected_files = args.files or sorted(list_files(args.folder))
+
+    export_tokens(args.output_folder, selected_files, tunes_folder=args.folder, n_arrangements=args.arrangements,
+                  params={"synco_prob": args.synco_prob, "kick_crash_prob": args.kick_crash_prob},
+                  voice_leading=args.voice_leading, n_workers=args.workers, seed=args.seed)
@@ -0,0 +1,170 @@
+import numpy as np
+
+
+class GenerationHistory:
+    """
+    History of the Cellular Automaton states generated in a session, for undo / redo.
+
+    Each version is stored as a delta against the previous one: the flat indices of the changed cells
+    and their new values (uint8), so that regenerating the rhythm of a tune costs a few hundred bytes
+    instead of a whole state (and score). Every KEYFRAME_INTERVAL versions, or when the tune (the shape
+    of the state) changes, the whole state is stored as a keyframe, which bounds the number of deltas
+    applied to rebuild a version. When the history exceeds max_bytes, the oldest versions are evicted
+    (the oldest remaining version becomes a keyframe).
+
+    Versions are numbered from 1 in the order they are added, and keep their number after evictions.
+    Adding a version after an undo discards the versions which could be redone (their numbers are not reused).
+    """
+
+    KEYFRAME_INTERVAL = 16
+
+    def __init__(self, max_bytes=1_000_000):
+        self.max_bytes = max_bytes
+        self._entries = []
+        self._cursor = -1  # position of the current version in _entries
+        self._next_version = 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def versions(self):
+        """
+        Version numbers in the history, oldest first
+        """
+        return [entry["version"] for entry in self._entries]
+
+    @property
+    def current(self):
+        """
+        Current version number, or None if the history is empty
+        """
+        return self._entries[self._cursor]["version"] if self._entries else None
+
+    @property
+    def nbytes(self):
+        """
+        Bytes of the stored states and deltas
+        """
+        return sum(self._entry_nbytes(entry) for entry in self._entries)
+
+    @staticmethod
+    def _entry_nbytes(entry):
+
+        if entry["keyframe"] is not None:
+            return entry["keyframe"].nbytes
+        return entry["indices"].nbytes + entry["values"].nbytes
+
+    def _position(self, version):
+
+        versions = self.versions
+        if version not in versions:
+            raise KeyError(f"Version {version} is not in the history ({self.label()})")
+        return versions.index(version)
+
+    def _rebuild(self, position):
+        """
+        State of the entry at a position: its keyframe, or the previous keyframe with the deltas applied
+        """
+        keyframe_position = position
+        while self._entries[keyframe_position]["keyframe"] is None:
+            keyframe_position -= 1
+
+        state = self._entries[keyframe_position]["keyframe"].copy()
+        flat_state = state.reshape(-1)
+        for entry in self._entries[keyframe_position + 1:position + 1]:
+            flat_state[entry["indices"]] = entry["values"]
+
+        return state
+
+    def push(self, state, **metadata):
+        """
+        Adds a generated state as the new current version.
+
+        :param state: state of the Cellular Automaton (values in [0, 255])
+        :param metadata: anything needed to render the version again (tune, parameters, seed...)
+        :return: version number
+        """
+        state = np.asarray(state).astype(np.uint8)
+
+        # versions which could be redone are discarded
+        del self._entries[self._cursor + 1:]
+
+        entry = {"version": self._next_version, "shape": state.shape, "metadata": metadata,
+                 "keyframe": None, "indices": None, "values": None}
+
+        previous_state = self._rebuild(len(self._entries) - 1) if self._entries else None
+        since_keyframe = next((n_entries for n_entries, previous_entry in enumerate(reversed(self._entries))
+                               if previous_entry["keyframe"] is not None), 0)
+
+        if previous_state is None or previous_state.shape != state.shape or \
+                since_keyframe + 1 >= self.KEYFRAME_INTERVAL:
+            entry["keyframe"] = state.copy()
+        else:
+            changed = np.flatnonzero(state.reshape(-1) != previous_state.reshape(-1))
+            index_dtype = np.uint16 if state.size <= np.iinfo(np.uint16).max + 1 else np.uint32
+            entry["indices"] = changed.astype(index_dtype)
+            entry["values"] = state.reshape(-1)[changed]
+            if self._entry_nbytes(entry) > state.nbytes:
+                entry["keyframe"], entry["indices"], entry["values"] = state.copy(), None, None
+
+        self._entries.append(entry)
+        self._cursor = len(self._entries) - 1
+        self._next_version += 1
+
+        self._evict()
+
+        return entry["version"]
+
+    def _evict(self):
+        """
+        Evicts the oldest versions until the history fits in max_bytes (the current version is kept)
+        """
+        while self.nbytes > self.max_bytes and self._cursor > 0:
+            if self._entries[1]["keyframe"] is None:
+                self._entries[1].update(keyframe=self._rebuild(1), indices=None, values=None)
+            del self._entries[0]
+            self._cursor -= 1
+
+    def state(self, version=None):
+        """
+        :param version: version number (default: current version)
+        :return: np.ndarray uint8, state of the version
+        """
+        return self._rebuild(self._position(version if version is not None else self.current))
+
+    def metadata(self, version=None):
+
+        return self._entries[self._position(version if version is not None else self.current)]["metadata"]
+
+    def select(self, version):
+        """
+        Makes a version the current one (as undo / redo do), without discarding the others
+        """
+        self._cursor = self._position(version)
+        return version
+
+    def undo(self):
+        """
+        :return: previous version number (now current), or None if there is none
+        """
+        if self._cursor <= 0:
+            return None
+        self._cursor -= 1
+        return self.current
+
+    def redo(self):
+        """
+        :return: next version number (now current), or None if there is none
+        """
+        if self._cursor >= len(self._entries) - 1:
+            return None
+        self._cursor += 1
+        return self.current
+
+    def label(self):
+
+        if not self._entries:
+            return "empty history"
+        return f"version {self.current} ({len(self)} versions from {self.versions[0]} to {self.versions[-1]}, " \
+               f"{self.nbytes / 1000:.1f} kB)"
@@ -0,0 +1,195 @@
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from omnibook_read import has_cached_key
+from pattern_m21_converter import measure_window
+
+# cheaper paths of a render, in the order they are applied when the budget is tight
+DEGRADATIONS = ["cached_key", "table_voicing", "preview_only"]
+
+DEGRADATION_DESCRIPTIONS = {
+    "cached_key": "key signature instead of score.analyze",
+    "table_voicing": "table-based chord voicing",
+    "preview_only": "preview image instead of the score",
+}
+
+
+class LatencyPlanner:
+    """
+    Chooses the degradations of a render which keep it within a latency budget.
+
+    The time of each pipeline stage is estimated from its cost in seconds per beat (measured on a reference
+    machine), scaled by a speed factor: the smoothed ratio of the measured to the estimated times of the
+    past renders of the session. The number of beats of a tune is the one of its last render.
+    A render of a window of measures only builds the score (or the preview) of the window beats, and only
+    its chords are built as music21 chords, but the whole tune is parsed and voice-led.
+    """
+
+    STAGE_SECONDS_PER_BEAT = {
+        "parse": 0.0005,  # parse, melody quantization and Cellular Automaton
+        "key": 0.0003,  # score.analyze
+        "voicing": 0.0012,
+        "table_voicing": 0.0002,
+        "score": 0.02,  # score construction and show (MusicXML export), per beat of all the choruses (or window)
+        "preview": 0.0002,  # per beat of all the choruses (or window)
+    }
+
+    DEFAULT_TUNE_BEATS = 128
+    SPEED_SMOOTHING = 0.3
+
+    def __init__(self):
+        self.speed_factor = 1.0
+        self.tune_beats = {}  # file path -> beats of the form
+        self._lock = threading.Lock()
+
+    def estimate(self, file_path, choruses=1, degradations=(), measures=None):
+        """
+        :param measures: (first, last) measure numbers of the rendered window (see render_score), or None
+        :return: estimated seconds of a render with the degradations
+        """
+        tune_beats = self.tune_beats.get(file_path, self.DEFAULT_TUNE_BEATS)
+
+        if measures is not None:
+            start_beat, end_beat = measure_window(measures, tune_beats * choruses)
+            rendered_beats = end_beat - start_beat
+        else:
+            rendered_beats = tune_beats * choruses
+        # the chords are voiced once per chorus; a window voices the whole tune as midis (see generate_arrangement)
+        voiced_beats = min(rendered_beats, tune_beats)
+        table_voiced_beats = tune_beats if "table_voicing" in degradations or measures is not None else 0
+
+        stage_beats = {
+            "parse": tune_beats,
+            "key": 0 if "cached_key" in degradations or has_cached_key(file_path) else tune_beats,
+            "voicing": 0 if "table_voicing" in degradations else voiced_beats,
+            "table_voicing": table_voiced_beats,
+            "score": 0 if "preview_only" in degradations else rendered_beats,
+            "preview": rendered_beats if "preview_only" in degradations else 0,
+        }
+
+        seconds = sum(self.STAGE_SECONDS_PER_BEAT[stage] * n_beats for stage, n_beats in stage_beats.items())
+
+        return self.speed_factor * seconds
+
+    def plan(self, latency_budget, file_path, choruses=1, measures=None):
+        """
+        Degradations applied in order until the estimated time of the render is within the budget
+        (all of them if it cannot be met)
+
+        :return: degradations: list of the applied DEGRADATIONS
+        :return: estimated: estimated seconds of the render with them
+        """
+        degradations = []
+        estimated = self.estimate(file_path, choruses, degradations, measures)
+        for degradation in DEGRADATIONS:
+            if estimated <= latency_budget:
+                break
+            degradations.append(degradation)
+            estimated = self.estimate(file_path, choruses, degradations, measures)
+
+        return degradations, estimated
+
+    def record(self, file_path, tune_beats, seconds, choruses=1, degradations=(), measures=None):
+        """
+        Records the measured time of a render, and the beats of the tune
+        """
+        with self._lock:
+            self.tune_beats[file_path] = tune_beats
+            expected = self.estimate(file_path, choruses, degradations, measures) / self.speed_factor
+            self.speed_factor += self.SPEED_SMOOTHING * (seconds / expected - self.speed_factor)
+
+
+def render_full_score(render_kwargs, folder, output_path):
+    """
+    Renders a score at full quality and writes it as MusicXML. Runs in the background worker process.
+
+    :param render_kwargs: render_arrangement_score parameters, with the seed and state of the degraded render
+    :return: output_path
+    :return: seconds: time of the render and export
+    :return: tune_beats: beats of the form
+    """
+    from cellularautomaton_gradio import render_arrangement_score
+
+    start_time = time.perf_counter()
+    score, state, _ = render_arrangement_score(folder=folder, **render_kwargs)
+    score.write("musicxml", fp=output_path)
+
+    return output_path, time.perf_counter() - start_time, state.shape[1] // int(render_kwargs.get("choruses", 1))
+
+
+class BackgroundRenders:
+    """
+    Full-quality renders of the degraded renders, finished one after another in a background worker process,
+    so that the interface is free as soon as the degraded render is shown. Each one is written to a MusicXML
+    file which can be fetched when it is done. Their measured times are recorded by the planner.
+    """
+
+    def __init__(self, latency_planner, output_folder=None):
+        self.latency_planner = latency_planner
+        self.output_folder = output_folder
+        self._executor = None
+        self._renders = {}  # render id -> (future, lead-sheet file name)
+        self._next_id = 1
+
+    def submit(self, render_kwargs, folder="./Omnibook"):
+        """
+        :param render_kwargs: see render_full_score
+        :return: render id
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=1)
+        if self.output_folder is None:
+            self.output_folder = tempfile.mkdtemp(prefix="full_renders_")
+
+        render_id = self._next_id
+        self._next_id += 1
+
+        file_path = os.path.join(folder, render_kwargs["selected_file"])
+        output_path = os.path.join(self.output_folder, f"render_{render_id:04d}.musicxml")
+        future = self._executor.submit(render_full_score, render_kwargs, folder, output_path)
+
+        def record_render(done_future):
+            if done_future.exception() is None:
+                _, seconds, tune_beats = done_future.result()
+                self.latency_planner.record(file_path, tune_beats, seconds,
+                                            choruses=int(render_kwargs.get("choruses", 1)),
+                                            measures=render_kwargs.get("measures"))
+
+        future.add_done_callback(record_render)
+        self._renders[render_id] = (future, render_kwargs["selected_file"])
+
+        return render_id
+
+    @property
+    def last_id(self):
+        return self._next_id - 1 if self._renders else None
+
+    def fetch(self, render_id=None, timeout=None):
+        """
+        :param render_id: render id (default: the last one)
+        :param timeout: seconds to wait for the render (None: do not wait)
+        :return: message
+        :return: MusicXML file path of the full render, or None if it is not done
+        """
+        render_id = render_id or self.last_id
+        if render_id not in self._renders:
+            return f"No background render {render_id}", None
+
+        future, selected_file = self._renders[render_id]
+        if timeout is not None:
+            wait([future], timeout=timeout)
+        if not future.done():
+            return f"Full render {render_id} of {selected_file} is not done yet", None
+        if future.exception() is not None:
+            return f"Full render {render_id} of {selected_file} failed: {future.exception()}", None
+
+        output_path, seconds, _ = future.result()
+
+        return f"Full render {render_id} of {selected_file} ({seconds:.1f} s)", output_path
+
+
+latency_planner = LatencyPlanner()
+background_renders = BackgroundRenders(latency_planner)
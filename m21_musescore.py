@@ -1,6 +1,8 @@
 import numpy as np
 import music21 as m21
 
+from chord_vocabulary import ChordVocabulary
+
 CHORD_JOIN = ":"
 
 class M21_and_show:
@@ -19,10 +21,34 @@ class M21_and_show:
         "C:ø7": [["C3", "Bb3", "Eb4", "Gb4"], ["C3", "Eb4", "Gb4", "Bb4"], ["C3", "Gb4", "Bb4", "Eb5"]],  # half diminished 7th
     }
 
+    # roots and chord types of chord_dict interned into small integers
+    chord_vocabulary = ChordVocabulary([chord_name.split(CHORD_JOIN)[1] for chord_name in chord_dict])
+    # chord types after which the next chord is voiced with minimum movement most of the time
+    smooth_voice_lead = chord_vocabulary.is_dominant | chord_vocabulary.is_diminished | \
+        chord_vocabulary.is_half_diminished
 
     V7_SMOOTH_VOICE_LEAD_PROBABILITY = 0.9
     NON_V7_SMOOTH_VOICE_LEAD_PROBABILITY = 0.5
 
+    # Viterbi voice leading: the movement after a 7th chord weighs more, so that with temperature > 0
+    # it is smoother than after other chords (as with the greedy probabilities above)
+    V7_VOICE_LEAD_WEIGHT = 2.0
+    NON_V7_VOICE_LEAD_WEIGHT = 1.0
+
+    # chord type -> list of np.ndarray with the midis of each chord version (root included), in C
+    _chord_versions_midis = {}
+    # (root code, type code) -> candidate voicings and their mean midis
+    _chord_candidates = {}
+    # midi -> name with octave, for the table-based voicing
+    _midi_names = {}
+
+    def __init__(self, random_state=None):
+        """
+        :param random_state: np.random.RandomState of the random draws of the voicing
+            (default: the global numpy random state)
+        """
+        self.random_state = random_state if random_state is not None else np.random
+
     def add_chord_version(self, m21_chord_version, trans_interv, chord_version_idx, mean_midis, m21_chord_versions):
 
         m21_chord_version.transpose(m21.interval.Interval(trans_interv), inPlace=True)
@@ -33,13 +59,17 @@ class M21_and_show:
 
         return mean_midis, m21_chord_versions
 
-    def chord_seq_to_m21_chords_and_bass(self, chord_progression):
+    def chord_seq_to_m21_chords_and_bass(self, chord_progression, voice_leading="greedy", temperature=0.0):
         """
         Translate the MC generated chord sequence into a list of music21
         chords.
 
         Parameters:
         - chord_progression (list): The MC generated chord sequence: list of tuples (chord_name, chord_duration).
+        - voice_leading (str): "greedy" chooses each chord version from the previous chord;
+            "viterbi" chooses the versions of the whole progression at once (see viterbi_voice_leading)
+        - temperature (float): only for "viterbi"; 0 chooses the smoothest progression,
+            higher values add randomness
 
         Returns:
         - list of music21.chord.Chord: The corresponding chord progression in music21 format.
@@ -47,38 +77,47 @@ class M21_and_show:
         """
 
         print(chord_progression)
-        # chord_progression = [('B_-7', 2), ('Bb_7', 2), ('Eb_-6', 2), ('G#_7(b9)', 2), ('C#_-7', 2), ('G#_-7', 2),
-        #                     ('F#_-7', 2), ('B_-7', 2), ('A_-7', 2), ('E_-7', 2), ('B_-7', 2), ('E_-7', 2)]
 
+        root_codes, type_codes = self.chord_vocabulary.encode_sequence(
+            [chord_name for (chord_name, _) in chord_progression])
+        chord_durations = [chord_duration for (_, chord_duration) in chord_progression]
 
+        return self.chord_codes_to_m21_chords_and_bass(root_codes, type_codes, chord_durations,
+                                                       voice_leading=voice_leading, temperature=temperature)
 
-        m21_bass_line = []
-        m21_chord_progression = []
-        for i, (chord_name, chord_duration) in enumerate(chord_progression):
-            chord_bass, chord_type = chord_name.split(CHORD_JOIN)
+    def chord_codes_to_m21_chords_and_bass(self, root_codes, type_codes, chord_durations,
+                                           voice_leading="greedy", temperature=0.0):
+        """
+        Same as chord_seq_to_m21_chords_and_bass, for a chord progression encoded with chord_vocabulary.
 
-            if chord_bass != "C":
-                interv = m21.interval.Interval(m21.note.Note("C"), m21.note.Note(chord_bass))
-                trans_interv = interv.semitones
+        Parameters:
+        - root_codes (np.ndarray): root code of each chord
+        - type_codes (np.ndarray): type code of each chord
+        - chord_durations (list): duration of each chord
+        """
+        if voice_leading == "viterbi":
+            return self._viterbi_chord_codes_to_m21_chords_and_bass(root_codes, type_codes, chord_durations,
+                                                                    temperature)
+        # chord_progression = [('B_-7', 2), ('Bb_7', 2), ('Eb_-6', 2), ('G#_7(b9)', 2), ('C#_-7', 2), ('G#_-7', 2),
+        #                     ('F#_-7', 2), ('B_-7', 2), ('A_-7', 2), ('E_-7', 2), ('B_-7', 2), ('E_-7', 2)]
 
-                if trans_interv > 6:
-                    trans_interv -= 12
 
-                elif trans_interv < -6:
-                    trans_interv += 12
 
-            else:
-                trans_interv = 0
+        m21_bass_line = []
+        m21_chord_progression = []
+        for i, (root_code, type_code, chord_duration) in enumerate(zip(root_codes, type_codes, chord_durations)):
+            chord_type = self.chord_vocabulary.type_names[type_code]
+            trans_interv = int(self.chord_vocabulary.trans_intervs[root_code])
 
             chord_versions = self.chord_dict["C" + CHORD_JOIN + chord_type]
             n_chord_versions = len(chord_versions)
 
             # music21 generates flat as "-", but we want to display flat as "b" (also admitted by music21)
-            chord_bass = chord_bass.replace("-", "b")
+            chord_bass = self.chord_vocabulary.root_display_names[root_code]
 
             if i==0:
                 # the chord is initially considered a C chord which is what the chord_dict contains
-                chord_version_idx = np.random.randint(n_chord_versions)
+                chord_version_idx = self.random_state.randint(n_chord_versions)
 
                 chord_notes_list = chord_versions[chord_version_idx]
 
@@ -88,8 +127,6 @@ class M21_and_show:
                     m21_chord.transpose(m21.interval.Interval(trans_interv), inPlace=True)
 
             else:
-                prev_chord_name, _ = chord_progression[i-1]
-                prev_chord_bass, prev_chord_type = chord_name.split(CHORD_JOIN)
                 # TODO choose chord version with several criteria:
 
                 prev_m21_chord = m21_chord_progression[i-1]
@@ -127,16 +164,16 @@ class M21_and_show:
                 midis_diff = [abs(prev_mean_midis - mean_midi) for (mean_midi, _) in mean_midis]
 
                 # - if previous chord is 7th chord, choose minimum movement version with some probability
-                if prev_chord_type in ["7", "7(b9)", "o7", "ø7"]:
-                    if np.random.random() < self.V7_SMOOTH_VOICE_LEAD_PROBABILITY:
+                if self.smooth_voice_lead[type_codes[i-1]]:
+                    if self.random_state.random_sample() < self.V7_SMOOTH_VOICE_LEAD_PROBABILITY:
                         chord_version_idx = midis_diff.index(min(midis_diff))
                     else:
-                        chord_version_idx = np.random.randint(len(midis_diff))
+                        chord_version_idx = self.random_state.randint(len(midis_diff))
                 else:
-                    if np.random.random() < self.NON_V7_SMOOTH_VOICE_LEAD_PROBABILITY:
+                    if self.random_state.random_sample() < self.NON_V7_SMOOTH_VOICE_LEAD_PROBABILITY:
                         chord_version_idx = midis_diff.index(min(midis_diff))
                     else:
-                        chord_version_idx = np.random.randint(len(midis_diff))
+                        chord_version_idx = self.random_state.randint(len(midis_diff))
 
                 # chord_version = mean_midis[chord_version_idx][1]
                 # print(midis_diff, chord_version)
@@ -144,15 +181,395 @@ class M21_and_show:
 
             # TODO if previous chord is the same as current one (M7, -7), change version
 
-            m21_chord.insertLyric("".join([chord_bass, chord_type]))
+            self._split_chord_and_bass(m21_chord, chord_bass, chord_type, m21_chord_progression, m21_bass_line)
+
+        return m21_chord_progression, m21_bass_line
+
+    def _split_chord_and_bass(self, m21_chord, chord_bass, chord_type, m21_chord_progression, m21_bass_line):
+
+        m21_chord.insertLyric("".join([chord_bass, chord_type]))
+
+        # This ensures the bass note is in the right octave
+        m21_bass_note = m21_chord.bass()
+        m21_bass_line.append(m21.note.Note(m21_bass_note, duration=m21_chord.duration))
+
+        # remove bass note from chord
+        m21_chord.remove(m21_chord.pitches[0])
+        m21_chord_progression.append(m21_chord)
+
+    def get_chord_versions_midis(self, chord_type):
+        """
+        Midis of the versions of a chord type in C, computed once from chord_dict
+        """
+        chord_versions_midis = self._chord_versions_midis.get(chord_type)
+        if chord_versions_midis is None:
+            chord_versions = self.chord_dict["C" + CHORD_JOIN + chord_type]
+            chord_versions_midis = [np.array([m21.pitch.Pitch(note_name).midi for note_name in chord_notes_list])
+                                    for chord_notes_list in chord_versions]
+            self._chord_versions_midis[chord_type] = chord_versions_midis
+
+        return chord_versions_midis
+
+    def get_chord_candidates(self, root_code, type_code):
+        """
+        Candidate voicings of a chord, with the same octave choices as the greedy voice leading.
+
+        Returns:
+        - list of tuples (chord_version_idx, trans_interv)
+        - np.ndarray: mean midi of each candidate without the root note
+        """
+        chord_codes = (int(root_code), int(type_code))
+        if chord_codes in self._chord_candidates:
+            return self._chord_candidates[chord_codes]
+
+        chord_type = self.chord_vocabulary.type_names[type_code]
+        trans_interv = int(self.chord_vocabulary.trans_intervs[root_code])
+
+        candidates = []
+        mean_midis = []
+        for chord_version_idx, version_midis in enumerate(self.get_chord_versions_midis(chord_type)):
+            upper_mean_midi = version_midis[1:].mean()
+
+            candidates.append((chord_version_idx, trans_interv))
+            mean_midis.append(upper_mean_midi + trans_interv)
+
+            if trans_interv > 3: # try descending octave
+                candidates.append((chord_version_idx, trans_interv - 12))
+                mean_midis.append(upper_mean_midi + trans_interv - 12)
+
+        self._chord_candidates[chord_codes] = (candidates, np.array(mean_midis))
+
+        return self._chord_candidates[chord_codes]
+
+    def greedy_voice_leading(self, root_codes, type_codes, random_draws=None):
+        """
+        Chord versions chosen as chord_codes_to_m21_chords_and_bass does with greedy voice leading
+        (same candidates, mean midis and random draws), computed from the chord version midis.
+
+        Parameters:
+        - random_draws (np.ndarray): optional (n_chords, 2) uniform draws of the chords (see _greedy_voicing),
+            instead of the random draws of chord_codes_to_m21_chords_and_bass. The draws of a chord do not
+            depend on the previous ones, so the voicings can be chosen again from any chord (see greedy_revoice)
+
+        Returns:
+        - list of tuples (chord_version_idx, trans_interv), one per chord.
+        """
+        voicings = []
+        prev_mean_midis = None
+        for i, (root_code, type_code) in enumerate(zip(root_codes, type_codes)):
+            voicing, prev_mean_midis = self._greedy_voicing(
+                root_code, type_code, type_codes[i-1] if i > 0 else None, prev_mean_midis,
+                random_draws[i] if random_draws is not None else None)
+            voicings.append(voicing)
+
+        return voicings
+
+    def _greedy_voicing(self, root_code, type_code, prev_type_code, prev_mean_midis, chord_draws=None):
+        """
+        Greedy voicing of a chord from the previous one (prev_mean_midis None for the first chord)
+
+        Parameters:
+        - chord_draws (np.ndarray): optional uniform draws of the chord: [0] chooses between the minimum movement
+            and a random version, [1] chooses the random version. If None, they are drawn as
+            chord_codes_to_m21_chords_and_bass draws them
+
+        Returns:
+        - tuple (chord_version_idx, trans_interv)
+        - float: mean midi of the voicing without the root note
+        """
+        chord_versions_midis = self.get_chord_versions_midis(self.chord_vocabulary.type_names[type_code])
+
+        if prev_mean_midis is None:
+            n_chord_versions = len(chord_versions_midis)
+            chord_version_idx = self.random_state.randint(n_chord_versions) if chord_draws is None else \
+                int(chord_draws[1] * n_chord_versions)
+            voicing = (chord_version_idx, int(self.chord_vocabulary.trans_intervs[root_code]))
+        else:
+            candidates, _ = self.get_chord_candidates(root_code, type_code)
+            # mean midis as the music21 chords give them (sum of the transposed midis), so that ties
+            # between candidates are broken as in the greedy voice leading
+            midis_diff = [abs(prev_mean_midis - self._upper_mean_midi(chord_versions_midis, candidate))
+                          for candidate in candidates]
+
+            if self.smooth_voice_lead[prev_type_code]:
+                smooth_voice_lead_probability = self.V7_SMOOTH_VOICE_LEAD_PROBABILITY
+            else:
+                smooth_voice_lead_probability = self.NON_V7_SMOOTH_VOICE_LEAD_PROBABILITY
+            smooth_draw = self.random_state.random_sample() if chord_draws is None else chord_draws[0]
+            if smooth_draw < smooth_voice_lead_probability:
+                voicing = candidates[midis_diff.index(min(midis_diff))]
+            else:
+                voicing = candidates[self.random_state.randint(len(midis_diff)) if chord_draws is None else
+                                     int(chord_draws[1] * len(midis_diff))]
+
+        return voicing, self._upper_mean_midi(chord_versions_midis, voicing)
+
+    def greedy_revoice(self, voicings, root_codes, type_codes, edited_chords, random_draws):
+        """
+        Greedy voicings of a progression after some of its chords were edited, equal to greedy_voice_leading
+        of the edited progression with the same random_draws: the voicings are chosen again from each edited
+        chord, until a chord which is not edited keeps its voicing (the next voicings would not change).
+
+        Parameters:
+        - voicings (list): voicings of the progression before the edit (greedy_voice_leading with random_draws)
+        - root_codes, type_codes (np.ndarray): codes of the edited progression
+        - edited_chords (iterable): positions of the edited chords
+        - random_draws (np.ndarray): (n_chords, 2) uniform draws of greedy_voice_leading
 
-            # This ensures the bass note is in the right octave
-            m21_bass_note = m21_chord.bass()
-            m21_bass_line.append(m21.note.Note(m21_bass_note, duration=m21_chord.duration))
+        Returns:
+        - list of tuples (chord_version_idx, trans_interv), one per chord
+        - list of int: positions of the chords whose voicing changed
+        """
+        voicings = list(voicings)
+        edited_chords = set(int(chord_pos) for chord_pos in edited_chords)
+        changed_chords = []
+
+        n_chords = len(voicings)
+        chord_pos = min(edited_chords, default=n_chords)
+        while chord_pos < n_chords:
+            prev_type_code, prev_mean_midis = None, None
+            if chord_pos > 0:
+                prev_type_code = type_codes[chord_pos - 1]
+                prev_mean_midis = self._upper_mean_midi(
+                    self.get_chord_versions_midis(self.chord_vocabulary.type_names[prev_type_code]),
+                    voicings[chord_pos - 1])
+
+            voicing, _ = self._greedy_voicing(root_codes[chord_pos], type_codes[chord_pos], prev_type_code,
+                                              prev_mean_midis, random_draws[chord_pos])
+            is_changed = voicing != voicings[chord_pos]
+            if is_changed:
+                voicings[chord_pos] = voicing
+                changed_chords.append(chord_pos)
+
+            # the next chord is voiced from this one: its voicing changes only if this chord changed
+            if is_changed or chord_pos in edited_chords or chord_pos + 1 in edited_chords:
+                chord_pos += 1
+            else:
+                chord_pos = min([edited_pos for edited_pos in edited_chords if edited_pos > chord_pos],
+                                default=n_chords)
+
+        return voicings, changed_chords
+
+    @staticmethod
+    def _upper_mean_midi(chord_versions_midis, voicing):
+
+        chord_version_idx, trans_interv = voicing
+        upper_midis = chord_versions_midis[chord_version_idx][1:] + trans_interv
+        return int(upper_midis.sum()) / len(upper_midis)
+
+    def chord_codes_to_midis(self, root_codes, type_codes, voice_leading="greedy", temperature=0.0):
+        """
+        Table-based voicing: the same chords as chord_codes_to_m21_chords_and_bass (for the same random state),
+        as midis, without building music21 chords.
 
-            # remove bass note from chord
-            m21_chord.remove(m21_chord.pitches[0])
+        Returns:
+        - list of np.ndarray: midis of each chord, without the root note
+        - list of int: midi of the bass note of each chord
+        """
+        if voice_leading == "viterbi":
+            voicings = self.viterbi_voice_leading(root_codes, type_codes, temperature)
+        else:
+            voicings = self.greedy_voice_leading(root_codes, type_codes)
+
+        chord_midis = []
+        bass_midis = []
+        for type_code, (chord_version_idx, trans_interv) in zip(type_codes, voicings):
+            chord_type = self.chord_vocabulary.type_names[type_code]
+            version_midis = self.get_chord_versions_midis(chord_type)[chord_version_idx] + trans_interv
+            chord_midis.append(version_midis[1:])
+            bass_midis.append(int(version_midis[0]))
+
+        return chord_midis, bass_midis
+
+    def table_chord_codes_to_m21_chords_and_bass(self, root_codes, type_codes, chord_durations,
+                                                 voice_leading="greedy", temperature=0.0):
+        """
+        Same as chord_codes_to_m21_chords_and_bass with the table-based voicing (see chord_codes_to_midis):
+        a single music21 chord is built per beat from its midis, instead of one per chord version
+        and transposition. The pitches are the same, but their spelling is music21's default for each midi.
+        """
+        chord_midis, bass_midis = self.chord_codes_to_midis(root_codes, type_codes, voice_leading=voice_leading,
+                                                            temperature=temperature)
+
+        m21_bass_line = []
+        m21_chord_progression = []
+        for root_code, type_code, chord_duration, midis, bass_midi in \
+                zip(root_codes, type_codes, chord_durations, chord_midis, bass_midis):
+            m21_chord = m21.chord.Chord([self._midi_name(midi) for midi in midis], quarterLength=chord_duration)
+            m21_chord.insertLyric("".join([self.chord_vocabulary.root_display_names[root_code],
+                                           self.chord_vocabulary.type_names[type_code]]))
             m21_chord_progression.append(m21_chord)
+            m21_bass_line.append(m21.note.Note(self._midi_name(bass_midi), quarterLength=chord_duration))
+
+        return m21_chord_progression, m21_bass_line
+
+    def _midi_name(self, midi):
+        """
+        Name with octave of a midi (music21 builds chords from names much faster than from midis)
+        """
+        midi_name = self._midi_names.get(midi)
+        if midi_name is None:
+            midi_name = m21.pitch.Pitch(midi=int(midi)).nameWithOctave
+            self._midi_names[int(midi)] = midi_name
+        return midi_name
+
+    def viterbi_voice_leading(self, root_codes, type_codes, temperature=0.0, random_draws=None):
+        """
+        Choose the chord versions of the whole progression at once with a Viterbi-style dynamic program.
+
+        The cost of moving between two consecutive voicings is the difference of their mean midis
+        (without the root note), weighted more after 7th chords. With temperature == 0 the progression
+        with minimum total movement is chosen; with temperature > 0 a progression is sampled with
+        probability proportional to exp(-cost / temperature) (forward filtering, backward sampling).
+
+        Parameters:
+        - root_codes (np.ndarray): root code of each chord (see chord_vocabulary).
+        - type_codes (np.ndarray): type code of each chord.
+        - temperature (float): randomness of the choice.
+        - random_draws (np.ndarray): optional n_chords uniform draws of the sampling (temperature > 0)
+
+        Returns:
+        - list of tuples (chord_version_idx, trans_interv), one per chord.
+        """
+        n_chords = len(root_codes)
+        if n_chords == 0:
+            return []
+
+        # candidates of each distinct chord of the progression
+        n_types = len(self.chord_vocabulary.type_names)
+        unique_chord_codes, chord_idxs = np.unique(np.asarray(root_codes, dtype=int) * n_types + type_codes,
+                                                   return_inverse=True)
+        unique_candidates = [self.get_chord_candidates(*divmod(int(chord_code), n_types))
+                             for chord_code in unique_chord_codes]
+
+        # padded (n_chords, max_candidates) matrix of mean midis; missing candidates are nan
+        n_candidates = max(len(candidates) for (candidates, _) in unique_candidates)
+        unique_mean_midis = np.full((len(unique_candidates), n_candidates), np.nan)
+        for unique_idx, (_, chord_mean_midis) in enumerate(unique_candidates):
+            unique_mean_midis[unique_idx, :len(chord_mean_midis)] = chord_mean_midis
+        mean_midis = unique_mean_midis[chord_idxs]
+
+        weights = np.where(self.smooth_voice_lead[type_codes], self.V7_VOICE_LEAD_WEIGHT,
+                           self.NON_V7_VOICE_LEAD_WEIGHT)
+
+        # costs[i, j, k]: movement from candidate j of chord i to candidate k of chord i + 1
+        costs = np.abs(mean_midis[:-1, :, None] - mean_midis[1:, None, :]) * weights[:-1, None, None]
+        costs = np.nan_to_num(costs, nan=np.inf)
+        first_scores = np.where(np.isnan(mean_midis[0]), np.inf, 0.0)
+
+        path = None
+        if temperature > 0:
+            path = self._sample_path(costs, first_scores, temperature, random_draws, self.random_state)
+        if path is None:
+            path = self._min_cost_path(costs, first_scores)
+
+        return [unique_candidates[chord_idxs[i]][0][candidate_idx] for i, candidate_idx in enumerate(path)]
+
+    @staticmethod
+    def _min_cost_path(costs, first_scores):
+
+        n_transitions = len(costs)
+        back_pointers = np.empty((n_transitions, costs.shape[2]), dtype=int)
+        scores = first_scores
+        for i in range(n_transitions):
+            total_costs = scores[:, None] + costs[i]
+            back_pointers[i] = total_costs.argmin(axis=0)
+            scores = total_costs.min(axis=0)
+
+        path = [int(scores.argmin())]
+        for i in range(n_transitions - 1, -1, -1):
+            path.append(int(back_pointers[i][path[-1]]))
+
+        return path[::-1]
+
+    @staticmethod
+    def _sample_path(costs, first_scores, temperature, random_draws=None, random_state=np.random):
+
+        # transition potentials; subtracting the minimum of each matrix does not change the distribution
+        # and avoids underflow for low temperatures
+        min_costs = costs.min(axis=(1, 2), keepdims=True) if len(costs) else 0
+        potentials = np.exp(-(costs - min_costs) / temperature)
+
+        n_transitions = len(costs)
+        forward_probs = np.empty((n_transitions + 1, costs.shape[2]))
+        forward_probs[0] = np.exp(-first_scores)
+        forward_probs[0] /= forward_probs[0].sum()
+        for i in range(n_transitions):
+            probs = forward_probs[i] @ potentials[i]
+            probs_sum = probs.sum()
+            if probs_sum == 0: # underflow: the temperature is too low to sample
+                return None
+            forward_probs[i + 1] = probs / probs_sum
+
+        if random_draws is None:
+            random_draws = random_state.random_sample(n_transitions + 1)
+
+        def draw(probs, random_draw):
+            cum_probs = np.cumsum(probs)
+            return int(np.searchsorted(cum_probs, random_draw * cum_probs[-1], side="right"))
+
+        path = [draw(forward_probs[-1], random_draws[-1])]
+        for i in range(n_transitions - 1, -1, -1):
+            path.append(draw(forward_probs[i] * potentials[i][:, path[-1]], random_draws[i]))
+
+        return path[::-1]
+
+    def _viterbi_chord_codes_to_m21_chords_and_bass(self, root_codes, type_codes, chord_durations, temperature):
+
+        voicings = self.viterbi_voice_leading(root_codes, type_codes, temperature)
+
+        m21_bass_line = []
+        m21_chord_progression = []
+        for root_code, type_code, chord_duration, voicing in zip(root_codes, type_codes, chord_durations, voicings):
+            self._voicing_to_m21_chord_and_bass(root_code, type_code, chord_duration, voicing,
+                                                m21_chord_progression, m21_bass_line)
+
+        return m21_chord_progression, m21_bass_line
+
+    def _voicing_to_m21_chord_and_bass(self, root_code, type_code, chord_duration, voicing,
+                                       m21_chord_progression, m21_bass_line):
+
+        chord_version_idx, trans_interv = voicing
+        chord_type = self.chord_vocabulary.type_names[type_code]
+
+        chord_notes_list = self.chord_dict["C" + CHORD_JOIN + chord_type][chord_version_idx]
+        m21_chord = m21.chord.Chord(chord_notes_list, quarterLength=chord_duration)
+        if trans_interv != 0:
+            m21_chord.transpose(m21.interval.Interval(trans_interv), inPlace=True)
+
+        chord_bass = self.chord_vocabulary.root_display_names[root_code]
+
+        self._split_chord_and_bass(m21_chord, chord_bass, chord_type, m21_chord_progression, m21_bass_line)
+
+    def window_chord_codes_to_m21_chords_and_bass(self, root_codes, type_codes, chord_durations, window_chords,
+                                                  voice_leading="greedy", temperature=0.0):
+        """
+        Same chords as chord_codes_to_m21_chords_and_bass (for the same random state), built as music21 chords
+        only for some of them, e.g. the beats of a window of measures: the versions of the whole progression
+        are chosen from the chord version midis (see greedy_voice_leading), so the chords of the window are
+        voice-led from the same previous chords, and spelled as in the whole progression.
+
+        Parameters:
+        - window_chords (iterable): positions of the chords to build
+
+        Returns:
+        - list of music21.chord.Chord, with None for the chords which are not built
+        - list of music21.note.Note, with None for the chords which are not built
+        """
+        if voice_leading == "viterbi":
+            voicings = self.viterbi_voice_leading(root_codes, type_codes, temperature)
+        else:
+            voicings = self.greedy_voice_leading(root_codes, type_codes)
+
+        m21_chord_progression = [None] * len(voicings)
+        m21_bass_line = [None] * len(voicings)
+        for chord_pos in sorted(window_chords):
+            m21_chords, m21_bass_notes = [], []
+            self._voicing_to_m21_chord_and_bass(root_codes[chord_pos], type_codes[chord_pos],
+                                                chord_durations[chord_pos], voicings[chord_pos],
+                                                m21_chords, m21_bass_notes)
+            m21_chord_progression[chord_pos] = m21_chords[0]
+            m21_bass_line[chord_pos] = m21_bass_notes[0]
 
         return m21_chord_progression, m21_bass_line
 
@@ -0,0 +1,259 @@
+import gc
+import math
+import os
+import shutil
+import struct
+import tempfile
+import xml.etree.ElementTree as ET
+
+import music21 as m21
+
+from cellularautomaton_gradio import render_score
+from pattern_m21_converter import MEASURE_DURATION
+
+DEFAULT_TEMPO = 120  # used when a tune has no tempo, so that the tempo of the previous tune does not continue
+
+
+class MidiMedleyWriter:
+    """
+    Writes the scores of a medley, one tune after another, to a single-track (format 0) MIDI file.
+
+    The events of each tune are written as soon as the tune is added, and the track length is
+    patched into the file when it is closed, so only one tune is kept in memory at a time.
+    Tempo, key and time signature events of each tune are written at the tune start.
+    """
+
+    def __init__(self, fp, ticks_per_quarter=m21.defaults.ticksPerQuarter):
+        self.ticks_per_quarter = ticks_per_quarter
+
+        self.file = open(fp, "wb")
+        self.file.write(b"MThd" + struct.pack(">LHHH", 6, 0, 1, ticks_per_quarter))
+        self.file.write(b"MTrk")
+        self._track_length_position = self.file.tell()
+        self.file.write(struct.pack(">L", 0))
+
+        self.track_length = 0
+        self.tick_offset = 0  # start of the next tune
+        self.last_tick = 0  # time of the last written event
+
+    def add_score(self, score, tune_quarters):
+        """
+        :param score: music21 score of the tune
+        :param tune_quarters: duration of the tune in quarters; the next tune starts after it
+        """
+        midi_file = m21.midi.translate.streamToMidiFile(score)
+        tick_scale = self.ticks_per_quarter / midi_file.ticksPerQuarterNote
+
+        # merge the tracks in time order; the conductor track (tempo, key) goes first
+        events = []
+        for track_idx, midi_track in enumerate(midi_file.tracks):
+            tick = 0
+            for event in midi_track.events:
+                if isinstance(event, m21.midi.DeltaTime):
+                    tick += event.time
+                elif event.type != m21.midi.MetaEvents.END_OF_TRACK:
+                    events.append((round(tick * tick_scale), track_idx, len(events), event))
+        events.sort(key=lambda tick_event: tick_event[:3])
+
+        for tick, _, _, event in events:
+            self._write_event(self.tick_offset + tick, event.getBytes())
+
+        self.tick_offset += round(tune_quarters * self.ticks_per_quarter)
+
+    def _write_event(self, tick, event_bytes):
+
+        event_bytes = m21.midi.putVariableLengthNumber(tick - self.last_tick) + event_bytes
+        self.file.write(event_bytes)
+        self.track_length += len(event_bytes)
+        self.last_tick = tick
+
+    def close(self):
+
+        # end of track after the last tune
+        self._write_event(max(self.tick_offset, self.last_tick), b"\xff\x2f\x00")
+
+        self.file.seek(self._track_length_position)
+        self.file.write(struct.pack(">L", self.track_length))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MusicXmlMedleyWriter:
+    """
+    Writes the scores of a medley, one tune after another, to a single MusicXML (partwise) file.
+
+    The measures of each part are exported as soon as the tune is added and appended to a spool file
+    per part; when the writer is closed, the spool files are concatenated into the MusicXML file.
+    The part list is taken from the first tune, so all the tunes must have the same parts.
+    """
+
+    def __init__(self, fp, title="Medley"):
+        self.fp = fp
+        self.title = title
+
+        self.spool_folder = tempfile.mkdtemp(prefix="medley_")
+        self.part_spools = None
+        self.part_list = None
+        self.part_ids = None  # ids of the parts and their instruments in the first tune
+        self.n_measures = 0
+
+    def add_score(self, score):
+        """
+        :param score: music21 score of the tune
+        """
+        general_exporter = m21.musicxml.m21ToXml.GeneralObjectExporter(score)
+        score_exporter = m21.musicxml.m21ToXml.ScoreExporter(general_exporter.fromGeneralObject(score))
+        root = score_exporter.parse()
+
+        score_parts = root.find("part-list").findall("score-part")
+        parts = root.findall("part")
+
+        tune_ids = [self._get_ids(score_part) for score_part in score_parts]
+        if self.part_spools is None:
+            # the first tune defines the parts of the medley
+            self.part_list = root.find("part-list")
+            self.part_ids = tune_ids
+            self.part_spools = [open(os.path.join(self.spool_folder, f"part_{part_idx}.xml"), "w", encoding="utf-8")
+                                for part_idx in range(len(parts))]
+        elif len(parts) != len(self.part_spools):
+            raise ValueError(f"All the tunes of a medley must have {len(self.part_spools)} parts, not {len(parts)}")
+
+        n_tune_measures = max(len(part.findall("measure")) for part in parts)
+        for part_idx, part in enumerate(parts):
+            id_map = dict(zip(tune_ids[part_idx], self.part_ids[part_idx]))
+
+            measures = part.findall("measure")
+            for measure_idx, measure in enumerate(measures):
+                measure.set("number", str(self.n_measures + measure_idx + 1))
+                for element in measure.iter():
+                    if element.get("id") in id_map:
+                        element.set("id", id_map[element.get("id")])
+
+                self.part_spools[part_idx].write(ET.tostring(measure, encoding="unicode"))
+
+            # all parts must have the same number of measures
+            for measure_idx in range(len(measures), n_tune_measures):
+                self.part_spools[part_idx].write(
+                    f'<measure number="{self.n_measures + measure_idx + 1}">'
+                    f'<note><rest measure="yes"/><duration>{m21.defaults.divisionsPerQuarter * MEASURE_DURATION}'
+                    f'</duration></note></measure>'
+                )
+
+        self.n_measures += n_tune_measures
+
+    @staticmethod
+    def _get_ids(score_part):
+
+        return [score_part.get("id")] + [score_instrument.get("id")
+                                         for score_instrument in score_part.findall("score-instrument")]
+
+    def close(self):
+
+        with open(self.fp, "w", encoding="utf-8") as xml_file:
+            xml_file.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                           '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" '
+                           '"http://www.musicxml.org/dtds/partwise.dtd">\n'
+                           '<score-partwise version="4.0">')
+
+            work = ET.Element("work")
+            ET.SubElement(work, "work-title").text = self.title
+            xml_file.write(ET.tostring(work, encoding="unicode"))
+
+            if self.part_spools is not None:
+                xml_file.write(ET.tostring(self.part_list, encoding="unicode"))
+
+                for part_idx, part_spool in enumerate(self.part_spools):
+                    part_spool.close()
+                    xml_file.write(f'<part id="{self.part_ids[part_idx][0]}">')
+                    with open(part_spool.name, encoding="utf-8") as part_file:
+                        shutil.copyfileobj(part_file, xml_file)
+                    xml_file.write("</part>")
+
+            xml_file.write("</score-partwise>\n")
+
+        shutil.rmtree(self.spool_folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def prepare_medley_score(score, tune_title):
+    """
+    Marks the tune boundaries of a medley score: title text at the start and double barline at the end.
+    A default tempo is added if the tune has none.
+
+    :return: duration of the tune in quarters (whole measures)
+    """
+    first_part = score.parts[0]
+    first_measure = first_part.getElementsByClass(m21.stream.Measure)[0]
+
+    if len(first_part.recurse().getElementsByClass(m21.tempo.MetronomeMark)) == 0:
+        first_measure.insert(0, m21.tempo.MetronomeMark(number=DEFAULT_TEMPO))
+
+    first_measure.insert(0, m21.expressions.TextExpression(tune_title))
+
+    for part in score.parts:
+        part.getElementsByClass(m21.stream.Measure)[-1].rightBarline = m21.bar.Barline("light-light")
+
+    tune_quarters = max(part.highestTime for part in score.parts)
+
+    return math.ceil(tune_quarters / MEASURE_DURATION) * MEASURE_DURATION
+
+
+def render_medley(playlist, output_file, folder="./Omnibook", title="Medley", **render_kwargs):
+    """
+    Adds rhythm to an ordered playlist of tunes and streams them to a single MIDI or MusicXML file
+    (depending on the extension of output_file). Each tune is rendered (CA state, voicings and parts),
+    written and released before the next one, so memory does not grow with the length of the medley.
+
+    :param playlist: list of lead-sheet file names in folder, or of tuples (file name, dict of
+        render_score parameters for that tune, e.g. {"synco_prob": 0.7})
+    :param render_kwargs: render_score parameters for all the tunes (selected_instrument, synco_prob...)
+    :return: output_file
+    """
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension in [".mid", ".midi"]:
+        medley_writer = MidiMedleyWriter(output_file)
+    elif extension in [".xml", ".musicxml"]:
+        medley_writer = MusicXmlMedleyWriter(output_file, title=title)
+    else:
+        raise ValueError(f"Unknown medley format {extension}: it should be .mid, .midi, .xml or .musicxml")
+
+    with medley_writer:
+        for playlist_item in playlist:
+            if isinstance(playlist_item, str):
+                selected_file, tune_kwargs = playlist_item, {}
+            else:
+                selected_file, tune_kwargs = playlist_item
+
+            print(f"Adding {selected_file} to the medley")
+            score = render_score(selected_file, folder=folder, **{**render_kwargs, **tune_kwargs})
+
+            tune_title = selected_file.split("/")[-1].strip(".xml")
+            tune_quarters = prepare_medley_score(score, tune_title)
+
+            if isinstance(medley_writer, MidiMedleyWriter):
+                medley_writer.add_score(score, tune_quarters)
+            else:
+                medley_writer.add_score(score)
+
+            del score
+            gc.collect()
+
+    return output_file
+
+
+if __name__ == "__main__":
+
+    folder = "./Omnibook"
+    playlist = sorted([xml_file for xml_file in os.listdir(folder) if xml_file.endswith(".xml")])
+
+    render_medley(playlist, "medley.mid", folder=folder)
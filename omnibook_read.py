@@ -1,5 +1,7 @@
 import os
+from collections import OrderedDict
 
+import numpy as np
 import music21 as m21
 from m21_musescore import M21_and_show
 
@@ -20,9 +22,18 @@ chord_type_map_dict = {
 }
 
 
-def chords_and_m21melody(omni_file):
+# keys found by score.analyze for the least recently read tunes: (file path, modification time) -> music21 key
+MAX_CACHED_KEYS = 64
+_key_cache = OrderedDict()
+
+
+def chords_and_m21melody(omni_file, quantize=True, analyze_key=True):
+    """
+    :param quantize: snap the melody to the admitted durations (see quantize_melody)
+    :param analyze_key: find the key with score.analyze if it is not cached (see tune_key)
+    """
     score = m21.converter.parse(omni_file)
-    key = score.analyze("key")
+    key = tune_key(omni_file, score, analyze=analyze_key)
 
     part = score.parts[0]
     m0 = part.getElementsByClass(m21.stream.Measure)[0] # measure 0
@@ -52,6 +63,13 @@ def chords_and_m21melody(omni_file):
             chords_omni.append((chord_name, int(element.offset)))
             # print("CHORD", chord_name, element.offset)
 
+    if quantize:
+        melody, report = quantize_melody(melody)
+        if report["n_changed"] > 0:
+            print(f"Quantized {report['n_changed']} of {report['n_figures']} melody figures "
+                  f"({report['n_dropped']} dropped, {report['n_split']} split), onset error "
+                  f"mean {report['mean_onset_error']:.3f} max {report['max_onset_error']:.3f} beats")
+
     chord_types = []
     chord_progression = []
     for chord_pos, (chord_name_omni, chord_offset) in enumerate(chords_omni):
@@ -83,6 +101,331 @@ def chords_and_m21melody(omni_file):
     return chord_progression, melody, chord_types, key, tempo
 
 
+def _key_cache_key(omni_file):
+
+    return os.path.abspath(omni_file), os.path.getmtime(omni_file)
+
+
+def has_cached_key(omni_file):
+
+    return _key_cache_key(omni_file) in _key_cache
+
+
+def tune_key(omni_file, score, analyze=True):
+    """
+    Key of a lead-sheet, found by score.analyze once per file (until the file is modified, for the
+    MAX_CACHED_KEYS least recently used files).
+    Without analyze, a key which is not cached is read from the first key signature of the score instead
+    (None if there is none), which is much faster but ignores the mode.
+    """
+    cache_key = _key_cache_key(omni_file)
+
+    key = _key_cache.get(cache_key)
+    if key is not None:
+        _key_cache.move_to_end(cache_key)
+    elif analyze:
+        key = score.analyze("key")
+        _key_cache[cache_key] = key
+        if len(_key_cache) > MAX_CACHED_KEYS:
+            _key_cache.popitem(last=False)
+    else:
+        key_signatures = score.flatten().getElementsByClass(m21.key.KeySignature)
+        key = key_signatures[0].asKey() if key_signatures else None
+
+    return key
+
+
+TICKS_PER_BEAT = 12  # all the admitted durations are whole ticks
+ADMITTED_TICKS = {round(admitted_duration * TICKS_PER_BEAT) for admitted_duration in admitted_durations}
+
+# subdivisions of a beat of the quantization grids: sixteenths, sextuplets (eighth and sixteenth triplets)
+BEAT_GRIDS = np.array([4, 6])
+
+# admitted pieces, in ticks, of a duration which is split: whole beats, then within a beat for each grid
+WHOLE_BEAT_PIECES = [48, 36, 24, 12]
+BEAT_GRID_PIECES = {4: [9, 6, 3], 6: [8, 6, 4, 2]}
+
+
+def quantize_melody(melody):
+    """
+    Snaps the onsets of a melody to a grid and makes all its durations admitted_durations, so that
+    odd tuplets (e.g. quintuplets) and rounding drift never reach the score.
+
+    The onsets (cumulative offsets) are snapped in one vectorized pass: each beat takes the grid
+    (sixteenths or sextuplets) with the smallest error for its onsets, and the durations are the
+    differences of the snapped onsets, in integer ticks, so that the bar totals stay exact.
+    Figures whose duration becomes 0 are dropped, and the durations which are not admitted
+    (e.g. a quarter and a sixteenth) are split into tied admitted durations.
+    The figures are modified in place (only the ones whose duration changes).
+
+    :param melody: list of music21 notes and rests
+    :return: quantized_melody: list of music21 notes and rests
+    :return: report: dict with the number of notes, changed, dropped and split figures, the mean and
+        maximum onset errors (in beats), the number of beats on the sextuplet grid and the number
+        of durations which were not admitted
+    """
+    durations = np.array([float(melody_fig.duration.quarterLength) for melody_fig in melody])
+    is_grace = durations == 0
+
+    # the end of the melody is snapped as the onset of a virtual last figure
+    onsets = np.concatenate([[0.0], np.cumsum(durations)])
+    beats = np.floor(onsets + 1e-6).astype(int)
+    beat_fractions = onsets - beats
+
+    # error of each onset on each grid, summed per beat
+    grid_steps = np.round(beat_fractions[:, None] * BEAT_GRIDS)
+    grid_errors = np.abs(grid_steps / BEAT_GRIDS - beat_fractions[:, None])
+    beat_errors = np.zeros((beats[-1] + 1, len(BEAT_GRIDS)))
+    np.add.at(beat_errors, beats, grid_errors)
+    beat_grids = np.argmin(beat_errors, axis=1)  # ties: sixteenths
+
+    onset_grids = beat_grids[beats]
+    onset_ticks = beats * TICKS_PER_BEAT + \
+        grid_steps[np.arange(len(onsets)), onset_grids].astype(int) * (TICKS_PER_BEAT // BEAT_GRIDS[onset_grids])
+    duration_ticks = np.diff(onset_ticks)
+    onset_errors = np.abs(onset_ticks / TICKS_PER_BEAT - onsets)
+
+    original_ticks = np.round(durations * TICKS_PER_BEAT)
+    is_whole_ticks = np.abs(durations * TICKS_PER_BEAT - original_ticks) < 1e-6
+    duration_changed = (duration_ticks != original_ticks) | ~is_whole_ticks
+    is_admitted = np.isin(duration_ticks, list(ADMITTED_TICKS))
+    is_dropped = (duration_ticks == 0) & ~is_grace
+
+    quantized_melody = []
+    n_split = 0
+    for melody_fig, fig_onset_ticks, fig_duration_ticks, changed, admitted, dropped, grace in zip(
+            melody, onset_ticks[:-1], duration_ticks, duration_changed, is_admitted, is_dropped, is_grace):
+        if grace or not (changed or dropped or not admitted):
+            quantized_melody.append(melody_fig)
+        elif dropped:
+            continue
+        elif admitted:
+            melody_fig.duration.quarterLength = m21.common.opFrac(fig_duration_ticks / TICKS_PER_BEAT)
+            quantized_melody.append(melody_fig)
+        else:
+            quantized_melody.extend(_split_melody_fig(melody_fig, int(fig_onset_ticks), int(fig_duration_ticks)))
+            n_split += 1
+
+    report = {
+        "n_figures": len(melody),
+        "n_changed": int((duration_changed & ~is_grace).sum()),
+        "n_dropped": int(is_dropped.sum()),
+        "n_split": n_split,
+        "mean_onset_error": float(onset_errors.mean()),
+        "max_onset_error": float(onset_errors.max()),
+        "n_sextuplet_beats": int((beat_grids == 1).sum()),
+        "n_non_admitted": int((~(np.isin(original_ticks, list(ADMITTED_TICKS)) & is_whole_ticks) & ~is_grace).sum()),
+    }
+
+    return quantized_melody, report
+
+
+def _split_melody_fig(melody_fig, onset_ticks, duration_ticks):
+    """
+    Splits a figure into tied figures of admitted durations: the part up to the next beat,
+    whole beats, then the part in the last beat
+    """
+    piece_ticks = []
+    position = onset_ticks
+    end = onset_ticks + duration_ticks
+    while position < end:
+        if position % TICKS_PER_BEAT != 0:
+            in_beat_ticks = min(end, position - position % TICKS_PER_BEAT + TICKS_PER_BEAT) - position
+        elif end - position >= TICKS_PER_BEAT:
+            in_beat_ticks = 0
+            for whole_beat_ticks in WHOLE_BEAT_PIECES:
+                while end - position >= whole_beat_ticks:
+                    piece_ticks.append(whole_beat_ticks)
+                    position += whole_beat_ticks
+        else:
+            in_beat_ticks = end - position
+
+        grid = 4 if in_beat_ticks % 3 == 0 else 6
+        for grid_piece_ticks in BEAT_GRID_PIECES[grid]:
+            while in_beat_ticks >= grid_piece_ticks:
+                piece_ticks.append(grid_piece_ticks)
+                in_beat_ticks -= grid_piece_ticks
+                position += grid_piece_ticks
+        if in_beat_ticks > 0:
+            # not on the grids of the beat (not expected): kept as it is
+            piece_ticks.append(in_beat_ticks)
+            position += in_beat_ticks
+
+    pieces = [melody_fig] + [_copy_melody_fig(melody_fig) for _ in piece_ticks[1:]]
+    for piece, ticks in zip(pieces, piece_ticks):
+        piece.duration.quarterLength = m21.common.opFrac(ticks / TICKS_PER_BEAT)
+
+    if melody_fig.isNote and len(pieces) > 1:
+        # the pieces keep the tie of the figure with its neighbours
+        first_tie = "start" if melody_fig.tie is None or melody_fig.tie.type == "start" else "continue"
+        last_tie = "stop" if melody_fig.tie is None or melody_fig.tie.type == "stop" else "continue"
+        for piece_idx, piece in enumerate(pieces):
+            tie_type = first_tie if piece_idx == 0 else (last_tie if piece_idx == len(pieces) - 1 else "continue")
+            piece.tie = m21.tie.Tie(tie_type)
+
+    return pieces
+
+
+# melody onset grids of the least recently parsed tunes: (file path, modification time, pattern length) -> grid
+MAX_MELODY_GRIDS = 64
+_melody_grid_cache = OrderedDict()
+
+
+def melody_onset_grid(melody, pattern_length):
+    """
+    Onsets and accents of a melody on a grid of eighths (2 per beat), in one vectorized pass over
+    the melody offsets. The melody figures are laid out one after another from offset 0, as in the score.
+    A note starts on the second eighth of a beat if it starts on the "and" (straight or swing).
+
+    Accent of a note (0 to 3), one point each for:
+        - a long note (a beat or more)
+        - an anticipation (starts off the beat and lasts over the next beat)
+        - a melodic peak (higher than the previous and the next notes)
+
+    :param melody: list of music21 notes and rests
+    :param pattern_length: length of the tune in beats
+    :return: dict of np.ndarray:
+        - "eighth_onsets": bool (2 * pattern_length,)
+        - "eighth_accents": int8 (2 * pattern_length,), highest accent of the notes starting on each eighth
+        - "beat_onsets": bool (pattern_length,)
+        - "beat_accents": int8 (pattern_length,)
+    """
+    durations = np.array([float(melody_fig.duration.quarterLength) for melody_fig in melody])
+    is_note = np.array([melody_fig.isNote for melody_fig in melody], dtype=bool)
+    is_onset = np.array([melody_fig.isNote and (melody_fig.tie is None or melody_fig.tie.type == "start")
+                         for melody_fig in melody], dtype=bool)
+    pitches = np.array([melody_fig.pitch.midi if melody_fig.isNote else -1 for melody_fig in melody], dtype=int)
+
+    offsets = np.cumsum(durations) - durations
+
+    # a tied note lasts as long as the whole tie
+    note_idxs = np.cumsum(is_onset) - 1
+    onset_durations = np.zeros(is_onset.sum())
+    np.add.at(onset_durations, note_idxs[is_note & (note_idxs >= 0)], durations[is_note & (note_idxs >= 0)])
+
+    onset_offsets = offsets[is_onset]
+    onset_pitches = pitches[is_onset]
+
+    is_long = onset_durations >= 1
+    is_anticipation = (onset_offsets % 1 > 1e-6) & (onset_offsets + onset_durations > np.ceil(onset_offsets) + 1e-6)
+    padded_pitches = np.pad(onset_pitches, 1, constant_values=np.iinfo(int).max)
+    is_peak = (onset_pitches > padded_pitches[:-2]) & (onset_pitches > padded_pitches[2:])
+    accents = is_long.astype(np.int8) + is_anticipation + is_peak
+
+    eighths = np.floor(onset_offsets * 2 + 1e-6).astype(int)
+    in_pattern = eighths < 2 * pattern_length
+
+    eighth_onsets = np.zeros(2 * pattern_length, dtype=bool)
+    eighth_onsets[eighths[in_pattern]] = True
+    eighth_accents = np.zeros(2 * pattern_length, dtype=np.int8)
+    np.maximum.at(eighth_accents, eighths[in_pattern], accents[in_pattern].astype(np.int8))
+
+    return {
+        "eighth_onsets": eighth_onsets,
+        "eighth_accents": eighth_accents,
+        "beat_onsets": eighth_onsets.reshape(pattern_length, 2).any(axis=1),
+        "beat_accents": eighth_accents.reshape(pattern_length, 2).max(axis=1, initial=0),
+    }
+
+
+def tune_melody_grid(omni_file, melody, pattern_length):
+    """
+    Melody onset grid of a parsed tune (see melody_onset_grid), cached per file
+    until the file is modified, for the MAX_MELODY_GRIDS least recently used tunes
+    """
+    cache_key = (os.path.abspath(omni_file), os.path.getmtime(omni_file), pattern_length)
+
+    melody_grid = _melody_grid_cache.get(cache_key)
+    if melody_grid is None:
+        melody_grid = melody_onset_grid(melody, pattern_length)
+        _melody_grid_cache[cache_key] = melody_grid
+        if len(_melody_grid_cache) > MAX_MELODY_GRIDS:
+            _melody_grid_cache.popitem(last=False)
+    else:
+        _melody_grid_cache.move_to_end(cache_key)
+
+    return melody_grid
+
+
+def repeat_melody(melody, pattern_length, choruses):
+    """
+    Melody of several choruses of the form: the melody of a chorus, padded with a rest up to the length
+    of the form (or cut at it, e.g. when the last chord is held longer than its assumed 4 beats), then copies
+    of it for the next choruses (a music21 object can only be once in a score)
+
+    :param melody: list of music21 notes and rests of one chorus
+    :param pattern_length: length of the form in beats
+    :return: list of music21 notes and rests
+    """
+    if choruses == 1:
+        return list(melody)
+
+    melody_duration = sum(float(melody_fig.duration.quarterLength) for melody_fig in melody)
+    # durations of the melody are multiples of 1/12 beat
+    padding = round((pattern_length - melody_duration) * 12) / 12
+
+    chorus_melody = list(melody)
+    if padding > 0:
+        chorus_melody.append(m21.note.Rest(quarterLength=m21.common.opFrac(padding)))
+    elif padding < 0:
+        chorus_melody = _cut_melody(chorus_melody, pattern_length)
+
+    repeated_melody = chorus_melody + [_copy_melody_fig(melody_fig)
+                                       for _ in range(choruses - 1) for melody_fig in chorus_melody]
+
+    repeated_duration = m21.common.opFrac(sum(melody_fig.duration.quarterLength for melody_fig in repeated_melody))
+    assert repeated_duration == pattern_length * choruses, \
+        f"Melody of {repeated_duration} beats for {choruses} choruses of {pattern_length} beats"
+
+    return repeated_melody
+
+
+def _cut_melody(melody, pattern_length):
+    """
+    Melody figures up to pattern_length beats; the figure across it is split, and only its first part kept
+    """
+    cut_melody = []
+    offset = 0
+    for melody_fig in melody:
+        fig_end = m21.common.opFrac(offset + melody_fig.duration.quarterLength)
+        if fig_end > pattern_length:
+            first_part = _copy_melody_fig(melody_fig)
+            first_part.duration.quarterLength = m21.common.opFrac(pattern_length - offset)
+            if first_part.tie is not None and first_part.tie.type in ("continue", "stop"):
+                first_part.tie = m21.tie.Tie("stop")
+            else:
+                first_part.tie = None
+            cut_melody.append(first_part)
+            break
+        cut_melody.append(melody_fig)
+        offset = fig_end
+        if offset == pattern_length:
+            break
+
+    return cut_melody
+
+
+def _copy_melody_fig(melody_fig):
+    """
+    New note or rest with the pitch, duration and tie of a melody figure (much faster than a deepcopy)
+    """
+    if not melody_fig.isNote:
+        return m21.note.Rest(quarterLength=melody_fig.duration.quarterLength)
+
+    new_fig = m21.note.Note(melody_fig.pitch.nameWithOctave, quarterLength=melody_fig.duration.quarterLength)
+    if melody_fig.tie is not None:
+        new_fig.tie = m21.tie.Tie(melody_fig.tie.type)
+
+    return new_fig
+
+
+def tile_melody_grid(melody_grid, choruses):
+    """
+    Melody onset grid of several choruses, from the grid of one chorus (see melody_onset_grid)
+    """
+    return {grid_name: np.tile(grid, choruses) for grid_name, grid in melody_grid.items()}
+
+
 def chords_and_melody_all(files_path):
 
     chord_types_all = set()
@@ -1,8 +1,13 @@
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
 
 import numpy as np
 import music21 as m21
 
+from render_memory import stage_context
+
 CHORD_SPLIT = ":"
 MEASURE_DURATION = 4
 
@@ -17,6 +22,69 @@ melody_m21instruments = [
 
 melody_instruments_d = {instr().instrumentName: instr for instr in melody_m21instruments}
 
+# executors of the concurrent part construction, reused across scores: (mode, max_workers) -> executor
+_part_executors = {}
+
+
+def _part_executor(parallel_parts, max_workers):
+
+    executor = _part_executors.get((parallel_parts, max_workers))
+    if executor is None:
+        if parallel_parts == "threads":
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        elif parallel_parts == "processes":
+            executor = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            raise ValueError(f"Unknown parallel_parts {parallel_parts} (threads or processes)")
+        _part_executors[(parallel_parts, max_workers)] = executor
+
+    return executor
+
+
+def _build_part(converter, method_name, args):
+    """
+    Builds a part in a worker thread
+
+    :return: part, build time
+    """
+    start_time = time.perf_counter()
+    part = getattr(converter, method_name)(*args)
+
+    return part, time.perf_counter() - start_time
+
+
+def _build_pickled_part(part_job_bytes):
+    """
+    Builds a part in a worker process, from its pickled job (converter, method name, arguments)
+
+    :return: pickled part, and the unpickling, build and pickling times
+    """
+    start_time = time.perf_counter()
+    converter, method_name, args = pickle.loads(part_job_bytes)
+    loaded_time = time.perf_counter()
+    part = getattr(converter, method_name)(*args)
+    built_time = time.perf_counter()
+    part_bytes = pickle.dumps(part, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return part_bytes, loaded_time - start_time, built_time - loaded_time, time.perf_counter() - built_time
+
+
+def measure_window(measures, pattern_length):
+    """
+    Beats of a window of measures
+
+    :param measures: (first, last) measure numbers, from 1, last included; last None (or 0) is the last measure
+    :param pattern_length: length of the tune in beats
+    :return: start_beat, end_beat (excluded)
+    """
+    first_measure, last_measure = measures
+    n_measures = int(np.ceil(pattern_length / MEASURE_DURATION))
+    last_measure = last_measure or n_measures
+    if not 1 <= first_measure <= min(last_measure, n_measures):
+        raise ValueError(f"Invalid measures {first_measure} to {last_measure} (tune of {n_measures} measures)")
+
+    return (first_measure - 1) * MEASURE_DURATION, min(last_measure * MEASURE_DURATION, pattern_length)
+
 
 class PitchedInstruments(Enum):
     # MELODY = 0
@@ -71,6 +139,10 @@ class PatternMusic21Converter:
                          score_title="Jazz Music generated by Bill Aivans",
                          melody_instrument=melody_m21instruments[0](),
                          octave_up_down=0,
+                         memory_profiler=None,
+                         parallel_parts=None,
+                         max_workers=None,
+                         measures=None,
                          ):
         """
         TODO: update
@@ -90,10 +162,31 @@ class PatternMusic21Converter:
 
             melody_instrument
 
+            memory_profiler: optional render_memory.RenderMemoryProfiler, which records memory
+                of the melody, chord, bass and drum parts construction
+
+            parallel_parts: None (one part after another), "threads" or "processes": the parts are
+                built concurrently by a pool of max_workers, and appended to the score in the same order.
+                With processes, the inputs and the parts are pickled; the time spent is reported
+                in self.parallel_report (see _build_parts_concurrently)
+
+            measures: (first, last) measure numbers of a window to convert (see measure_window), or None
+                for the whole pattern. The state, chords, bass and melody are sliced to the window, so that
+                the work is proportional to its length; the figures which start before the window are tied
+                into it, and the key signature and tempo are set at its start
+
         Returns:
             music21.stream.Score: The music21 score representation of the drum
                 pattern.
         """
+        first_measure = 1
+        if measures is not None:
+            start_beat, end_beat = measure_window(measures, len(state[0]))
+            first_measure = start_beat // MEASURE_DURATION + 1
+            score_title += f" (measures {first_measure}-{(end_beat - 1) // MEASURE_DURATION + 1})"
+            state, melody, m21_chord_progression, m21_bass_line = self._window(
+                state, melody, m21_chord_progression, m21_bass_line, start_beat, end_beat)
+
         score = m21.stream.Score()
         score.metadata = m21.metadata.Metadata(
             title=score_title
@@ -101,31 +194,49 @@ class PatternMusic21Converter:
 
         pattern_length = len(state[0])
 
-        if not self.is_m21melody:
-            melody_part = self._melody_instrument_to_music21_part(
-                melody, state, melody_instrument, octave_up_down,
+        if parallel_parts is not None:
+            with stage_context(memory_profiler, "parts"):
+                part_jobs = self._part_jobs(state, melody, m21_chord_progression, m21_bass_line,
+                                            melody_instrument, octave_up_down)
+                for part in self._build_parts_concurrently(part_jobs, parallel_parts, max_workers):
+                    score.append(part)
+
+            return self._complete_measures(score, first_measure)
+
+        with stage_context(memory_profiler, "melody_part"):
+            if not self.is_m21melody:
+                melody_part = self._melody_instrument_to_music21_part(
+                    melody, state, melody_instrument, octave_up_down,
+                )
+            else:
+                melody_part = self._m21melody_instrument_to_music21_part(
+                    melody, melody_instrument, octave_up_down,
+                )
+            score.append(melody_part)
+
+        with stage_context(memory_profiler, "chord_part"):
+            chord_part = self._chord_instrument_to_music21_part(
+                    m21_chord_progression, state
             )
-        else:
-            melody_part = self._m21melody_instrument_to_music21_part(
-                melody, melody_instrument, octave_up_down,
+            score.append(chord_part)
+
+        with stage_context(memory_profiler, "bass_part"):
+            bass_part = self._bass_instrument_to_music21_part(
+                    m21_bass_line, state
             )
-        score.append(melody_part)
+            score.append(bass_part)
 
-        chord_part = self._chord_instrument_to_music21_part(
-                m21_chord_progression, state
-        )
-        score.append(chord_part)
+        with stage_context(memory_profiler, "drum_parts"):
+            for drum_instrument in DrumInstruments:
+                part = self._drum_instrument_to_music21_part(
+                    drum_instrument, state, pattern_length
+                )
+                score.append(part)
 
-        bass_part = self._bass_instrument_to_music21_part(
-                m21_bass_line, state
-        )
-        score.append(bass_part)
+        return self._complete_measures(score, first_measure)
 
-        for drum_instrument in DrumInstruments:
-            part = self._drum_instrument_to_music21_part(
-                drum_instrument, state, pattern_length
-            )
-            score.append(part)
+    @staticmethod
+    def _complete_measures(score, first_measure=1):
 
         max_measures = max([len(part.getElementsByClass(m21.stream.Measure)) for part in score.parts])
         for part in score.parts:
@@ -134,8 +245,193 @@ class PatternMusic21Converter:
                 last_measure = m21.stream.Measure()
                 part.append(last_measure)
 
+            # measures of a window keep their numbers in the tune
+            if first_measure != 1:
+                for measure_idx, measure in enumerate(part.getElementsByClass(m21.stream.Measure)):
+                    measure.number = first_measure + measure_idx
+
+        return score
+
+    def update_measures(self, score, state, m21_chord_progression, m21_bass_line, measure_idxs):
+        """
+        Builds again some measures of the chord, bass and drum parts of a score of the whole pattern
+        (see to_music21_score), e.g. after a chord edit, and replaces them in the score. The melody part is kept.
+
+        Each measure is built from its beats and the first beat of the next measure, so that its figures
+        get the same ties as in the score of the whole pattern.
+
+        Parameters:
+            score (music21.stream.Score): score built by to_music21_score (without measures)
+            measure_idxs (iterable): indices of the measures, from 0
+        """
+        pattern_length = len(state[0])
+        beats_per_measure = int(MEASURE_DURATION / self.BEAT_DURATION)
+        parts = list(score.parts)[1:]
+
+        for measure_idx in sorted(set(measure_idxs)):
+            start_beat = measure_idx * beats_per_measure
+            end_beat = min(start_beat + beats_per_measure, pattern_length)
+            tie_end_beat = min(end_beat + 1, pattern_length)
+
+            # the key signature is only in the first measure
+            measure_converter = self if measure_idx == 0 else \
+                PatternMusic21Converter(is_m21melody=self.is_m21melody, tempo=self.tempo)
+
+            measure_parts = [
+                measure_converter._chord_instrument_to_music21_part(
+                    m21_chord_progression[start_beat:tie_end_beat], state[:, start_beat:tie_end_beat]),
+                measure_converter._bass_instrument_to_music21_part(
+                    m21_bass_line[start_beat:tie_end_beat], state[:, start_beat:tie_end_beat]),
+            ]
+            for drum_instrument in DrumInstruments:
+                measure_parts.append(measure_converter._drum_instrument_to_music21_part(
+                    drum_instrument, state[:, start_beat:end_beat], end_beat - start_beat))
+
+            for part, measure_part in zip(parts, measure_parts):
+                old_measure = part.getElementsByClass(m21.stream.Measure)[measure_idx]
+                new_measure = measure_part.getElementsByClass(m21.stream.Measure)[0]
+                new_measure.number = old_measure.number
+                part.replace(old_measure, new_measure)
+
         return score
 
+    def _window(self, state, melody, m21_chord_progression, m21_bass_line, start_beat, end_beat):
+        """
+        State, melody, chords and bass of the beats [start_beat, end_beat).
+
+        The melody figures are laid out one after another from offset 0; the figures across the window limits
+        are split, and a figure which starts before the window is tied into it. A chord or bass note
+        tied from the beat before the window gets a tie stop.
+
+        :return: state, melody, m21_chord_progression, m21_bass_line of the window
+        """
+        m21_chord_progression = list(m21_chord_progression[start_beat:end_beat])
+        m21_bass_line = list(m21_bass_line[start_beat:end_beat])
+
+        # ties into the first beat, unless it starts with a rest
+        if start_beat > 0:
+            chord_states = state[PitchedInstruments.CHORD.value, start_beat - 1:start_beat + 1]
+            if chord_states[0] in (States.FILL_0_1.value, States.FILL_1_T.value) and \
+                    chord_states[1] != States.FILL_0_1.value:
+                m21_chord_progression[0] = self._tied_copy(m21_chord_progression[0])
+            bass_states = state[PitchedInstruments.BASS.value, start_beat - 1:start_beat + 1]
+            if bass_states[0] == States.FILL_0_1.value and bass_states[1] != States.FILL_0_1.value:
+                m21_bass_line[0] = self._tied_copy(m21_bass_line[0])
+
+        state = state[:, start_beat:end_beat]
+
+        window_melody = []
+        offset = 0
+        for melody_fig in melody:
+            if offset >= end_beat:
+                break
+
+            # exact offsets (music21 quarter lengths are fractions for tuplets)
+            fig_duration = melody_fig.duration.quarterLength if self.is_m21melody else melody_fig[1]
+            fig_end = m21.common.opFrac(offset + fig_duration)
+            if fig_end > start_beat:
+                if offset < start_beat:
+                    melody_fig = self._split_melody_fig(melody_fig, m21.common.opFrac(start_beat - offset))[1]
+                if fig_end > end_beat:
+                    melody_fig = self._split_melody_fig(melody_fig, m21.common.opFrac(end_beat - max(offset, start_beat)))[0]
+                window_melody.append(melody_fig)
+
+            offset = fig_end
+
+        return state, window_melody, m21_chord_progression, m21_bass_line
+
+    def _split_melody_fig(self, melody_fig, quarter_length):
+        """
+        Figure split at a quarter length: music21 figures are tied, (name, duration) figures are cut
+        """
+        if self.is_m21melody:
+            return melody_fig.splitAtQuarterLength(quarter_length)
+        fig_name, fig_duration = melody_fig
+        return (fig_name, quarter_length), (fig_name, fig_duration - quarter_length)
+
+    @staticmethod
+    def _tied_copy(m21_figure):
+        """
+        Copy of a chord or note tied from the previous one (the figures may be shared between choruses)
+        """
+        if isinstance(m21_figure, m21.chord.Chord):
+            tied_figure = m21.chord.Chord(m21_figure.pitches, quarterLength=m21_figure.quarterLength)
+            tied_figure.insertLyric(m21_figure.lyric)
+        else:
+            tied_figure = m21.note.Note(m21_figure.pitch, quarterLength=m21_figure.quarterLength)
+        tied_figure.tie = m21.tie.Tie("stop")
+        return tied_figure
+
+    def _part_jobs(self, state, melody, m21_chord_progression, m21_bass_line, melody_instrument, octave_up_down):
+        """
+        Method name and arguments of the construction of each part, in the order of the score
+        """
+        if not self.is_m21melody:
+            melody_job = ("_melody_instrument_to_music21_part", (melody, state, melody_instrument, octave_up_down))
+        else:
+            melody_job = ("_m21melody_instrument_to_music21_part", (melody, melody_instrument, octave_up_down))
+
+        part_jobs = [
+            melody_job,
+            ("_chord_instrument_to_music21_part", (m21_chord_progression, state)),
+            ("_bass_instrument_to_music21_part", (m21_bass_line, state)),
+        ]
+        for drum_instrument in DrumInstruments:
+            part_jobs.append(("_drum_instrument_to_music21_part", (drum_instrument, state, len(state[0]))))
+
+        return part_jobs
+
+    def _build_parts_concurrently(self, part_jobs, parallel_parts, max_workers=None):
+        """
+        Builds the parts in a pool of threads or processes.
+
+        The time spent is stored in self.parallel_report (seconds):
+            - "wall": construction of all the parts
+            - "build": sum of the construction times of the parts in the workers
+            - "serialize_inputs", "deserialize_inputs": pickling of the jobs (processes only)
+            - "serialize_parts", "deserialize_parts": pickling of the built parts (processes only)
+
+        :return: list of music21.stream.Part, in the order of part_jobs
+        """
+        start_time = time.perf_counter()
+        executor = _part_executor(parallel_parts, max_workers)
+        parallel_report = dict.fromkeys(["wall", "build", "serialize_inputs", "deserialize_inputs",
+                                         "serialize_parts", "deserialize_parts"], 0.0)
+
+        if parallel_parts == "threads":
+            futures = [executor.submit(_build_part, self, method_name, args) for method_name, args in part_jobs]
+            parts = []
+            for future in futures:
+                part, build_time = future.result()
+                parts.append(part)
+                parallel_report["build"] += build_time
+        else:
+            futures = []
+            for method_name, args in part_jobs:
+                serialize_start = time.perf_counter()
+                part_job_bytes = pickle.dumps((self, method_name, args), protocol=pickle.HIGHEST_PROTOCOL)
+                parallel_report["serialize_inputs"] += time.perf_counter() - serialize_start
+                futures.append(executor.submit(_build_pickled_part, part_job_bytes))
+
+            parts = []
+            for future in futures:
+                part_bytes, load_time, build_time, dump_time = future.result()
+                deserialize_start = time.perf_counter()
+                parts.append(pickle.loads(part_bytes))
+                parallel_report["deserialize_parts"] += time.perf_counter() - deserialize_start
+                parallel_report["deserialize_inputs"] += load_time
+                parallel_report["build"] += build_time
+                parallel_report["serialize_parts"] += dump_time
+
+        parallel_report["wall"] = time.perf_counter() - start_time
+        self.parallel_report = parallel_report
+        print(f"Parts built with {parallel_parts} in {parallel_report['wall']:.2f} s (build "
+              f"{parallel_report['build']:.2f} s, serialization "
+              f"{parallel_report['serialize_inputs'] + parallel_report['serialize_parts']:.2f} s, deserialization "
+              f"{parallel_report['deserialize_inputs'] + parallel_report['deserialize_parts']:.2f} s)")
+
+        return parts
+
     def _melody_instrument_to_music21_part(
             self, melody, state, melody_instrument, octave_up_down,
     ):
@@ -281,6 +577,10 @@ class PatternMusic21Converter:
 
             new_chord = m21.chord.Chord(chord.pitches, quarterlength=chord.quarterLength)
             new_chord.insertLyric(chord.lyric)
+            # tied from the beat before a window of measures
+            tied_from_previous = chord.tie is not None
+            if tied_from_previous:
+                new_chord.tie = m21.tie.Tie("stop")
 
             if current_measure.quarterLength + new_chord.quarterLength > 4.0:
                 chord_part.append(current_measure)
@@ -306,7 +606,7 @@ class PatternMusic21Converter:
                 next_chord_pos = chord_pos + 1
                 if next_chord_pos < len(chord_progression):
                     #    next_bass_note = bass_line[next_bass_pos]
-                    new_chord.tie = m21.tie.Tie('start')
+                    new_chord.tie = m21.tie.Tie('continue' if tied_from_previous else 'start')
 
             current_measure.append(new_chord)
 
@@ -331,6 +631,9 @@ class PatternMusic21Converter:
         for bass_pos, bass_note in enumerate(bass_line):
 
             new_bass_note = m21.note.Note(bass_note.pitch)
+            # tied from the beat before a window of measures
+            if bass_note.tie is not None:
+                new_bass_note.tie = m21.tie.Tie("stop")
             if current_measure.quarterLength + bass_note.quarterLength > 4.0:
                 bass_part.append(current_measure)
                 current_measure = m21.stream.Measure()
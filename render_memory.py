@@ -0,0 +1,413 @@
+import gc
+import os
+import resource
+import time
+import tracemalloc
+import multiprocessing as mp
+import queue
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+import music21 as m21
+
+MB = 1024 * 1024
+
+
+class MemoryBudgetExceeded(Exception):
+    """
+    Raised when a render exceeds the memory budget and the budget action is "fail".
+    """
+    pass
+
+
+class MemoryBudget:
+    """
+    Memory budget of a render (or of a batch worker).
+
+    Attributes:
+        peak_mb (float): maximum peak traced memory in MB of any pipeline stage (None: no limit).
+        m21_objects (int): maximum number of live music21 objects after any pipeline stage (None: no limit).
+        action (str): what to do when the budget is exceeded:
+            - "fail": the render fails with MemoryBudgetExceeded
+            - "recycle": the render finishes, then the batch worker is replaced by a new process
+    """
+
+    ACTIONS = ["fail", "recycle"]
+
+    def __init__(self, peak_mb=None, m21_objects=None, action="recycle"):
+        if action not in self.ACTIONS:
+            raise ValueError(f"Unknown budget action {action}, it should be one of {self.ACTIONS}")
+
+        self.peak_mb = peak_mb
+        self.m21_objects = m21_objects
+        self.action = action
+
+    def check(self, peak_mb, m21_objects):
+        """
+        :return: description of the exceeded limits ("" if the budget is not exceeded)
+        """
+        exceeded = []
+        if self.peak_mb is not None and peak_mb > self.peak_mb:
+            exceeded.append(f"peak {peak_mb:.1f} MB > {self.peak_mb} MB")
+        if self.m21_objects is not None and m21_objects > self.m21_objects:
+            exceeded.append(f"{m21_objects} music21 objects > {self.m21_objects}")
+
+        return ", ".join(exceeded)
+
+
+def count_m21_objects():
+    """
+    Number of live music21 objects (notes, chords, measures, parts...) tracked by the garbage collector
+    """
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, m21.base.Music21Object))
+
+
+class RenderMemoryProfiler:
+    """
+    Records peak traced memory (tracemalloc) and live music21 object counts
+    per pipeline stage and per tune.
+
+    Usage:
+        profiler = RenderMemoryProfiler(budget=MemoryBudget(peak_mb=200))
+        score = render_score(selected_file, memory_profiler=profiler)
+        profiler.print_summary()
+
+    Tracing memory slows down the render, so it should only be used to measure.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.tunes = []  # one record (dict) per tune
+        self.recycle_requested = False
+        self._current_tune = None
+
+    @contextmanager
+    def tune(self, tune_name):
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        self._current_tune = {
+            "tune": tune_name,
+            "stages": [],
+            "peak_mb": 0.0,
+            "m21_objects": 0,
+            "max_rss_mb": 0.0,
+            "seconds": 0.0,
+            "exceeded": "",
+        }
+        self.tunes.append(self._current_tune)
+
+        start_time = time.perf_counter()
+        try:
+            yield self._current_tune
+        finally:
+            self._current_tune["seconds"] = time.perf_counter() - start_time
+            # maximum resident set size of the process (kB in Linux)
+            self._current_tune["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            self._current_tune = None
+            if started_tracing:
+                tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, stage_name):
+        if self._current_tune is None:
+            # stage outside a tune, e.g. to_music21_score called directly
+            with self.tune(stage_name):
+                with self.stage(stage_name):
+                    yield
+            return
+
+        tracemalloc.reset_peak()
+        start_mb = tracemalloc.get_traced_memory()[0] / MB
+        start_time = time.perf_counter()
+
+        # a stage which raises is recorded too, so that failed renders report their peaks
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            current_mb, peak_mb = [memory / MB for memory in tracemalloc.get_traced_memory()]
+            m21_objects = count_m21_objects()
+            self._current_tune["stages"].append({
+                "stage": stage_name,
+                "start_mb": start_mb,
+                "current_mb": current_mb,
+                "peak_mb": peak_mb,
+                "m21_objects": m21_objects,
+                "seconds": time.perf_counter() - start_time,
+                "failed": failed,
+            })
+            self._current_tune["peak_mb"] = max(self._current_tune["peak_mb"], peak_mb)
+            self._current_tune["m21_objects"] = max(self._current_tune["m21_objects"], m21_objects)
+
+            # the error of a failed stage is not replaced by MemoryBudgetExceeded
+            self._check_budget(stage_name, peak_mb, m21_objects, raise_exceeded=not failed)
+
+    def _check_budget(self, stage_name, peak_mb, m21_objects, raise_exceeded=True):
+
+        if self.budget is None:
+            return
+
+        exceeded = self.budget.check(peak_mb, m21_objects)
+        if exceeded:
+            message = f"Memory budget exceeded in {self._current_tune['tune']} ({stage_name}): {exceeded}"
+            self._current_tune["exceeded"] = message
+            if self.budget.action == "fail":
+                if raise_exceeded:
+                    raise MemoryBudgetExceeded(message)
+            else:
+                self.recycle_requested = True
+
+    def summary(self):
+        """
+        Batch summary of the recorded tunes
+        """
+        if len(self.tunes) == 0:
+            return {"tunes": 0}
+
+        return summarize(self.tunes)
+
+    def print_summary(self):
+
+        for tune_record in self.tunes:
+            print_tune_record(tune_record)
+
+        print_batch_summary(self.summary())
+
+
+def tune_context(memory_profiler, tune_name):
+    """
+    memory_profiler.tune(tune_name), or nothing if there is no profiler
+    """
+    if memory_profiler is None:
+        return nullcontext()
+    return memory_profiler.tune(tune_name)
+
+
+def stage_context(memory_profiler, stage_name):
+    """
+    memory_profiler.stage(stage_name), or nothing if there is no profiler
+    """
+    if memory_profiler is None:
+        return nullcontext()
+    return memory_profiler.stage(stage_name)
+
+
+def summarize(tune_records):
+
+    stage_peaks = {}
+    for tune_record in tune_records:
+        for stage_record in tune_record["stages"]:
+            stage_name = stage_record["stage"]
+            stage_peaks[stage_name] = max(stage_peaks.get(stage_name, 0.0), stage_record["peak_mb"])
+
+    return {
+        "tunes": len(tune_records),
+        "failed": sum(1 for tune_record in tune_records if tune_record.get("error")),
+        "over_budget": sum(1 for tune_record in tune_records if tune_record["exceeded"]),
+        "max_peak_mb": max(tune_record["peak_mb"] for tune_record in tune_records),
+        "mean_peak_mb": sum(tune_record["peak_mb"] for tune_record in tune_records) / len(tune_records),
+        "max_m21_objects": max(tune_record["m21_objects"] for tune_record in tune_records),
+        "max_rss_mb": max(tune_record["max_rss_mb"] for tune_record in tune_records),
+        "seconds": sum(tune_record["seconds"] for tune_record in tune_records),
+        "stage_peak_mb": stage_peaks,
+    }
+
+
+def print_tune_record(tune_record):
+
+    print(f"{tune_record['tune']}: peak {tune_record['peak_mb']:.1f} MB, "
+          f"{tune_record['m21_objects']} music21 objects, max RSS {tune_record['max_rss_mb']:.1f} MB, "
+          f"{tune_record['seconds']:.2f} s")
+    for stage_record in tune_record["stages"]:
+        print(f"    {stage_record['stage']:<20} peak {stage_record['peak_mb']:8.1f} MB"
+              f"  current {stage_record['current_mb']:8.1f} MB  {stage_record['m21_objects']:8d} music21 objects"
+              f"  {stage_record['seconds']:.2f} s" + ("  (failed)" if stage_record.get("failed") else ""))
+    if tune_record["exceeded"]:
+        print("    " + tune_record["exceeded"])
+    if tune_record.get("error"):
+        print("    Error: " + tune_record["error"])
+
+
+def print_batch_summary(summary):
+
+    if summary["tunes"] == 0:
+        print("No tunes rendered")
+        return
+
+    print(f"{summary['tunes']} tunes ({summary['failed']} failed, {summary['over_budget']} over budget) "
+          f"in {summary['seconds']:.1f} s")
+    print(f"Peak traced memory: max {summary['max_peak_mb']:.1f} MB, mean {summary['mean_peak_mb']:.1f} MB; "
+          f"max {summary['max_m21_objects']} music21 objects; max RSS {summary['max_rss_mb']:.1f} MB")
+    for stage_name, peak_mb in summary["stage_peak_mb"].items():
+        print(f"    {stage_name:<20} max peak {peak_mb:8.1f} MB")
+
+
+def _empty_tune_record(selected_file):
+
+    return {"tune": selected_file, "stages": [], "peak_mb": 0.0, "m21_objects": 0,
+            "max_rss_mb": 0.0, "seconds": 0.0, "exceeded": ""}
+
+
+def _batch_worker(task_queue, result_queue, budget, render_kwargs, output_folder):
+    """
+    Renders the tunes handed out in its task_queue until it gets None or the memory budget asks for recycling
+    """
+    from cellularautomaton_gradio import render_score
+
+    memory_profiler = RenderMemoryProfiler(budget=budget)
+
+    while True:
+        selected_file = task_queue.get()
+        if selected_file is None:
+            break
+
+        result_queue.put(("started", os.getpid(), selected_file, None))
+
+        n_tunes = len(memory_profiler.tunes)
+        error = ""
+        try:
+            score = render_score(selected_file, memory_profiler=memory_profiler, **render_kwargs)
+            if output_folder is not None:
+                tune_name = selected_file.split("/")[-1].strip(".xml")
+                score.write("midi", fp=os.path.join(output_folder, tune_name + ".mid"))
+            del score
+        except MemoryBudgetExceeded as e:
+            error = str(e)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+
+        if len(memory_profiler.tunes) > n_tunes:
+            tune_record = memory_profiler.tunes[-1]
+        else: # failed before the tune started
+            tune_record = _empty_tune_record(selected_file)
+        tune_record["error"] = error
+
+        gc.collect()
+
+        recycle = memory_profiler.recycle_requested
+        result_queue.put(("recycled" if recycle else "done", os.getpid(), selected_file, tune_record))
+        if recycle:
+            break
+
+
+def render_batch(selected_files, folder="./Omnibook", budget=None, n_workers=1, output_folder=None,
+                 print_summary=True, **render_kwargs):
+    """
+    Renders a batch of tunes in worker processes, recording memory per stage and per tune.
+    A worker which exceeds a "recycle" budget is replaced by a new process after finishing its render;
+    with a "fail" budget the render fails cleanly and the worker continues with the next tune.
+    A worker killed during a render (e.g. by the OOM killer) fails that tune and is replaced too, as is
+    a worker which died while idle. Tunes are handed out one at a time to live workers, so none is lost.
+
+    :param selected_files: list of lead-sheet file names in folder
+    :param budget: optional MemoryBudget
+    :param n_workers: number of worker processes
+    :param output_folder: if given, the MIDI file of each render is written there
+    :param render_kwargs: other render_score parameters (selected_instrument, synco_prob...)
+    :return: (list of tune records, batch summary)
+    """
+    render_kwargs["folder"] = folder
+    if output_folder is not None:
+        os.makedirs(output_folder, exist_ok=True)
+
+    result_queue = mp.Queue()
+    pending = deque(selected_files)
+
+    workers = {}  # pid -> (process, task queue of the worker)
+    rendering = {}  # pid -> file handed out to the worker
+    tune_records = []
+    n_recycled = 0
+
+    def start_worker():
+        task_queue = mp.Queue()
+        worker = mp.Process(target=_batch_worker,
+                            args=(task_queue, result_queue, budget, render_kwargs, output_folder))
+        worker.start()
+        workers[worker.pid] = (worker, task_queue)
+        hand_out(worker.pid)
+
+    def hand_out(pid):
+        """
+        Sends the next tune to a worker if it is alive, else replaces it (the tune goes to the new worker)
+        """
+        nonlocal n_recycled
+        worker, task_queue = workers[pid]
+        if not pending:
+            task_queue.put(None)
+        elif worker.is_alive():
+            rendering[pid] = pending.popleft()
+            task_queue.put(rendering[pid])
+        else:
+            del workers[pid]
+            n_recycled += 1
+            start_worker()
+
+    def replace_dead_workers():
+        """
+        Fails the tune of a worker which died (e.g. killed by the OOM killer) and replaces any dead worker,
+        busy or idle, while tunes are pending
+        """
+        nonlocal n_recycled
+        for pid, (worker, _) in list(workers.items()):
+            if worker.is_alive():
+                continue
+            del workers[pid]
+            if pid in rendering:
+                tune_record = _empty_tune_record(rendering.pop(pid))
+                tune_record["error"] = f"Worker died with exit code {worker.exitcode}"
+                tune_records.append(tune_record)
+            if pending:
+                n_recycled += 1
+                start_worker()
+
+    for _ in range(min(n_workers, len(selected_files))):
+        start_worker()
+
+    while len(tune_records) < len(selected_files):
+        try:
+            message, pid, selected_file, tune_record = result_queue.get(timeout=1)
+        except queue.Empty:
+            # the results of a worker are all received before it is found dead
+            replace_dead_workers()
+            continue
+
+        if message == "started":
+            continue
+
+        rendering.pop(pid, None)
+        tune_records.append(tune_record)
+
+        if message == "recycled":
+            n_recycled += 1
+            workers.pop(pid)[0].join()
+            if pending:
+                start_worker()
+        else:
+            hand_out(pid)
+
+    for worker, task_queue in workers.values():
+        task_queue.put(None)
+    for worker, _ in workers.values():
+        worker.join()
+
+    summary = summarize(tune_records) if len(tune_records) > 0 else {"tunes": 0}
+    summary["recycled_workers"] = n_recycled
+
+    if print_summary:
+        for tune_record in tune_records:
+            print_tune_record(tune_record)
+        print_batch_summary(summary)
+        print(f"{n_recycled} workers recycled")
+
+    return tune_records, summary
+
+
+if __name__ == "__main__":
+
+    folder = "./Omnibook"
+    selected_files = sorted([xml_file for xml_file in os.listdir(folder) if xml_file.endswith(".xml")])
+
+    render_batch(selected_files, folder=folder, budget=MemoryBudget(peak_mb=300, action="recycle"), n_workers=2)
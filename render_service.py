@@ -0,0 +1,401 @@
+import argparse
+import base64
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import threading
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cellularautomaton_gradio import render_score
+from pattern_m21_converter import melody_instruments_d
+
+FORMATS = {
+    "midi": "audio/midi",
+    "musicxml": "application/vnd.recordare.musicxml+xml",
+}
+
+# request fields passed to render_score, with their types
+RENDER_PARAMS = {
+    "synco_prob": float,
+    "kick_crash_prob": float,
+    "octave_up_down": int,
+    "voice_leading": str,
+    "voice_leading_temperature": float,
+}
+
+# valid values of the render parameters: (minimum, maximum) range, or list of the choices
+RENDER_PARAM_VALUES = {
+    "synco_prob": (0.0, 1.0),
+    "kick_crash_prob": (0.0, 1.0),
+    "octave_up_down": (-1, 1),
+    "voice_leading": ["greedy", "viterbi"],
+    "voice_leading_temperature": (0.0, 100.0),
+}
+
+# default values of the render parameters, so that a request which omits a parameter
+# and one which gives its default value are the same request
+RENDER_DEFAULTS = {param: inspect.signature(render_score).parameters[param].default for param in RENDER_PARAMS}
+
+
+class RenderRequestError(Exception):
+    """
+    Invalid render request; status is the HTTP status of the response
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _warm_worker():
+    """
+    Worker initializer: import music21 and the pipeline once, before the first request arrives
+    """
+    import music21
+    import cellularautomaton_gradio
+
+
+def _ping():
+    return os.getpid()
+
+
+def score_to_bytes(score, output_format):
+    """
+    MIDI or MusicXML bytes of a music21 score
+    """
+    import music21 as m21
+
+    if output_format == "midi":
+        return m21.midi.translate.streamToMidiFile(score).writestr()
+    else:
+        return m21.musicxml.m21ToXml.GeneralObjectExporter(score).parse()
+
+
+def validate_musicxml(musicxml):
+    """
+    Checks that an uploaded lead-sheet is a MusicXML score with notes and chord symbols,
+    without music21 (in the server process)
+
+    :param musicxml: bytes of the file
+    """
+    try:
+        root = ElementTree.fromstring(musicxml)
+    except ElementTree.ParseError as parse_error:
+        raise RenderRequestError(f"musicxml is not valid XML: {parse_error}")
+
+    if root.tag not in ("score-partwise", "score-timewise"):
+        raise RenderRequestError(f"musicxml must be a MusicXML score, not {root.tag}")
+    for element, description in [("part", "part"), ("note", "note"), ("harmony", "chord symbol")]:
+        if root.find(f".//{element}") is None:
+            raise RenderRequestError(f"The musicxml lead-sheet has no {description}")
+
+
+def render_request(render_args, folder):
+    """
+    Renders a (validated) request in a worker process.
+
+    :param render_args: dict with "tune" (file name in folder) or "musicxml" (file content),
+        "instrument", "format" and the render_score parameters
+    :return: bytes of the rendered score
+    """
+    import music21 as m21
+
+    render_kwargs = {param: render_args[param] for param in RENDER_PARAMS if param in render_args}
+
+    with tempfile.TemporaryDirectory() as upload_folder:
+        if "musicxml" in render_args:
+            selected_file = "upload.xml"
+            with open(os.path.join(upload_folder, selected_file), "wb") as upload_file:
+                upload_file.write(render_args["musicxml"])
+            folder = upload_folder
+        else:
+            selected_file = render_args["tune"]
+
+        try:
+            score = render_score(selected_file, render_args.get("instrument"), folder=folder, **render_kwargs)
+        except m21.exceptions21.Music21Exception as m21_error:
+            # the Omnibook tunes are known to render: only an upload is bad input
+            if "musicxml" not in render_args:
+                raise
+            raise RenderRequestError(f"The musicxml lead-sheet could not be read: {m21_error}")
+
+    return score_to_bytes(score, render_args["format"])
+
+
+class RenderService:
+    """
+    Renders requests in a pool of pre-warmed worker processes.
+
+    At most n_workers renders run at the same time and at most max_queue requests wait for a worker;
+    when the queue is full, new requests are rejected (HTTP 429). A request which takes longer than
+    request_timeout seconds gets an HTTP 504 response (the render finishes in its worker anyway).
+
+    Concurrent requests with the same normalized key (see request_key) share a single render:
+    the later ones wait for the render in flight instead of taking a worker ("coalesced" counter).
+    """
+
+    def __init__(self, folder="./Omnibook", n_workers=2, max_queue=8, request_timeout=60.0):
+        self.folder = folder
+        self.n_workers = n_workers
+        self.max_queue = max_queue
+        self.request_timeout = request_timeout
+
+        self.executor = self._make_executor()
+        # slots for running + queued renders; a slot is released when its render finishes, not when it times out
+        self._slots = threading.BoundedSemaphore(n_workers + max_queue)
+
+        self._stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "renders": 0, "coalesced": 0, "rejected": 0, "timeouts": 0, "errors": 0}
+
+        # request key -> future of the render in flight
+        self._in_flight_lock = threading.Lock()
+        self._in_flight = {}
+
+    def _make_executor(self):
+
+        return ProcessPoolExecutor(max_workers=self.n_workers, initializer=_warm_worker)
+
+    def warm_up(self):
+        """
+        Start all the worker processes (with music21 imported) before serving
+        """
+        worker_pids = set(future.result() for future in [self.executor.submit(_ping) for _ in range(self.n_workers)])
+        print(f"{len(worker_pids)} render workers ready")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def parse_request(self, request):
+        """
+        Validates a JSON render request.
+
+        :param request: dict with:
+            - "tune": Omnibook file name, or "musicxml": base64 encoded MusicXML lead-sheet
+            - "instrument" (optional): melody instrument name
+            - "format" (optional): "midi" (default) or "musicxml"
+            - optional render parameters: synco_prob, kick_crash_prob, octave_up_down,
+              voice_leading, voice_leading_temperature (see RENDER_PARAM_VALUES)
+        :return: dict of render arguments
+        """
+        if not isinstance(request, dict):
+            raise RenderRequestError("The request must be a JSON object")
+
+        render_args = {}
+
+        if "musicxml" in request:
+            try:
+                render_args["musicxml"] = base64.b64decode(request["musicxml"], validate=True)
+            except (ValueError, TypeError):
+                raise RenderRequestError("musicxml must be base64 encoded")
+            validate_musicxml(render_args["musicxml"])
+        elif "tune" in request:
+            tune = request["tune"]
+            if not isinstance(tune, str) or os.path.basename(tune) != tune or not tune.endswith(".xml"):
+                raise RenderRequestError(f"Invalid tune {tune}")
+            if not os.path.isfile(os.path.join(self.folder, tune)):
+                raise RenderRequestError(f"Unknown tune {tune}", status=404)
+            render_args["tune"] = tune
+        else:
+            raise RenderRequestError("The request must include a tune or a musicxml lead-sheet")
+
+        instrument = request.get("instrument")
+        if instrument is not None and instrument not in melody_instruments_d:
+            raise RenderRequestError(f"Unknown instrument {instrument}, it should be one of "
+                                     f"{list(melody_instruments_d.keys())}")
+        render_args["instrument"] = instrument
+
+        output_format = request.get("format", "midi")
+        if output_format not in FORMATS:
+            raise RenderRequestError(f"Unknown format {output_format}, it should be one of {list(FORMATS)}")
+        render_args["format"] = output_format
+
+        for param, param_type in RENDER_PARAMS.items():
+            if param in request:
+                try:
+                    render_args[param] = param_type(request[param])
+                except (ValueError, TypeError):
+                    raise RenderRequestError(f"Invalid {param}: {request[param]}")
+
+                valid_values = RENDER_PARAM_VALUES[param]
+                if isinstance(valid_values, list):
+                    if render_args[param] not in valid_values:
+                        raise RenderRequestError(f"Unknown {param} {render_args[param]}, it should be one of "
+                                                 f"{valid_values}")
+                # NaN is out of any range
+                elif not valid_values[0] <= render_args[param] <= valid_values[1]:
+                    raise RenderRequestError(f"Invalid {param}: {render_args[param]}, it should be between "
+                                             f"{valid_values[0]} and {valid_values[1]}")
+
+        return render_args
+
+    @staticmethod
+    def request_key(render_args):
+        """
+        Normalized key of a validated request: omitted parameters take their default values,
+        floats are rounded and uploaded lead-sheets are identified by their hash
+        """
+        key = {param: render_args.get(param, default) for param, default in RENDER_DEFAULTS.items()}
+        key = {param: round(value, 6) if isinstance(value, float) else value for param, value in key.items()}
+
+        key["instrument"] = render_args["instrument"] or list(melody_instruments_d.keys())[0]
+        key["format"] = render_args["format"]
+        if "musicxml" in render_args:
+            key["musicxml"] = hashlib.sha256(render_args["musicxml"]).hexdigest()
+        else:
+            key["tune"] = render_args["tune"]
+
+        return json.dumps(key, sort_keys=True)
+
+    def _submit(self, render_args):
+        """
+        Future of the render of a request: the one in flight with the same key, or a new one
+        """
+        key = self.request_key(render_args)
+
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._count("coalesced")
+                return future
+
+            if not self._slots.acquire(blocking=False):
+                self._count("rejected")
+                raise RenderRequestError("Too many render requests, try again later", status=429)
+
+            try:
+                future = self.executor.submit(render_request, render_args, self.folder)
+            except RuntimeError as submit_error:
+                # e.g. BrokenProcessPool after a worker crashed: the pool is replaced for the next requests
+                self._slots.release()
+                self._count("errors")
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self._make_executor()
+                raise RenderRequestError(f"Render workers unavailable ({type(submit_error).__name__}), "
+                                         f"try again", status=503)
+            self._in_flight[key] = future
+            self._count("renders")
+
+        def finish_render(_):
+            with self._in_flight_lock:
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+            self._slots.release()
+
+        future.add_done_callback(finish_render)
+
+        return future
+
+    def render(self, render_args):
+        """
+        Renders a validated request in the worker pool, or waits for an identical render in flight.
+
+        :return: bytes of the rendered score
+        """
+        self._count("requests")
+
+        future = self._submit(render_args)
+
+        try:
+            score_bytes = future.result(timeout=self.request_timeout)
+        except TimeoutError:
+            self._count("timeouts")
+            raise RenderRequestError(f"The render took more than {self.request_timeout} s", status=504)
+        except RenderRequestError:
+            # invalid lead-sheet found by the worker
+            self._count("errors")
+            raise
+        except Exception as e:
+            self._count("errors")
+            raise RenderRequestError(f"Render failed: {type(e).__name__}: {e}", status=500)
+
+        return score_bytes
+
+
+def make_request_handler(render_service):
+
+    class RenderRequestHandler(BaseHTTPRequestHandler):
+        """
+        POST /render with a JSON render request: responds with the MIDI or MusicXML bytes
+        GET /health: responds with the service stats
+        """
+
+        def _send_json(self, status, content):
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"status": "ok", "workers": render_service.n_workers,
+                                      **render_service.stats})
+            else:
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/render":
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+
+            try:
+                content_length = int(self.headers.get("Content-Length", 0))
+                try:
+                    request = json.loads(self.rfile.read(content_length))
+                except ValueError:
+                    raise RenderRequestError("The request body must be JSON")
+
+                render_args = render_service.parse_request(request)
+                score_bytes = render_service.render(render_args)
+
+            except RenderRequestError as e:
+                self._send_json(e.status, {"error": str(e)})
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", FORMATS[render_args["format"]])
+            self.send_header("Content-Length", str(len(score_bytes)))
+            self.end_headers()
+            self.wfile.write(score_bytes)
+
+    return RenderRequestHandler
+
+
+def serve(host="127.0.0.1", port=8021, folder="./Omnibook", n_workers=2, max_queue=8, request_timeout=60.0):
+
+    render_service = RenderService(folder=folder, n_workers=n_workers, max_queue=max_queue,
+                                   request_timeout=request_timeout)
+    render_service.warm_up()
+
+    server = ThreadingHTTPServer((host, port), make_request_handler(render_service))
+    print(f"Render service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        render_service.shutdown()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local HTTP/JSON service which adds rhythm to lead-sheets")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8021)
+    parser.add_argument("--folder", default="./Omnibook")
+    parser.add_argument("--workers", type=int, default=2, help="number of render worker processes")
+    parser.add_argument("--max-queue", type=int, default=8, help="requests waiting for a worker before HTTP 429")
+    parser.add_argument("--timeout", type=float, default=60.0, help="request timeout in seconds")
+    args = parser.parse_args()
+
+    serve(host=args.host, port=args.port, folder=args.folder, n_workers=args.workers,
+          max_queue=args.max_queue, request_timeout=args.timeout)
@@ -0,0 +1,234 @@
+import argparse
+import csv
+import os
+import time
+from itertools import product
+
+import numpy as np
+
+from cellularautomaton_gradio import CellularAutomatonRhythmGenerator, list_files
+from omnibook_read import chords_and_m21melody
+from pattern_m21_converter import PitchedInstruments, DrumInstruments, States
+from rule_tables import compile_jazz_rules, rule_context
+
+# onsets played in a beat for each state (a tied beat is played once, at its start)
+ONSETS_PER_STATE = np.array([0, 1, 2, 1, 1])
+
+PARAMS = ["synco_prob", "kick_crash_prob", "even_beat_swing_prob", "odd_beat_swing_prob"]
+
+METRICS = [f"{drum.name.lower()}_onsets" for drum in DrumInstruments] + [
+    "chord_syncopation_rate",  # beats with a piano push (eighth rest + eighth)
+    "bass_syncopation_rate",  # beats with a bass push
+    "kick_rate",  # beats with a kick (not a pushed kick)
+    "crash_rate",  # beats with a crash
+    "push_melody_coincidence",  # piano or bass pushes which coincide with a melody onset
+]
+
+
+class TuneSampler:
+    """
+    Generates batches of Cellular Automaton states of a tune with the compiled rule tables.
+    The tune is parsed once; each batch is a single vectorized application of the rules.
+    """
+
+    def __init__(self, file_path):
+        chord_progression, m21_melody, _, _, _ = chords_and_m21melody(file_path)
+
+        rhythm_generator = CellularAutomatonRhythmGenerator(melody=m21_melody, chord_sequence=chord_progression)
+        self.initial_state = rhythm_generator.state
+        self.pattern_length = rhythm_generator.pattern_length
+        self.melody = m21_melody
+        self.beat_chord_roots = rhythm_generator.beat_chord_roots
+        self.beat_chord_types = rhythm_generator.beat_chord_types
+        self.melody_grid = rhythm_generator.melody_grid
+        self.context = rule_context(rhythm_generator.beat_chord_roots, rhythm_generator.beat_chord_types,
+                                    self.melody_grid)
+
+    def sample(self, n_samples, compiled_rules, rng=None):
+        """
+        :param compiled_rules: list of rule_tables.CompiledRule, e.g. compile_jazz_rules(synco_prob, ...)
+        :param rng: optional np.random.Generator of the random draws, for reproducible batches
+        :return: states after one step: np.ndarray (n_samples, n_instruments, pattern_length)
+        """
+        states = np.broadcast_to(self.initial_state, (n_samples,) + self.initial_state.shape)
+        for compiled_rule in compiled_rules:
+            random_draws = rng.random((n_samples, self.pattern_length)) if rng is not None else None
+            states = compiled_rule.apply(states, self.context, random_draws)
+
+        return states
+
+
+def rhythm_metric_sums(states, melody_grid):
+    """
+    Sums of the rhythm metrics over a batch of states, and the number of beats (or pushes) of each sum,
+    so that several batches and tunes can be averaged.
+
+    :param states: np.ndarray (n_samples, n_instruments, pattern_length)
+    :param melody_grid: melody onsets per eighth, see omnibook_read.melody_onset_grid
+    :return: sums: dict metric -> sum
+    :return: counts: dict metric -> number of beats or pushes
+    """
+    n_beats = states.shape[0] * states.shape[2]
+    sums, counts = {}, {}
+
+    onsets = ONSETS_PER_STATE[states]
+    for drum in DrumInstruments:
+        sums[f"{drum.name.lower()}_onsets"] = onsets[:, drum.value].sum()
+
+    chord_pushes = states[:, PitchedInstruments.CHORD.value] == States.FILL_0_1.value
+    bass_pushes = states[:, PitchedInstruments.BASS.value] == States.FILL_0_1.value
+    sums["chord_syncopation_rate"] = chord_pushes.sum()
+    sums["bass_syncopation_rate"] = bass_pushes.sum()
+    sums["kick_rate"] = (states[:, DrumInstruments.KICK.value] == States.FILL_1.value).sum()
+    sums["crash_rate"] = (states[:, DrumInstruments.CRASH.value] == States.FILL_1.value).sum()
+
+    # a push is played on the second eighth of the beat
+    pushes = chord_pushes | bass_pushes
+    sums["push_melody_coincidence"] = (pushes & melody_grid["eighth_onsets"][1::2]).sum()
+
+    counts = {metric: n_beats for metric in METRICS}
+    counts["push_melody_coincidence"] = pushes.sum()
+
+    return sums, counts
+
+
+def parameter_sweep(selected_files, folder="./Omnibook", synco_probs=(0.0, 0.25, 0.5, 0.75, 1.0),
+                    kick_crash_probs=(0.0, 0.1, 0.2, 0.3, 0.4, 0.5),
+                    even_beat_swing_probs=(CellularAutomatonRhythmGenerator.EVEN_BEAT_SWING_PROBABILITY,),
+                    odd_beat_swing_probs=(CellularAutomatonRhythmGenerator.ODD_BEAT_SWING_PROBABILITY,),
+                    n_samples=1000, batch_size=250):
+    """
+    Generates n_samples Cellular Automaton states per tune and parameter setting, and averages the rhythm
+    metrics over all the tunes (weighted by their number of beats).
+
+    :return: list of dicts, one per parameter setting, with the parameters and the metrics
+    """
+    start_time = time.time()
+
+    tune_samplers = []
+    for selected_file in selected_files:
+        print(f"Parsing {selected_file}")
+        tune_samplers.append(TuneSampler(os.path.join(folder, selected_file)))
+
+    sweep_rows = []
+    n_states = 0
+    for param_values in product(synco_probs, kick_crash_probs, even_beat_swing_probs, odd_beat_swing_probs):
+        params = dict(zip(PARAMS, param_values))
+        compiled_rules = compile_jazz_rules(**params)
+
+        metric_sums = dict.fromkeys(METRICS, 0)
+        metric_counts = dict.fromkeys(METRICS, 0)
+        for tune_sampler in tune_samplers:
+            for batch_start in range(0, n_samples, batch_size):
+                states = tune_sampler.sample(min(batch_size, n_samples - batch_start), compiled_rules)
+                sums, counts = rhythm_metric_sums(states, tune_sampler.melody_grid)
+                for metric in METRICS:
+                    metric_sums[metric] += sums[metric]
+                    metric_counts[metric] += counts[metric]
+                n_states += states.shape[0]
+
+        sweep_rows.append({
+            **params,
+            **{metric: metric_sums[metric] / metric_counts[metric] if metric_counts[metric] > 0 else float("nan")
+               for metric in METRICS},
+        })
+
+    print(f"{n_states} states of {len(tune_samplers)} tunes in {time.time() - start_time:.1f} s")
+
+    return sweep_rows
+
+
+def print_sweep_table(sweep_rows, metrics=METRICS):
+
+    columns = PARAMS + list(metrics)
+    widths = [max(len(column), 6) for column in columns]
+
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for sweep_row in sweep_rows:
+        print("  ".join(f"{sweep_row[column]:.3f}".rjust(width) for column, width in zip(columns, widths)))
+
+
+def save_sweep_csv(sweep_rows, fp):
+
+    with open(fp, "w", newline="") as csv_file:
+        csv_writer = csv.DictWriter(csv_file, fieldnames=PARAMS + METRICS)
+        csv_writer.writeheader()
+        csv_writer.writerows(sweep_rows)
+
+    return fp
+
+
+def plot_sweep_heatmaps(sweep_rows, fp, metrics=METRICS, x_param="kick_crash_prob", y_param="synco_prob"):
+    """
+    One heatmap per metric over two parameters; when the sweep has other parameters,
+    the metric is averaged over them. Requires matplotlib.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    x_values = sorted(set(sweep_row[x_param] for sweep_row in sweep_rows))
+    y_values = sorted(set(sweep_row[y_param] for sweep_row in sweep_rows))
+
+    n_cols = 3
+    n_rows = int(np.ceil(len(metrics) / n_cols))
+    fig, axes = plt.subplots(n_rows, n_cols, figsize=(4.5 * n_cols, 3.5 * n_rows), squeeze=False)
+
+    for ax, metric in zip(axes.flat, metrics):
+        sums = np.zeros((len(y_values), len(x_values)))
+        counts = np.zeros((len(y_values), len(x_values)))
+        for sweep_row in sweep_rows:
+            y_idx, x_idx = y_values.index(sweep_row[y_param]), x_values.index(sweep_row[x_param])
+            sums[y_idx, x_idx] += sweep_row[metric]
+            counts[y_idx, x_idx] += 1
+        grid = sums / np.maximum(counts, 1)
+
+        image = ax.imshow(grid, origin="lower", aspect="auto", cmap="viridis")
+        ax.set_xticks(range(len(x_values)), [f"{x_value:g}" for x_value in x_values])
+        ax.set_yticks(range(len(y_values)), [f"{y_value:g}" for y_value in y_values])
+        ax.set_xlabel(x_param)
+        ax.set_ylabel(y_param)
+        ax.set_title(metric)
+        for y_idx, x_idx in product(range(len(y_values)), range(len(x_values))):
+            ax.text(x_idx, y_idx, f"{grid[y_idx, x_idx]:.2f}", ha="center", va="center", fontsize=7, color="w")
+        fig.colorbar(image, ax=ax)
+
+    for ax in axes.flat[len(metrics):]:
+        ax.axis("off")
+
+    fig.tight_layout()
+    fig.savefig(fp)
+    plt.close(fig)
+
+    return fp
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Rhythm metrics of the Cellular Automaton across a parameter grid")
+    parser.add_argument("--folder", default="./Omnibook")
+    parser.add_argument("--files", nargs="*", help="tunes of the folder (default: all)")
+    parser.add_argument("--samples", type=int, default=1000, help="states per tune and parameter setting")
+    parser.add_argument("--synco-probs", type=float, nargs="+", default=[0.0, 0.25, 0.5, 0.75, 1.0])
+    parser.add_argument("--kick-crash-probs", type=float, nargs="+", default=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5])
+    parser.add_argument("--even-swing-probs", type=float, nargs="+",
+                        default=[CellularAutomatonRhythmGenerator.EVEN_BEAT_SWING_PROBABILITY])
+    parser.add_argument("--odd-swing-probs", type=float, nargs="+",
+                        default=[CellularAutomatonRhythmGenerator.ODD_BEAT_SWING_PROBABILITY])
+    parser.add_argument("--csv", help="output CSV file")
+    parser.add_argument("--heatmaps", help="output image of the heatmaps (requires matplotlib)")
+    args = parser.parse_args()
+
+    selected_files = args.files or sorted(list_files(args.folder))
+
+    sweep_rows = parameter_sweep(selected_files, folder=args.folder,
+                                 synco_probs=args.synco_probs, kick_crash_probs=args.kick_crash_probs,
+                                 even_beat_swing_probs=args.even_swing_probs,
+                                 odd_beat_swing_probs=args.odd_swing_probs,
+                                 n_samples=args.samples)
+
+    print_sweep_table(sweep_rows)
+    if args.csv:
+        save_sweep_csv(sweep_rows, args.csv)
+    if args.heatmaps:
+        plot_sweep_heatmaps(sweep_rows, args.heatmaps)
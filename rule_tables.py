@@ -0,0 +1,348 @@
+from itertools import product
+
+import numpy as np
+
+from m21_musescore import M21_and_show
+from pattern_m21_converter import PitchedInstruments, DrumInstruments, States
+
+CHORD_VOCABULARY = M21_and_show.chord_vocabulary
+
+# values of the chord_class feature; other chord types are class 0
+CHORD_CLASSES = {
+    "dominant": 1,
+    "diminished": 2,
+    "half_diminished": 3,
+}
+N_CHORD_CLASSES = 4
+
+# chord class of each chord type code
+TYPE_CHORD_CLASSES = np.select(
+    [CHORD_VOCABULARY.is_dominant, CHORD_VOCABULARY.is_diminished, CHORD_VOCABULARY.is_half_diminished],
+    [CHORD_CLASSES["dominant"], CHORD_CLASSES["diminished"], CHORD_CLASSES["half_diminished"]],
+    0,
+)
+
+# value of a state feature outside the pattern (or of the previous new state at position 0)
+NO_STATE = len(States)
+
+# features computed from the beat chord sequence: name -> number of values
+CONTEXT_FEATURES = {
+    "parity": 2,  # position % 2
+    "chord_class": N_CHORD_CLASSES,
+    "same_chord_next": 3,  # 0: no next beat, 1: different chord, 2: same chord
+    "same_chord_prev": 3,  # 0: no previous beat, 1: different chord, 2: same chord
+    "melody_push": 2,  # 1: accented melody note on the second eighth of the beat (needs the melody grid)
+}
+
+
+class RuleSpec:
+    """
+    Declarative Cellular Automaton rule.
+
+    For the instrument rows `rows`, given the features of each beat, the rule gives the probabilities
+    of the output states of the rows. Features can be:
+        - a context feature (see CONTEXT_FEATURES): "parity", "chord_class", "same_chord_next", "same_chord_prev"
+        - ("state", row, offset): state of a row at position + offset before the rule is applied
+        - ("new_state", row, -1): state of a row at the previous position after the rule is applied
+          (the rule is applied from left to right, like the per-position Python rules)
+
+    Each entry of `table` is (key, outcomes):
+        - key: tuple with one value per feature; a value may be None (any value) or a list of values
+        - outcomes: list of (probability, states): states is a tuple with one state per row,
+          or None to keep the current state; probabilities of an entry must add up to 1
+    For each beat, the first matching entry is used; if none matches, the states are kept.
+    """
+
+    def __init__(self, name, rows, features, table):
+        self.name = name
+        self.rows = [row.value if hasattr(row, "value") else row for row in rows]
+        self.features = [tuple(feature) if isinstance(feature, (list, tuple)) else feature for feature in features]
+        self.table = table
+
+
+def feature_cardinality(feature):
+
+    if isinstance(feature, str):
+        return CONTEXT_FEATURES[feature]
+    return len(States) + 1  # states and NO_STATE
+
+
+def _matches(key_value, feature_value):
+
+    if key_value is None:
+        return True
+    if isinstance(key_value, (list, tuple, set)):
+        return feature_value in key_value
+    return feature_value == key_value
+
+
+def _state_value(state):
+
+    return None if state is None else (state.value if hasattr(state, "value") else state)
+
+
+class CompiledRule:
+    """
+    A RuleSpec compiled into lookup tables indexed by an integer neighbourhood code:
+        - cum_probs[code, outcome]: cumulative probability of each outcome
+        - outcome_states[outcome, row]: output state of each row (-1 keeps the current state)
+    apply() computes the codes of all the positions at once with sliding windows over the state.
+    """
+
+    def __init__(self, rule_spec):
+        self.name = rule_spec.name
+        self.rows = np.array(rule_spec.rows)
+        self.features = rule_spec.features
+
+        self.cardinalities = [feature_cardinality(feature) for feature in self.features]
+        # code = sum(feature value * radix)
+        self.radixes = np.cumprod([1] + self.cardinalities[:0:-1])[::-1]
+        n_codes = int(np.prod(self.cardinalities))
+
+        causal_features = [feature_idx for feature_idx, feature in enumerate(self.features)
+                           if isinstance(feature, tuple) and feature[0] == "new_state"]
+        if len(causal_features) > 1:
+            raise ValueError(f"Rule {self.name}: only one new_state feature is supported")
+        self.causal_feature = causal_features[0] if causal_features else None
+        if self.causal_feature is not None:
+            _, causal_row, causal_offset = self.features[self.causal_feature]
+            causal_row = causal_row.value if hasattr(causal_row, "value") else causal_row
+            if causal_offset != -1 or causal_row not in rule_spec.rows:
+                raise ValueError(f"Rule {self.name}: new_state feature must be (\"new_state\", row, -1) "
+                                 f"for one of the rule rows")
+            self.causal_row_idx = rule_spec.rows.index(causal_row)
+
+        outcomes = [(None,) * len(self.rows)]  # outcome 0: keep
+        outcome_idxs = {outcomes[0]: 0}
+        probs = np.zeros((n_codes, 1))
+        probs[:, 0] = 1.0
+
+        for code, feature_values in enumerate(product(*[range(cardinality) for cardinality in self.cardinalities])):
+            for key, entry_outcomes in rule_spec.table:
+                if all(_matches(key_value, feature_value) for key_value, feature_value in zip(key, feature_values)):
+                    probs[code, 0] = 0.0
+                    for probability, states in entry_outcomes:
+                        states = (None,) * len(self.rows) if states is None else \
+                            tuple(_state_value(state) for state in states)
+                        if states not in outcome_idxs:
+                            outcome_idxs[states] = len(outcomes)
+                            outcomes.append(states)
+                            probs = np.hstack([probs, np.zeros((n_codes, 1))])
+                        probs[code, outcome_idxs[states]] += probability
+                    break
+
+        if not np.allclose(probs.sum(axis=1), 1.0):
+            raise ValueError(f"Rule {self.name}: the probabilities of each entry must add up to 1")
+
+        self.cum_probs = np.cumsum(probs, axis=1)
+        self.cum_probs[:, -1] = 1.0
+        self.outcome_states = np.array([[-1 if state is None else state for state in states]
+                                        for states in outcomes])
+
+    def _feature_values(self, feature, state, context):
+        """
+        Values of a (non causal) feature for all positions: shape (..., pattern_length)
+        """
+        if isinstance(feature, str):
+            return context[feature]
+
+        _, row, offset = feature
+        row = row.value if hasattr(row, "value") else row
+        row_states = state[..., row, :]
+        pattern_length = row_states.shape[-1]
+
+        # pad with NO_STATE and take, for each position, the window [position - radius, position + radius]
+        radius = abs(offset)
+        pad_width = [(0, 0)] * (row_states.ndim - 1) + [(radius, radius)]
+        padded = np.pad(row_states, pad_width, constant_values=NO_STATE)
+        windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * radius + 1, axis=-1)
+
+        return windows[..., :pattern_length, radius + offset]
+
+    def _outcomes(self, base_codes, causal_values, random_draws):
+
+        codes = base_codes
+        if self.causal_feature is not None:
+            codes = codes + causal_values * self.radixes[self.causal_feature]
+
+        return (self.cum_probs[codes] <= random_draws[..., None]).sum(axis=-1)
+
+    def apply(self, state, context, random_draws=None):
+        """
+        Applies the rule to all the positions of the state at once.
+
+        :param state: np.ndarray (..., n_instruments, pattern_length); leading dimensions are a batch of states
+        :param context: dict of context features, each np.ndarray (pattern_length,)
+        :param random_draws: optional uniform draws (..., pattern_length)
+        :return: new state
+        """
+        pattern_length = state.shape[-1]
+        batch_shape = state.shape[:-2]
+        if random_draws is None:
+            random_draws = np.random.random(batch_shape + (pattern_length,))
+
+        base_codes = np.zeros(batch_shape + (pattern_length,), dtype=np.int64)
+        for feature_idx, feature in enumerate(self.features):
+            if feature_idx != self.causal_feature:
+                base_codes = base_codes + self._feature_values(feature, state, context) * self.radixes[feature_idx]
+
+        causal_values = None
+        if self.causal_feature is not None:
+            causal_values = self._resolve_causal_values(state, base_codes, random_draws)
+
+        outcome_idxs = self._outcomes(base_codes, causal_values, random_draws)
+
+        new_state = state.copy()
+        for row_idx, row in enumerate(self.rows):
+            row_states = self.outcome_states[outcome_idxs, row_idx]
+            new_state[..., row, :] = np.where(row_states >= 0, row_states, state[..., row, :])
+
+        return new_state
+
+    def _resolve_causal_values(self, state, base_codes, random_draws):
+        """
+        Values of the ("new_state", row, -1) feature, i.e. the output of the rule at the previous position.
+
+        For each position, the output state of the causal row is a function of the causal value:
+        f_p: previous output -> output. The causal value of position p is (f_(p-1) o ... o f_0)(NO_STATE),
+        and the prefix compositions are computed in log2(pattern_length) vectorized steps.
+        """
+        n_values = len(States) + 1
+        causal_row = self.rows[self.causal_row_idx]
+        row_states = state[..., causal_row, :]
+
+        # maps[..., p, v] = output state of the causal row at p when the previous output is v
+        maps = np.empty(base_codes.shape + (n_values,), dtype=np.int64)
+        for value in range(n_values):
+            outcome_idxs = self._outcomes(base_codes, np.full(base_codes.shape, value), random_draws)
+            output_states = self.outcome_states[outcome_idxs, self.causal_row_idx]
+            maps[..., value] = np.where(output_states >= 0, output_states, row_states)
+
+        # Hillis-Steele scan: after the loop, maps[..., p, :] = f_p o ... o f_0
+        pattern_length = base_codes.shape[-1]
+        shift = 1
+        while shift < pattern_length:
+            composed = np.take_along_axis(maps[..., shift:, :], maps[..., :-shift, :], axis=-1)
+            maps = np.concatenate([maps[..., :shift, :], composed], axis=-2)
+            shift *= 2
+
+        causal_values = np.full(base_codes.shape, NO_STATE, dtype=np.int64)
+        causal_values[..., 1:] = maps[..., :-1, NO_STATE]
+
+        return causal_values
+
+
+def rule_context(beat_chord_roots, beat_chord_types, melody_grid=None):
+    """
+    Context features of the beats, computed once from the chord codes of the beats
+    (see chord_vocabulary) and the melody onset grid (see omnibook_read.melody_onset_grid).
+    The chord codes may have leading batch dimensions (..., pattern_length), e.g. a batch of progressions.
+    """
+    pattern_length = beat_chord_roots.shape[-1]
+
+    same_chord_next = np.zeros(beat_chord_roots.shape, dtype=np.int64)
+    is_same_chord = (beat_chord_roots[..., :-1] == beat_chord_roots[..., 1:]) & \
+                    (beat_chord_types[..., :-1] == beat_chord_types[..., 1:])
+    same_chord_next[..., :-1] = np.where(is_same_chord, 2, 1)
+    same_chord_prev = np.zeros(beat_chord_roots.shape, dtype=np.int64)
+    same_chord_prev[..., 1:] = same_chord_next[..., :-1]
+
+    context = {
+        "parity": np.arange(pattern_length) % 2,
+        "chord_class": TYPE_CHORD_CLASSES[beat_chord_types].astype(np.int64),
+        "same_chord_next": same_chord_next,
+        "same_chord_prev": same_chord_prev,
+    }
+    if melody_grid is not None:
+        context["melody_push"] = (melody_grid["eighth_accents"][1::2] > 0).astype(np.int64)
+
+    return context
+
+
+def jazz_drum_rule(even_beat_swing_prob=0.2, odd_beat_swing_prob=0.8):
+    """
+    Basic swing rhythm with some randomness (as CellularAutomatonRhythmGenerator._apply_jazz_drum_rule)
+    """
+    OFF, FILL_1, FILL_1_1 = States.OFF, States.FILL_1, States.FILL_1_1
+
+    return RuleSpec(
+        name="jazz_drum",
+        rows=[DrumInstruments.FOOT_HIHAT, DrumInstruments.RIDE],
+        features=["parity"],
+        table=[
+            # even beats: no hihat, one ride beat
+            ((0,), [(even_beat_swing_prob, (OFF, FILL_1_1)), (1 - even_beat_swing_prob, (OFF, FILL_1))]),
+            # odd beats: one hihat beat, swing ride beat
+            ((1,), [(odd_beat_swing_prob, (FILL_1, FILL_1_1)), (1 - odd_beat_swing_prob, (FILL_1, OFF))]),
+        ],
+    )
+
+
+def jazz_syncopation_rule(synco_prob=0.5, kick_crash_prob=0.2, melody_synco_prob=None):
+    """
+    Syncopations of V7 / o7 chords in chord, bass, snare, kick and hi hat, syncopations of other chords
+    in the chord only, and kick or crash beats (as CellularAutomatonRhythmGenerator._apply_jazz_syncopation_rule)
+
+    :param melody_synco_prob: if not None, syncopation probability of the beats with an accented melody note
+        on their second eighth (melody-aware syncopation, needs the "melody_push" context feature)
+    """
+    FILL_1, FILL_0_1, FILL_1_T = States.FILL_1, States.FILL_0_1, States.FILL_1_T
+
+    # rows: chord, bass, snare, kick, hihat, crash
+    rows = [PitchedInstruments.CHORD, PitchedInstruments.BASS, DrumInstruments.SNARE, DrumInstruments.KICK,
+            DrumInstruments.HIHAT, DrumInstruments.CRASH]
+
+    kick_prob = kick_crash_prob
+    crash_prob = min(kick_crash_prob, 1 - kick_crash_prob)  # the kick is checked first
+
+    def kick_or_crash(synco_states, synco_prob=synco_prob):
+        """
+        Outcomes when syncopation occurs (with probability synco_prob): synco_states, with a kick or crash beat
+        """
+        synco_states = list(synco_states)
+        kick_states = synco_states[:3] + [FILL_1] + synco_states[4:]
+        crash_states = synco_states[:5] + [FILL_1]
+        return [
+            (synco_prob * kick_prob, tuple(kick_states)),
+            (synco_prob * crash_prob, tuple(crash_states)),
+            (synco_prob * (1 - kick_prob - crash_prob), tuple(synco_states)),
+            (1 - synco_prob, None),
+        ]
+
+    keep_all = [None] * 6
+    synco_all = [FILL_0_1] * 5 + [None]
+    synco_chord = [FILL_0_1] + [None] * 5
+
+    syncopation_classes = [CHORD_CLASSES["dominant"], CHORD_CLASSES["diminished"]]
+
+    features = ["chord_class", "same_chord_next", "same_chord_prev", ("new_state", PitchedInstruments.CHORD, -1)]
+    table = [
+        # V7 or o7 chord followed by the same chord: syncopation of chord, bass, snare, kick and hihat
+        ((syncopation_classes, 2, None, None), synco_all),
+        # other chords: avoid syncopation if previous chord has same name and is [syncopated or tied]
+        ((None, 2, 2, [FILL_0_1.value, FILL_1_T.value]), keep_all),
+        ((None, 2, [1, 2], None), synco_chord),
+        # first beat, last beat or chord change: only kick or crash
+        ((None, None, None, None), keep_all),
+    ]
+
+    if melody_synco_prob is None:
+        table = [(key, kick_or_crash(synco_states)) for key, synco_states in table]
+    else:
+        # same entries for beats with a melody push, with their own syncopation probability
+        features = ["melody_push"] + features
+        table = [((1,) + key, kick_or_crash(synco_states, melody_synco_prob)) for key, synco_states in table] + \
+                [((0,) + key, kick_or_crash(synco_states)) for key, synco_states in table]
+
+    return RuleSpec(name="jazz_syncopation", rows=rows, features=features, table=table)
+
+
+def compile_jazz_rules(synco_prob=0.5, kick_crash_prob=0.2, even_beat_swing_prob=0.2, odd_beat_swing_prob=0.8,
+                       melody_synco_prob=None):
+    """
+    Compiled tables of the two jazz rules, in the order in which they are applied
+    """
+    return [
+        CompiledRule(jazz_drum_rule(even_beat_swing_prob, odd_beat_swing_prob)),
+        CompiledRule(jazz_syncopation_rule(synco_prob, kick_crash_prob, melody_synco_prob)),
+    ]
@@ -0,0 +1,285 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+from itertools import product
+
+import numpy as np
+
+from cellularautomaton_gradio import CellularAutomatonRhythmGenerator, list_files
+from rhythm_analytics import PARAMS, TuneSampler
+from rule_tables import compile_jazz_rules
+
+MANIFEST_FILE = "manifest.json"
+
+STATE_DTYPE = np.uint8  # states are in [0, len(States))
+
+# sidecar index of the samples of a shard
+INDEX_DTYPE = np.dtype(
+    [("tune_id", "<i4"), ("seed", "<u4"), ("sample_idx", "<i4")] + [(param, "<f4") for param in PARAMS]
+)
+
+# parsed tunes of a worker process: tune file path -> TuneSampler
+_tune_samplers = {}
+
+
+def write_shard(shard_job):
+    """
+    Generates the samples of a shard and writes them to a memory-mapped .npy file, with its sidecar index.
+    Runs in a worker process; each shard is written by a single worker, so workers never share a file.
+
+    :param shard_job: dict with "folder", "shard_name", "tune_file", "tune_id", "params", "n_samples",
+        "seed" and "batch_size"
+    :return: shard record of the manifest
+    """
+    tune_file = shard_job["tune_file"]
+    tune_sampler = _tune_samplers.get(tune_file)
+    if tune_sampler is None:
+        tune_sampler = TuneSampler(tune_file)
+        _tune_samplers[tune_file] = tune_sampler
+
+    n_samples = shard_job["n_samples"]
+    shape = (n_samples,) + tune_sampler.initial_state.shape
+    states_file = shard_job["shard_name"] + ".npy"
+    index_file = shard_job["shard_name"] + ".index.npy"
+    states_path = os.path.join(shard_job["folder"], states_file)
+
+    # written under a temporary name, so readers never see a partial shard
+    shard_states = np.lib.format.open_memmap(states_path + ".tmp", mode="w+", dtype=STATE_DTYPE, shape=shape)
+
+    # the samples of a shard are reproducible from its seed
+    rng = np.random.default_rng(shard_job["seed"])
+    compiled_rules = compile_jazz_rules(**shard_job["params"])
+    for batch_start in range(0, n_samples, shard_job["batch_size"]):
+        batch_end = min(batch_start + shard_job["batch_size"], n_samples)
+        shard_states[batch_start:batch_end] = tune_sampler.sample(batch_end - batch_start, compiled_rules, rng)
+
+    shard_states.flush()
+    del shard_states
+    os.replace(states_path + ".tmp", states_path)
+
+    shard_index = np.zeros(n_samples, dtype=INDEX_DTYPE)
+    shard_index["tune_id"] = shard_job["tune_id"]
+    shard_index["seed"] = shard_job["seed"]
+    shard_index["sample_idx"] = np.arange(n_samples)
+    for param, value in shard_job["params"].items():
+        shard_index[param] = value
+    np.save(os.path.join(shard_job["folder"], index_file), shard_index)
+
+    return {
+        "states_file": states_file,
+        "index_file": index_file,
+        "tune_id": shard_job["tune_id"],
+        "n_samples": n_samples,
+        "pattern_length": shape[-1],
+        "seed": shard_job["seed"],
+        "params": shard_job["params"],
+    }
+
+
+class StateDatasetWriter:
+    """
+    Appends generated Cellular Automaton states to a dataset folder of sharded memory-mapped .npy files.
+
+    Each shard holds the states of one tune and parameter setting, (n_samples, n_instruments, pattern_length)
+    uint8, next to a sidecar index (.index.npy) with the tune id, seed, sample position and parameters
+    of each sample. Shards are written in parallel by a pool of worker processes; the manifest
+    (tunes, parameters and shards) is updated when all the shards of a write are complete.
+    """
+
+    def __init__(self, folder, tunes_folder="./Omnibook", n_workers=None, shard_size=10000, batch_size=1000):
+        """
+        :param folder: dataset folder; an existing dataset is appended to
+        :param tunes_folder: folder of the lead-sheets
+        :param shard_size: maximum number of samples per shard
+        :param batch_size: samples generated at a time in a worker
+        """
+        self.folder = folder
+        self.tunes_folder = tunes_folder
+        self.n_workers = n_workers or os.cpu_count()
+        self.shard_size = shard_size
+        self.batch_size = batch_size
+
+        os.makedirs(folder, exist_ok=True)
+        self.manifest = read_manifest(folder) if os.path.isfile(os.path.join(folder, MANIFEST_FILE)) else {
+            "params": PARAMS,
+            "state_dtype": np.dtype(STATE_DTYPE).str,
+            "tunes": [],
+            "shards": [],
+        }
+
+    def _tune_id(self, selected_file):
+
+        if selected_file not in self.manifest["tunes"]:
+            self.manifest["tunes"].append(selected_file)
+        return self.manifest["tunes"].index(selected_file)
+
+    def write(self, selected_files, param_settings, n_samples, seed=0):
+        """
+        Generates n_samples states per tune and parameter setting and appends them to the dataset.
+
+        :param selected_files: lead-sheet file names in tunes_folder
+        :param param_settings: list of dicts of parameters (see rhythm_analytics.PARAMS); missing parameters
+            take the CellularAutomatonRhythmGenerator defaults
+        :param seed: seed of the write; each shard gets its own seed derived from it (see shard_seed)
+        :return: number of written samples
+        """
+        start_time = time.time()
+
+        shard_jobs = []
+        for selected_file, params in product(selected_files, param_settings):
+            params = {**default_params(), **params}
+            for shard_start in range(0, n_samples, self.shard_size):
+                shard_jobs.append({
+                    "folder": self.folder,
+                    "shard_name": f"shard_{len(self.manifest['shards']) + len(shard_jobs):06d}",
+                    "tune_file": os.path.join(self.tunes_folder, selected_file),
+                    "tune_id": self._tune_id(selected_file),
+                    "params": params,
+                    "n_samples": min(self.shard_size, n_samples - shard_start),
+                    "batch_size": self.batch_size,
+                })
+
+        n_shards = len(self.manifest["shards"])
+        for shard_idx, shard_job in enumerate(shard_jobs, start=n_shards):
+            shard_job["seed"] = shard_seed(seed, shard_idx)
+
+        with mp.Pool(self.n_workers) as pool:
+            shard_records = pool.map(write_shard, shard_jobs, chunksize=1)
+
+        self.manifest["shards"].extend(shard_records)
+        write_manifest(self.folder, self.manifest)
+
+        n_written = sum(shard_record["n_samples"] for shard_record in shard_records)
+        elapsed = time.time() - start_time
+        print(f"Wrote {n_written} states in {len(shard_records)} shards in {elapsed:.1f} s "
+              f"({n_written / elapsed:.0f} states/s)")
+
+        return n_written
+
+
+def shard_seed(seed, shard_idx):
+    """
+    Seed of a shard, derived from the seed of the write and the index of the shard in the dataset,
+    so that appending to a dataset with the same seed writes new shards, not copies of the first ones
+    """
+    return int(np.random.SeedSequence(seed, spawn_key=(shard_idx,)).generate_state(1)[0])
+
+
+def default_params():
+
+    return {
+        "synco_prob": 0.5,
+        "kick_crash_prob": 0.2,
+        "even_beat_swing_prob": CellularAutomatonRhythmGenerator.EVEN_BEAT_SWING_PROBABILITY,
+        "odd_beat_swing_prob": CellularAutomatonRhythmGenerator.ODD_BEAT_SWING_PROBABILITY,
+    }
+
+
+def read_manifest(folder):
+
+    with open(os.path.join(folder, MANIFEST_FILE)) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(folder, manifest):
+
+    manifest_path = os.path.join(folder, MANIFEST_FILE)
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+class StateDataset:
+    """
+    Random access to the samples of a dataset written by StateDatasetWriter.
+
+    Shards are memory-mapped (read-only) when first accessed, and dataset[i] is a view of the
+    sample in its shard, so no data is copied or loaded until it is used.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.manifest = read_manifest(folder)
+        self.tunes = self.manifest["tunes"]
+        self.shards = self.manifest["shards"]
+
+        shard_sizes = np.array([shard["n_samples"] for shard in self.shards], dtype=np.int64)
+        self._shard_starts = np.concatenate([[0], np.cumsum(shard_sizes)])
+
+        self._shard_states = [None] * len(self.shards)
+        self._shard_indexes = [None] * len(self.shards)
+
+    def __len__(self):
+        return int(self._shard_starts[-1])
+
+    def _locate(self, sample_idx):
+
+        if not 0 <= sample_idx < len(self):
+            raise IndexError(f"Sample {sample_idx} out of range (dataset of {len(self)} samples)")
+        shard_idx = int(np.searchsorted(self._shard_starts, sample_idx, side="right")) - 1
+
+        return shard_idx, int(sample_idx - self._shard_starts[shard_idx])
+
+    def shard_states(self, shard_idx):
+        """
+        Memory-mapped states of a shard: (n_samples, n_instruments, pattern_length) uint8
+        """
+        if self._shard_states[shard_idx] is None:
+            self._shard_states[shard_idx] = np.load(
+                os.path.join(self.folder, self.shards[shard_idx]["states_file"]), mmap_mode="r")
+        return self._shard_states[shard_idx]
+
+    def shard_index(self, shard_idx):
+
+        if self._shard_indexes[shard_idx] is None:
+            self._shard_indexes[shard_idx] = np.load(
+                os.path.join(self.folder, self.shards[shard_idx]["index_file"]), mmap_mode="r")
+        return self._shard_indexes[shard_idx]
+
+    def __getitem__(self, sample_idx):
+        """
+        :return: state of the sample (a read-only view of its shard)
+        """
+        shard_idx, shard_sample_idx = self._locate(sample_idx)
+        return self.shard_states(shard_idx)[shard_sample_idx]
+
+    def info(self, sample_idx):
+        """
+        :return: dict with the tune, seed, position in the shard and parameters of a sample
+        """
+        shard_idx, shard_sample_idx = self._locate(sample_idx)
+        index_record = self.shard_index(shard_idx)[shard_sample_idx]
+
+        sample_info = {param: float(index_record[param]) for param in self.manifest["params"]}
+        sample_info.update({
+            "tune": self.tunes[int(index_record["tune_id"])],
+            "seed": int(index_record["seed"]),
+            "sample_idx": int(index_record["sample_idx"]),
+        })
+
+        return sample_info
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Writes generated Cellular Automaton states to a sharded dataset")
+    parser.add_argument("output_folder")
+    parser.add_argument("--folder", default="./Omnibook", help="folder of the lead-sheets")
+    parser.add_argument("--files", nargs="*", help="tunes of the folder (default: all)")
+    parser.add_argument("--samples", type=int, default=10000, help="states per tune and parameter setting")
+    parser.add_argument("--synco-probs", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--kick-crash-probs", type=float, nargs="+", default=[0.2])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--shard-size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    selected_files = args.files or sorted(list_files(args.folder))
+    param_settings = [{"synco_prob": synco_prob, "kick_crash_prob": kick_crash_prob}
+                      for synco_prob, kick_crash_prob in product(args.synco_probs, args.kick_crash_probs)]
+
+    dataset_writer = StateDatasetWriter(args.output_folder, tunes_folder=args.folder, n_workers=args.workers,
+                                        shard_size=args.shard_size)
+    dataset_writer.write(selected_files, param_settings, args.samples, seed=args.seed)